@@ -0,0 +1,125 @@
+"""Cold import time of the package's entry points, per module, from python -X importtime.
+
+    python -m exchanges.benchmarks.import_time                         exchanges.factory and each adapter
+    python -m exchanges.benchmarks.import_time exchanges.binance --top 30
+    python -m exchanges.benchmarks.import_time --output results.json
+
+Every target is imported in a fresh interpreter, repeat times, keeping the fastest run. For each one the report gives
+the total, and the modules that took longest including what they imported themselves, so a new eager import of a
+heavy library shows up by name. Modules a bare interpreter imports at startup (site, encodings, ...) are left out of
+both, and their time reported once as startup_ms. Targets that fail to import (a client library not installed, say)
+are reported with their error rather than stopping the run.
+
+-X importtime needs Python 3.7 or later.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+TARGETS = ('exchanges.factory', 'exchanges.binance', 'exchanges.bittrex2', 'exchanges.cryptopia', 'exchanges.idex',
+           'exchanges.okex_service', 'exchanges.qryptos')
+REPEAT = 3
+TOP = 15
+
+
+def parse_importtime(output):
+    """
+    :param output: stderr of python -X importtime
+    :return: [(module, self_us, cumulative_us)], in import order
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # The header line
+            continue
+        modules.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return modules
+
+
+def measure(target=None):
+    """
+    :param target: module to import, None for a bare interpreter
+    :return: (modules as in parse_importtime, or None, error or None)
+    """
+    code = 'pass' if target is None else 'import ' + target
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        return None, process.stderr.strip().splitlines()[-1]
+    modules = parse_importtime(process.stderr)
+    if len(modules) == 0:
+        # Interpreters before 3.7 ignore -X importtime rather than failing
+        return None, 'python -X importtime reported no imports. It needs Python 3.7 or later'
+    return modules, None
+
+
+def fastest(target, repeat, exclude=frozenset()):
+    """
+    :param exclude: names of modules left out of the total and the list
+    :return: (total_us, modules as in parse_importtime) of the fastest run, or (None, error)
+    """
+    best = None
+    for _ in range(repeat):
+        modules, error = measure(target)
+        if error is not None:
+            return None, error
+        modules = [module for module in modules if module[0] not in exclude]
+        total_us = sum(self_us for _, self_us, _ in modules)
+        if best is None or total_us < best[0]:
+            best = (total_us, modules)
+    return best
+
+
+def run(target, repeat=REPEAT, top=TOP, startup_modules=frozenset()):
+    """
+    :param startup_modules: names of the modules a bare interpreter imports, left out of the results
+    """
+    total_us, modules = fastest(target, repeat, startup_modules)
+    if total_us is None:
+        return {'target': target, 'error': modules}
+
+    slowest = sorted(modules, key=lambda module: module[2], reverse=True)[:top]
+    return {'target': target,
+            'total_ms': round(total_us / 1000.0, 1),
+            'modules': len(modules),
+            'slowest': [{'module': name, 'self_ms': round(self_us / 1000.0, 1),
+                         'cumulative_ms': round(cumulative_us / 1000.0, 1)}
+                        for name, self_us, cumulative_us in slowest]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure cold import time of the exchanges package')
+    parser.add_argument('targets', nargs='*', default=list(TARGETS), help='modules to import')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='fresh interpreters per target, fastest is kept')
+    parser.add_argument('--top', type=int, default=TOP, help='slowest modules to list per target')
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    args = parser.parse_args(argv)
+    if sys.version_info < (3, 7):
+        parser.error('python -X importtime needs Python 3.7 or later, this is {}'.format(platform.python_version()))
+
+    startup_us, startup = fastest(None, args.repeat)
+    if startup_us is None:
+        parser.error(startup)
+    startup_modules = frozenset(name for name, _, _ in startup)
+    report = {'benchmark': 'import_time',
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'created_s': int(time.time()),
+              'startup_ms': round(startup_us / 1000.0, 1),
+              'results': [run(target, args.repeat, args.top, startup_modules) for target in args.targets]}
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
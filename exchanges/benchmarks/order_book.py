@@ -0,0 +1,214 @@
+"""Throughput, latency and memory of the Binance OrderBookService hot path, without a network.
+
+    python -m exchanges.benchmarks.order_book                          synthetic top_n books of 1k, 10k and 50k levels
+    python -m exchanges.benchmarks.order_book --levels 10000 --updates 50000 --publish-mode delta
+    python -m exchanges.benchmarks.order_book --capture captures --symbol BTCUSDT
+    python -m exchanges.benchmarks.order_book --output results.json
+
+Results are printed as JSON, one entry per run, so two of them can be diffed to catch regressions. Latency is
+measured from handing a diff to the service to its order_book callback running, on the same thread.
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from exchanges.binance.depth_capture import DIFF, DepthReplay
+from exchanges.binance.order_book import OrderBookService, PUBLISH_MODES
+
+LEVELS = (1000, 10000, 50000)
+UPDATES = 20000
+LEVELS_PER_UPDATE = 5
+TICK_SIZE = '0.01'
+STEP_SIZE = '0.001'
+
+
+class SyntheticDepthFeed(object):
+    """Stands in for the depth socket and the recovery worker of one OrderBookService, like DepthReplay does.
+
+    The book starts from a snapshot of `levels` levels per side around a mid price of 10000.00; every diff then
+    changes levels_per_update levels on each side, each one a quantity change, a removal or an insertion with equal
+    odds of the last two, so the book stays around its starting depth.
+    """
+
+    def __init__(self, levels, levels_per_update=LEVELS_PER_UPDATE, seed=1):
+        self.levels = levels
+        self.levels_per_update = levels_per_update
+        self.random = random.Random(seed)
+        self.callback = None
+        self.recovering = None
+        self.update_id = 0
+        self.mid_ticks = 1000000
+
+    def subscribe(self, symbol, callback):
+        self.callback = callback
+
+    def unsubscribe(self, symbol):
+        self.callback = None
+
+    def request(self, order_book_service, delay_s=0):
+        self.recovering = order_book_service
+
+    def snapshot(self):
+        bids = [[self.__price(self.mid_ticks - i), self.__quantity()] for i in range(1, self.levels + 1)]
+        asks = [[self.__price(self.mid_ticks + i), self.__quantity()] for i in range(1, self.levels + 1)]
+        return {'lastUpdateId': self.update_id, 'bids': bids, 'asks': asks}
+
+    def diff(self):
+        first_update_id = self.update_id + 1
+        self.update_id += 1
+        return {'e': 'depthUpdate', 'U': first_update_id, 'u': self.update_id,
+                'b': [self.__level(-1) for _ in range(self.levels_per_update)],
+                'a': [self.__level(1) for _ in range(self.levels_per_update)]}
+
+    def start(self, service):
+        """Sends the first diff, which makes the service ask for a snapshot, then answers with the snapshot."""
+        service.start()
+        self.callback(self.diff())
+        service.on_snapshot(self.snapshot())
+
+    def __level(self, direction):
+        # Prices are drawn from twice the starting depth, so about half of them hit an existing level
+        price = self.__price(self.mid_ticks + direction * self.random.randint(1, 2 * self.levels))
+        if self.random.random() < 0.25:
+            return [price, '0.000']
+        return [price, self.__quantity()]
+
+    def __quantity(self):
+        return '{:.3f}'.format(self.random.randint(1, 100000) / 1000.0)
+
+    @staticmethod
+    def __price(ticks):
+        return '{}.{:02d}'.format(ticks // 100, ticks % 100)
+
+
+class LatencyRecorder(object):
+
+    def __init__(self):
+        self.sent = None
+        self.latencies = []
+
+    def callback(self, topic, **kwargs):
+        if self.sent is not None:
+            self.latencies.append(time.perf_counter() - self.sent)
+            self.sent = None
+
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(name, levels, publish_mode, elapsed_s, latencies, book_bytes):
+    latencies = sorted(latencies)
+    to_us = lambda value: None if value is None else round(value * 1e6, 2)
+    return {'name': name,
+            'levels': levels,
+            'publish_mode': publish_mode,
+            'updates': len(latencies),
+            'updates_per_s': round(len(latencies) / elapsed_s, 1) if elapsed_s > 0 else None,
+            'latency_us': {'p50': to_us(percentile(latencies, 0.5)),
+                           'p99': to_us(percentile(latencies, 0.99)),
+                           'p999': to_us(percentile(latencies, 0.999)),
+                           'max': to_us(latencies[-1] if len(latencies) > 0 else None)},
+            'book_bytes': book_bytes}
+
+
+def run_synthetic(levels, updates, publish_mode, depth):
+    recorder = LatencyRecorder()
+    feed = SyntheticDepthFeed(levels)
+
+    # Memory is the growth in traced allocations from an empty service to one holding the loaded book
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    service = OrderBookService(None, 'BTC', 'USDT', recorder.callback, 'binance', publish_mode=publish_mode,
+                               depth=depth, depth_socket=feed, recovery=feed, tick_size=TICK_SIZE,
+                               step_size=STEP_SIZE)
+    feed.start(service)
+    gc.collect()
+    book_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # Diffs are generated up front so only the service is timed
+    diffs = [feed.diff() for _ in range(updates)]
+    callback = feed.callback
+    gc.collect()
+    started = time.perf_counter()
+    for diff in diffs:
+        recorder.sent = time.perf_counter()
+        callback(diff)
+    elapsed_s = time.perf_counter() - started
+
+    return summarize('synthetic', levels, publish_mode, elapsed_s, recorder.latencies, book_bytes)
+
+
+def run_capture(directory, symbol, publish_mode, depth):
+    recorder = LatencyRecorder()
+    replay = DepthReplay(directory, symbol)
+    service = OrderBookService(None, symbol, '', recorder.callback, 'binance', publish_mode=publish_mode,
+                               depth=depth, depth_socket=replay, recovery=replay, tick_size=replay.tick_size,
+                               step_size=replay.step_size)
+    service.start()
+
+    # Records are read up front so decompression is not timed. Snapshots go through replay.run's logic unchanged
+    records = list(replay.records())
+    callback = replay.callback
+    gc.collect()
+    started = time.perf_counter()
+    for kind, received_ms, payload in records:
+        if kind == DIFF:
+            recorder.sent = time.perf_counter()
+            callback(payload)
+        elif replay.recovering is not None:
+            pending = replay.recovering
+            replay.recovering = None
+            if not pending.on_snapshot(payload):
+                replay.recovering = pending
+    elapsed_s = time.perf_counter() - started
+
+    snapshot = service.get_snapshot()
+    return summarize('capture:' + symbol, len(snapshot.bids) + len(snapshot.asks), publish_mode, elapsed_s,
+                     recorder.latencies, None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Binance OrderBookService hot path')
+    parser.add_argument('--levels', type=int, nargs='+', default=list(LEVELS), help='levels per side of the book')
+    parser.add_argument('--updates', type=int, default=UPDATES, help='synthetic diffs per run')
+    # 'full' formats the whole book on every diff, so on deep books it measures formatting, not book maintenance
+    parser.add_argument('--publish-mode', default='top_n', choices=PUBLISH_MODES)
+    parser.add_argument('--depth', type=int, default=10, help='depth of the top_n publish mode')
+    parser.add_argument('--capture', help='directory of a DepthCapture to replay instead of synthetic diffs')
+    parser.add_argument('--symbol', help='symbol of the capture to replay')
+    parser.add_argument('--output', help='file to write the JSON results to, stdout by default')
+    args = parser.parse_args(argv)
+
+    if args.capture is not None:
+        if args.symbol is None:
+            parser.error('--capture needs --symbol')
+        results = [run_capture(args.capture, args.symbol, args.publish_mode, args.depth)]
+    else:
+        results = [run_synthetic(levels, args.updates, args.publish_mode, args.depth) for levels in args.levels]
+
+    report = {'benchmark': 'order_book',
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'created_s': int(time.time()),
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
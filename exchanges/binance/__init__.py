@@ -1,12 +1,20 @@
-import time
+from decimal import Decimal
+
 from binance.exceptions import BinanceAPIException
 from aj_sns.transfer_service import TransferService
 from exchanges.exchange import Exchange
-from exchanges.binance.order_book import OrderBookService
+from exchanges.binance.clock_sync import ClockSync
+from exchanges.binance.depth_capture import DepthCapture
+from exchanges.binance.depth_socket import DepthSocketManager
+from exchanges.binance.limits import WeightGovernor
+from exchanges.binance.order_book import OrderBookService, DEFAULT_INCREMENT
+from exchanges.binance.snapshot_recovery import SnapshotRecoveryWorker
+from exchanges.binance.symbol_info import SymbolInfoService
 from exchanges.binance.user_data import UserDataService
+from exchanges.common.events import LifecycleEvent
+from exchanges.common.metrics import ReceiveTime
 from binance.client import Client
 from aj_sns.log_service import logger
-from pandas import DataFrame
 
 
 class BinanceService(Exchange, TransferService):
@@ -15,10 +23,19 @@ class BinanceService(Exchange, TransferService):
         Exchange.__init__(self, name)
         TransferService.__init__(self)
         self.client = Client(public_key, private_key)
-        self.user_data_service = UserDataService(self.client, self.notify_callbacks, name)
+        # Every REST call below goes through the governor, see limits.WeightGovernor
+        self.governor = WeightGovernor(self.client, metrics=self.metrics)
+        self.symbol_info = SymbolInfoService(self.client, governor=self.governor)
+        self.user_data_service = UserDataService(self.client, self.notify_callbacks, name, self.symbol_info,
+                                                 self.latencies)
+        self.clock_sync = ClockSync(self.client, self.latencies.clock, governor=self.governor)
         self.is_authenticated = (public_key is not None) and (private_key is not None)
+        self.depth_socket = DepthSocketManager(self.client, metrics=self.metrics)
+        self.snapshot_recovery = SnapshotRecoveryWorker(self.client, metrics=self.metrics, governor=self.governor)
         self.order_book_services = {}
-        self.callbacks = {}
+
+    def warm_up(self):
+        self.symbol_info.load()
 
     def follow_market(self, base, quote):
         self.follow_order_book(base, quote)
@@ -31,6 +48,7 @@ class BinanceService(Exchange, TransferService):
 
     def follow_user_data(self):
         if self.is_authenticated:
+            self.clock_sync.start()
             self.user_data_service.start()
 
     def unfollow_user_data(self):
@@ -46,18 +64,49 @@ class BinanceService(Exchange, TransferService):
         self.order_book_services = {}
         self.unfollow_user_data()
 
-    def follow_order_book(self, base, quote):
+    def follow_order_book(self, base, quote, publish_mode='full', depth=10, capture_directory=None,
+                          conflation_ms=None, conflation_count=None):
+        """
+        :param publish_mode: what each order_book callback carries. One of 'full', 'top_n' (best `depth` levels),
+                             'best' (best bid/ask) or 'delta' (changed levels only). See order_book.PUBLISH_MODES
+        :param capture_directory: if given, every raw diff and snapshot of the cross is also written there, to be
+                                  replayed offline with depth_capture.DepthReplay
+        :param conflation_ms: publish at most once per this many milliseconds, merging the diffs in between
+        :param conflation_count: publish at most once per this many diffs. Either or both conflation limits can be set.
+                                 Given only a count, diffs still wait at most order_book.MAX_CONFLATION_MS
+        """
         cross = base+quote
         if cross not in self.order_book_services:
             logger().info('Subscribing to ' + cross)
+            self.clock_sync.start()
+            tick_size, step_size = self.__get_increments(cross)
+            capture = None
+            if capture_directory is not None:
+                capture = DepthCapture(capture_directory, cross, tick_size, step_size)
             self.order_book_services[cross] = OrderBookService(self.client, base, quote,
-                                                               self.notify_callbacks, self.name)
+                                                               self.notify_callbacks, self.name,
+                                                               publish_mode=publish_mode, depth=depth,
+                                                               depth_socket=self.depth_socket,
+                                                               recovery=self.snapshot_recovery,
+                                                               tick_size=tick_size, step_size=step_size,
+                                                               capture=capture, conflation_ms=conflation_ms,
+                                                               conflation_count=conflation_count,
+                                                               latencies=self.latencies,
+                                                               metrics=self.metrics)
             self.order_book_services[cross].start()
             return True
         else:
             logger().warning('Already subscribed to '+base+quote)
             pass
 
+    def __get_increments(self, cross):
+        info = self.symbol_info.get(cross)
+        if info is None:
+            logger().warning('No symbol info for {}. Assuming 8 decimal prices and quantities'.format(cross))
+            return DEFAULT_INCREMENT, DEFAULT_INCREMENT
+
+        return info.tick_size or DEFAULT_INCREMENT, info.step_size or DEFAULT_INCREMENT
+
     def unfollow_order_book(self, base, quote):
         cross = base+quote
         if cross in self.order_book_services:
@@ -68,20 +117,56 @@ class BinanceService(Exchange, TransferService):
             # send some kind of warning message (not following)?
             pass
 
-    def get_order_book(self, base, quote):
+    def get_order_book(self, base, quote, depth=None):
         cross = base + quote
         if cross in self.order_book_services:
-            book = self.order_book_services[cross].get_order_book()
+            book = self.order_book_services[cross].get_order_book(depth)
             return book
         else:
             raise LookupError('Not subscribed to cross: {}. First call BinanceService.follow_order_book(base, quote)'
                               .format(cross))
 
+    def get_order_book_snapshot(self, base, quote):
+        """
+        :return: the latest immutable BookSnapshot of a followed cross. Cheap to call from any thread; compare its
+                 version with one seen earlier to tell whether the book changed
+        """
+        cross = base + quote
+        if cross in self.order_book_services:
+            return self.order_book_services[cross].get_snapshot()
+        else:
+            raise LookupError('Not subscribed to cross: {}. First call BinanceService.follow_order_book(base, quote)'
+                              .format(cross))
+
     def create_order(self, base, quote, price, quantity, side, order_type, internal_order_id, request_id=None,
                      requester_id=None, **kwargs):
         try:
-            self.client.create_order(symbol=base + quote, side=side, type=order_type, timeInForce='GTC',
-                                        quantity=quantity, price=price, newClientOrderId=internal_order_id)
+            symbol = base + quote
+            formatted_quantity = self.symbol_info.format_quantity(symbol, quantity)
+            if Decimal(formatted_quantity) == 0:
+                logger().error('Not creating order {}: its {} quantity {} is less than one step'
+                               .format(internal_order_id, symbol, quantity))
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CREATE_FAILED',
+                    reason='quantity_below_step_size',
+                    exchange=self.name,
+                    base=base,
+                    quote=quote,
+                    internal_order_id=internal_order_id,
+                    request_id=request_id,
+                    requester_id=requester_id,
+                    side=side,
+                    quantity=str(quantity),
+                    price=str(price),
+                    cum_quantity_filled=0,
+                    receive_time=ReceiveTime()
+                ))
+                return
+            with self.governor.request('create_order'), self.metrics.rest_call('create_order'):
+                self.client.create_order(symbol=symbol, side=side, type=order_type, timeInForce='GTC',
+                                         quantity=formatted_quantity,
+                                         price=self.symbol_info.format_price(symbol, price, side),
+                                         newClientOrderId=internal_order_id)
             message = dict()
             message['internal_order_id'] = internal_order_id
             message['request_id'] = request_id
@@ -94,34 +179,36 @@ class BinanceService(Exchange, TransferService):
 
     def cancel_order(self, base, quote, internal_order_id, request_id, requester_id=None, exchange_order_id=None):
         try:
-            self.client.cancel_order(symbol=base+quote, origClientOrderId=internal_order_id)
+            with self.governor.request('cancel_order'), self.metrics.rest_call('cancel_order'):
+                self.client.cancel_order(symbol=base+quote, origClientOrderId=internal_order_id)
             message = dict()
             message['action'] = 'cancel_sent'
             message['internal_order_id'] = internal_order_id
             message['request_id'] = request_id
             message['exchange'] = self.name
-            self.user_data_service.pending_cancel[internal_order_id] = True
+            self.user_data_service.orders.set_pending_cancel(internal_order_id)
             self.notify_callbacks('trade_lifecycle', trade_lifecycle_type='cancel_sent', data=message)
         except BinanceAPIException as e:
             logger().error('Failed to cancel order. Exception was: {}'.format(e))
             if str(e.code) == '-2011':
-                self.notify_callbacks('trade_lifecycle', data={
-                    'action': 'CANCEL_FAILED',
-                    'reason': 'order_not_found',
-                    'base': base,
-                    'quote': quote,
-                    'exchange': self.name,
-                    'exchange_order_id': exchange_order_id,
-                    'internal_order_id': internal_order_id,
-                    'order_status': 'UNKNOWN',
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000))
-                })
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CANCEL_FAILED',
+                    reason='order_not_found',
+                    base=base,
+                    quote=quote,
+                    exchange=self.name,
+                    exchange_order_id=exchange_order_id,
+                    internal_order_id=internal_order_id,
+                    order_status='UNKNOWN',
+                    server_ms=None,
+                    receive_time=ReceiveTime()
+                ))
 
 
     def get_balances(self):
         try:
-            account = self.client.get_account()
+            with self.governor.request('account'), self.metrics.rest_call('account'):
+                account = self.client.get_account()
             self.notify_callbacks('account', account_type='balance', data=account['balances'])
             return account['balances']
         except BinanceAPIException as e:
@@ -184,10 +271,5 @@ class BinanceService(Exchange, TransferService):
             'tag': response['addressTag']
         }
 
-    @staticmethod
-    def get_limits():
-        from requests import get
-        url = 'https://api.binance.com/api/v1/exchangeInfo'
-        r = get(url)
-        j = r.json()
-        return j
+    def get_limits(self):
+        return self.symbol_info.load()
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from aj_sns.log_service import logger
+
+
+class ClockSync(object):
+    """Keeps a metrics.ClockOffset of Binance's clock against ours up to date from its REST server time.
+
+    A few samples are taken on start, so the shortest round trip among them sets the first estimate, then one more
+    every interval_s on a daemon timer to follow drift.
+    """
+
+    INTERVAL_S = 600
+    INITIAL_SAMPLES = 3
+
+    def __init__(self, client, clock, interval_s=INTERVAL_S, governor=None):
+        """
+        :param governor: a limits.WeightGovernor the server time calls take their request weight from
+        """
+        self.client = client
+        self.clock = clock
+        self.governor = governor
+        self.interval_s = interval_s
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def start(self):
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = self.__schedule()
+        for _ in range(ClockSync.INITIAL_SAMPLES):
+            self.sync()
+
+    def stop(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def sync(self):
+        try:
+            if self.governor is None:
+                server_time, sent_ms, received_ms = self.__get_server_time()
+            else:
+                with self.governor.request('server_time'):
+                    server_time, sent_ms, received_ms = self.__get_server_time()
+            self.clock.add_sample(server_time['serverTime'], sent_ms, received_ms)
+        except Exception as e:
+            logger().warning('Failed to sample the Binance server time. Exception was: {}'.format(e))
+
+    def __get_server_time(self):
+        # Timed around the call alone, not any wait for request weight
+        sent_ms = time.time() * 1000
+        server_time = self.client.get_server_time()
+        return server_time, sent_ms, time.time() * 1000
+
+    def __on_timer(self):
+        self.sync()
+        with self.lock:
+            if self.timer is not None:
+                self.timer = self.__schedule()
+
+    def __schedule(self):
+        timer = threading.Timer(self.interval_s, self.__on_timer)
+        timer.daemon = True
+        timer.start()
+        return timer
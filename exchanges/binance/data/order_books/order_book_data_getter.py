@@ -1,55 +1,47 @@
 import json
+import sys
+import time
 from exchanges.binance import BinanceService
 
-bs = BinanceService()
-bs.follow_order_book("BNB", "BTC")
-bs.follow_order_book("BNB", "USDT")
-bs.follow_order_book("BTC", "USDT")
-bs.follow_order_book("ETH", "BTC")
-bs.follow_order_book("ETH", "USDT")
-bs.follow_order_book("NEO", "BNB")
-bs.follow_order_book("NEO", "BTC")
-bs.follow_order_book("NEO", "ETH")
-bs.follow_order_book("NEO", "USDT")
+# python order_book_data_getter.py              dumps one snapshot of each cross to <base>_<quote>.json
+# python order_book_data_getter.py captures     also keeps capturing raw diffs into captures/ until interrupted,
+#                                               for replay with exchanges.binance.depth_capture.DepthReplay
+CROSSES = [("BNB", "BTC"), ("BNB", "USDT"), ("BTC", "USDT"), ("ETH", "BTC"), ("ETH", "USDT"),
+           ("NEO", "BNB"), ("NEO", "BTC"), ("NEO", "ETH"), ("NEO", "USDT")]
 
+capture_directory = sys.argv[1] if len(sys.argv) > 1 else None
 
-def strip_and_write(order_book, file_):
-    del order_book['timestamp']
-    as_json = order_book.to_dict(orient='records')
-    file_.write(json.dumps(as_json))
-
-
-with open('bnb_btc.json', 'w') as file:
-    strip_and_write(bs.get_order_book("BNB", "BTC"), file)
-
-
-with open('bnb_usdt.json', 'w') as file:
-    strip_and_write(bs.get_order_book("BNB", "USDT"), file)
-
-
-with open('btc_usdt.json', 'w') as file:
-    strip_and_write(bs.get_order_book("BTC", "USDT"), file)
-
+bs = BinanceService('binance')
+for base, quote in CROSSES:
+    bs.follow_order_book(base, quote, capture_directory=capture_directory)
 
-with open('eth_btc.json', 'w') as file:
-    strip_and_write(bs.get_order_book("ETH", "BTC"), file)
 
+def wait_for_book(base, quote, timeout_s=30):
+    deadline = time.time() + timeout_s
+    while bs.get_order_book_snapshot(base, quote).version == 0 and time.time() < deadline:
+        time.sleep(0.1)
 
-with open('eth_usdt.json', 'w') as file:
-    strip_and_write(bs.get_order_book("ETH", "USDT"), file)
 
-
-with open('neo_bnb.json', 'w') as file:
-    strip_and_write(bs.get_order_book("NEO", "BNB"), file)
-
-
-with open('neo_btc.json', 'w') as file:
-    strip_and_write(bs.get_order_book("NEO", "BTC"), file)
-
-
-with open('neo_eth.json', 'w') as file:
-    strip_and_write(bs.get_order_book("NEO", "ETH"), file)
-
-
-with open('neo_usdt.json', 'w') as file:
-    strip_and_write(bs.get_order_book("NEO", "USDT"), file)
+def strip_and_write(order_book, file_):
+    records = []
+    for side, levels in (('sell', order_book['asks']), ('buy', order_book['bids'])):
+        for depth, (price, quantity) in enumerate(levels, 1):
+            records.append({'depth': depth, 'price': price, 'quantity': quantity, 'side': side,
+                            'exchange': order_book['exchange'], 'quote': order_book['quote'],
+                            'base': order_book['base']})
+    file_.write(json.dumps(records, indent=2))
+
+
+for base, quote in CROSSES:
+    wait_for_book(base, quote)
+    with open('{}_{}.json'.format(base.lower(), quote.lower()), 'w') as file:
+        strip_and_write(bs.get_order_book(base, quote), file)
+
+if capture_directory is not None:
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+bs.unfollow_all()
@@ -0,0 +1,183 @@
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+
+from aj_sns.log_service import logger
+
+# Record kinds, the first field of every captured line
+DIFF = 'd'
+SNAPSHOT = 's'
+
+
+class DepthCapture(object):
+    """Appends the raw depth diffs and REST snapshots an OrderBookService sees to compressed segment files.
+
+    Files live in <directory>/<symbol>/: meta.json holds the tick and step sizes, segment-NNNNNN.jsonl.gz hold one
+    compact JSON line per record ([kind, received_ms, payload]) and index.jsonl gets one line per closed segment with
+    its record count and first/last receive time and update id, so a replay can pick segments without opening them.
+    """
+
+    SEGMENT_RECORDS = 100000
+
+    def __init__(self, directory, symbol, tick_size, step_size, segment_records=SEGMENT_RECORDS):
+        self.directory = os.path.join(directory, symbol)
+        self.symbol = symbol
+        self.segment_records = segment_records
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_name = None
+        self.segment_stats = None
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as meta_file:
+            json.dump({'symbol': symbol, 'tick_size': tick_size, 'step_size': step_size}, meta_file)
+        self.next_segment = len(glob.glob(os.path.join(self.directory, 'segment-*.jsonl.gz')))
+
+    def record_diff(self, msg, received_ms=None):
+        self.__record(DIFF, msg, msg['U'], msg['u'], received_ms)
+
+    def record_snapshot(self, snapshot, received_ms=None):
+        self.__record(SNAPSHOT, snapshot, snapshot['lastUpdateId'], snapshot['lastUpdateId'], received_ms)
+
+    def close(self):
+        with self.lock:
+            self.__close_segment()
+
+    def __record(self, kind, payload, first_update_id, last_update_id, received_ms):
+        if received_ms is None:
+            received_ms = int(round(time.time() * 1000))
+        line = json.dumps([kind, received_ms, payload], separators=(',', ':'))
+        with self.lock:
+            if self.segment is None:
+                self.__open_segment()
+            self.segment.write(line)
+            self.segment.write('\n')
+
+            stats = self.segment_stats
+            if stats['records'] == 0:
+                stats['first_ms'] = received_ms
+                stats['first_update_id'] = first_update_id
+            stats['records'] += 1
+            stats['last_ms'] = received_ms
+            stats['last_update_id'] = last_update_id
+
+            if stats['records'] >= self.segment_records:
+                self.__close_segment()
+
+    def __open_segment(self):
+        self.segment_name = 'segment-{:06d}.jsonl.gz'.format(self.next_segment)
+        self.next_segment += 1
+        self.segment = gzip.open(os.path.join(self.directory, self.segment_name), 'wt')
+        self.segment_stats = {'segment': self.segment_name, 'records': 0}
+
+    def __close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        with open(os.path.join(self.directory, 'index.jsonl'), 'a') as index_file:
+            index_file.write(json.dumps(self.segment_stats, separators=(',', ':')))
+            index_file.write('\n')
+        self.segment = None
+
+
+class DepthReplay(object):
+    """Feeds a DepthCapture back through an OrderBookService's normal update path.
+
+    The replay stands in for both the depth socket and the snapshot recovery worker of the service it drives:
+    diffs go to the callback the service subscribed with, and when the service asks for a snapshot it gets the
+    next recorded one. Passing speed=10 replays ten times faster than recorded, speed=None as fast as possible.
+
+        replay = DepthReplay('captures', 'BTCUSDT')
+        service = OrderBookService(None, 'BTC', 'USDT', callback, 'binance', depth_socket=replay, recovery=replay,
+                                   tick_size=replay.tick_size, step_size=replay.step_size)
+        service.start()
+        replay.run(speed=10)
+    """
+
+    def __init__(self, directory, symbol):
+        self.directory = os.path.join(directory, symbol)
+        self.symbol = symbol
+        with open(os.path.join(self.directory, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        self.tick_size = meta['tick_size']
+        self.step_size = meta['step_size']
+        self.callback = None
+        self.recovering = None
+
+    # Depth socket interface
+    def subscribe(self, symbol, callback):
+        self.callback = callback
+
+    def unsubscribe(self, symbol):
+        self.callback = None
+
+    # Snapshot recovery interface
+    def request(self, order_book_service, delay_s=0):
+        self.recovering = order_book_service
+
+    def segments(self, start_ms=None, end_ms=None):
+        index = {}
+        index_path = os.path.join(self.directory, 'index.jsonl')
+        if os.path.isfile(index_path):
+            with open(index_path) as index_file:
+                for line in index_file:
+                    entry = json.loads(line)
+                    index[entry['segment']] = entry
+
+        segments = []
+        for path in sorted(glob.glob(os.path.join(self.directory, 'segment-*.jsonl.gz'))):
+            # A segment missing from the index was still open when capture stopped, so it cannot be skipped
+            entry = index.get(os.path.basename(path))
+            if entry is not None and ((start_ms is not None and entry['last_ms'] < start_ms) or
+                                      (end_ms is not None and entry['first_ms'] > end_ms)):
+                continue
+            segments.append(path)
+
+        return segments
+
+    def records(self, start_ms=None, end_ms=None):
+        for path in self.segments(start_ms, end_ms):
+            with gzip.open(path, 'rt') as segment:
+                try:
+                    for line in segment:
+                        record = json.loads(line)
+                        if start_ms is not None and record[1] < start_ms:
+                            continue
+                        if end_ms is not None and record[1] > end_ms:
+                            return
+                        yield record
+                except (EOFError, zlib.error, ValueError):
+                    # The last segment of a capture that was not closed cleanly ends mid-stream
+                    logger().warning('Capture segment {} is truncated. Skipping the rest of it'.format(path))
+
+    def run(self, speed=None, start_ms=None, end_ms=None):
+        """Replays the capture and returns the number of records fed to the service."""
+        count = 0
+        first_ms = None
+        started = time.monotonic()
+
+        for kind, received_ms, payload in self.records(start_ms, end_ms):
+            if speed is not None:
+                if first_ms is None:
+                    first_ms = received_ms
+                wait_s = (received_ms - first_ms) / 1000.0 / speed - (time.monotonic() - started)
+                if wait_s > 0:
+                    time.sleep(wait_s)
+
+            if kind == DIFF:
+                if self.callback is not None:
+                    self.callback(payload)
+            elif kind == SNAPSHOT and self.recovering is not None:
+                service = self.recovering
+                self.recovering = None
+                if not service.on_snapshot(payload):
+                    # Live, the worker would fetch another snapshot; here that is the next recorded one
+                    self.recovering = service
+            count += 1
+
+        return count
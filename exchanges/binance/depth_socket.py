@@ -0,0 +1,160 @@
+import threading
+
+from aj_sns.log_service import logger
+from binance.websockets import BinanceSocketManager
+
+from exchanges.common.metrics import ReceiveTime
+
+
+class DepthSocketManager(object):
+    """Multiplexes the depth streams of every followed cross over Binance combined-stream connections.
+
+    One BinanceSocketManager (so one reactor thread) serves all crosses. Streams are packed into shards of at
+    most max_streams_per_connection, each shard being a single combined-stream connection. A connection's streams
+    are fixed when it opens: BinanceSocketManager cannot send SUBSCRIBE or UNSUBSCRIBE on a live connection, and
+    reopening it would cost every other stream on it a gap and a snapshot recovery. So a cross subscribed at runtime
+    goes on a new shard, an unsubscribed one is only dropped from the callbacks, and a shard's connection is closed
+    once none of its streams is subscribed any more. Subscriptions made within reconnect_delay_s of each other share
+    one new shard, so following 150 crosses at start up opens one connection, not 150.
+    """
+
+    # Binance accepts up to 1024 streams per connection, but the stream list travels in the URL
+    MAX_STREAMS_PER_CONNECTION = 200
+    RECONNECT_DELAY_S = 0.5
+
+    def __init__(self, client, max_streams_per_connection=MAX_STREAMS_PER_CONNECTION,
+                 reconnect_delay_s=RECONNECT_DELAY_S, metrics=None):
+        self.bm = BinanceSocketManager(client)
+        # Optional metrics.MetricsRegistry to count connections and errors into
+        self.metrics = metrics
+        self.max_streams_per_connection = max_streams_per_connection
+        self.reconnect_delay_s = reconnect_delay_s
+        self.lock = threading.RLock()
+        self.callbacks = {}
+        self.shards = []
+        # Subscribed streams only. A shard may carry more, unsubscribed since it opened
+        self.stream_to_shard = {}
+        self.pending_shards = []
+        self.reconnect_timer = None
+        self.started = False
+
+    @staticmethod
+    def to_stream(symbol):
+        return symbol.lower() + '@depth'
+
+    def subscribe(self, symbol, callback):
+        stream = DepthSocketManager.to_stream(symbol)
+        with self.lock:
+            already_subscribed = stream in self.callbacks
+            self.callbacks[stream] = callback
+            if already_subscribed:
+                return
+
+            # Unsubscribed earlier but still carried by an open connection, which can simply be listened to again
+            for shard in self.shards:
+                if stream in shard.streams:
+                    shard.subscribed.add(stream)
+                    self.stream_to_shard[stream] = shard
+                    return
+
+            shard = self.__unopened_shard_with_room()
+            shard.streams.add(stream)
+            shard.subscribed.add(stream)
+            self.stream_to_shard[stream] = shard
+            self.__schedule_reconnect(shard)
+
+    def unsubscribe(self, symbol):
+        stream = DepthSocketManager.to_stream(symbol)
+        with self.lock:
+            self.callbacks.pop(stream, None)
+            shard = self.stream_to_shard.pop(stream, None)
+            if shard is None:
+                return
+            shard.subscribed.discard(stream)
+            if shard.conn_key is None:
+                shard.streams.discard(stream)
+            if len(shard.subscribed) == 0:
+                self.__schedule_reconnect(shard)
+
+    def get_connection_count(self):
+        with self.lock:
+            return len([shard for shard in self.shards if shard.conn_key is not None])
+
+    def close(self):
+        with self.lock:
+            if self.reconnect_timer is not None:
+                self.reconnect_timer.cancel()
+                self.reconnect_timer = None
+            self.bm.close()
+            self.callbacks = {}
+            self.shards = []
+            self.stream_to_shard = {}
+            self.pending_shards = []
+
+    def __unopened_shard_with_room(self):
+        for shard in self.shards:
+            if shard.conn_key is None and len(shard.streams) < self.max_streams_per_connection:
+                return shard
+
+        shard = _Shard()
+        self.shards.append(shard)
+        return shard
+
+    def __schedule_reconnect(self, shard):
+        if shard not in self.pending_shards:
+            self.pending_shards.append(shard)
+
+        if self.reconnect_timer is None:
+            self.reconnect_timer = threading.Timer(self.reconnect_delay_s, self.__reconnect_pending_shards)
+            self.reconnect_timer.daemon = True
+            self.reconnect_timer.start()
+
+    def __reconnect_pending_shards(self):
+        # Opens new shards and closes empty ones. An open shard with subscribed streams is never touched
+        with self.lock:
+            self.reconnect_timer = None
+            shards = self.pending_shards
+            self.pending_shards = []
+
+            if not self.started:
+                self.bm.start()
+                self.started = True
+
+            for shard in shards:
+                if len(shard.subscribed) == 0:
+                    if shard.conn_key is not None:
+                        self.bm.stop_socket(shard.conn_key)
+                        shard.conn_key = None
+                        logger().info('Closed a Binance depth connection carrying no subscribed stream')
+                elif shard.conn_key is None:
+                    shard.conn_key = self.bm.start_multiplex_socket(sorted(shard.streams), self.__process_message)
+                    logger().info('Opened a Binance depth connection carrying {} streams'.format(len(shard.streams)))
+                    if self.metrics is not None:
+                        self.metrics.counter('socket_connects_total', 'Websocket connections opened',
+                                             socket='depth').inc()
+
+            self.shards = [shard for shard in self.shards if len(shard.subscribed) > 0]
+            if self.metrics is not None:
+                self.metrics.gauge('socket_connections', 'Websocket connections open', socket='depth').set(
+                    len([shard for shard in self.shards if shard.conn_key is not None]))
+
+    def __process_message(self, msg):
+        # The one place depth messages are timestamped on arrival
+        receive_time = ReceiveTime()
+        # Combined stream payloads are wrapped as {'stream': 'bnbbtc@depth', 'data': {...}}
+        callback = self.callbacks.get(msg.get('stream'))
+        if callback is not None:
+            callback(msg['data'], receive_time)
+        elif msg.get('e') == 'error':
+            logger().error('Binance depth connection failed with error: {}'.format(msg.get('m')))
+            if self.metrics is not None:
+                self.metrics.counter('socket_errors_total', 'Websocket errors', socket='depth').inc()
+
+
+class _Shard(object):
+
+    def __init__(self):
+        # What the connection carries, fixed once it is open, and which of those are still subscribed
+        self.streams = set()
+        self.subscribed = set()
+        self.conn_key = None
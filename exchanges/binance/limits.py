@@ -1 +1,226 @@
+import heapq
+import itertools
+import threading
+import time
 
+from aj_sns.log_service import logger
+
+# Priorities, most urgent first. Orders and cancels go before everything else, and market data recoveries last
+ORDERS = 0
+ACCOUNT = 1
+MARKET_DATA = 2
+PRIORITY_NAMES = {ORDERS: 'orders', ACCOUNT: 'account', MARKET_DATA: 'market_data'}
+
+# Share of the weight limit each priority may use up, so recoveries during a reconnect storm leave room for orders
+CEILINGS = {ORDERS: 1.0, ACCOUNT: 0.9, MARKET_DATA: 0.75}
+
+# endpoint -> (request weight, priority), per Binance's REST API documentation
+ENDPOINTS = {'create_order': (1, ORDERS),
+             'cancel_order': (1, ORDERS),
+             'account': (20, ACCOUNT),
+             'server_time': (1, ACCOUNT),
+             'depth': (5, MARKET_DATA),
+             'exchange_info': (20, MARKET_DATA)}
+
+# Depth costs more the more levels are asked for: (most levels, weight)
+DEPTH_WEIGHTS = ((100, 5), (500, 25), (1000, 50), (5000, 250))
+
+INTERVAL_SECONDS = {'SECOND': 1, 'MINUTE': 60, 'HOUR': 3600, 'DAY': 86400}
+USED_WEIGHT_HEADERS = ('X-MBX-USED-WEIGHT-1M', 'X-MBX-USED-WEIGHT')
+
+
+def depth_weight(limit):
+    for most_levels, weight in DEPTH_WEIGHTS:
+        if limit <= most_levels:
+            return weight
+    return DEPTH_WEIGHTS[-1][1]
+
+
+class WeightGovernor(object):
+    """Keeps a BinanceService's REST calls inside Binance's request weight limit, which bans the IP when exceeded.
+
+    Every call takes its weight from the current minute's budget before it is made, and waits, in priority order,
+    while there is not enough left, rather than being sent and failing. Each priority may only use the budget up to
+    its ceiling (see CEILINGS), so snapshot recoveries and balance polls can never spend what an order or cancel
+    needs. The limit comes from exchangeInfo's rateLimits (set_rate_limits), and the weight used so far from the
+    X-MBX-USED-WEIGHT headers of Binance's responses, which also count other processes sharing our IP. After a 429
+    or 418 every call waits out the Retry-After Binance gave.
+
+        with self.governor.request('create_order'):
+            self.client.create_order(...)
+    """
+
+    LIMIT = 1200
+    INTERVAL_S = 60
+
+    def __init__(self, client, limit=LIMIT, interval_s=INTERVAL_S, metrics=None, clock=time.time):
+        """
+        :param client: the binance Client the calls are made with. Its last response is read for the used weight
+        :param metrics: a common.metrics.MetricsRegistry to export the budget and the time spent waiting to
+        :param clock: wall clock seconds, which Binance's intervals are aligned on
+        """
+        self.client = client
+        self.clock = clock
+        self.limit = limit
+        self.interval_s = interval_s
+        self.condition = threading.Condition()
+        self.window_start_s = 0
+        self.used = 0
+        # Heap of (priority, sequence) tickets of the calls waiting their turn
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.paused_until_s = 0
+        self.throttled_count = {priority: 0 for priority in PRIORITY_NAMES}
+        self.throttled_s = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self.rate_limited_count = 0
+        if metrics is not None:
+            metrics.add_collector(self.collect)
+
+    def set_rate_limits(self, rate_limits):
+        """
+        :param rate_limits: exchangeInfo's rateLimits. The per minute (or else shortest) REQUEST_WEIGHT one is used
+        """
+        weight_limits = [(INTERVAL_SECONDS[rate_limit['interval']] * rate_limit.get('intervalNum', 1),
+                          rate_limit['limit'])
+                         for rate_limit in rate_limits
+                         if rate_limit.get('rateLimitType') == 'REQUEST_WEIGHT'
+                         and rate_limit.get('interval') in INTERVAL_SECONDS]
+        if len(weight_limits) == 0:
+            return
+        minute = [weight_limit for weight_limit in weight_limits if weight_limit[0] == 60]
+        interval_s, limit = minute[0] if len(minute) > 0 else min(weight_limits)
+        with self.condition:
+            if (interval_s, limit) != (self.interval_s, self.limit):
+                logger().info('Binance request weight limit is {} per {}s'.format(limit, interval_s))
+            self.interval_s = interval_s
+            self.limit = limit
+            self.condition.notify_all()
+
+    def request(self, endpoint, weight=None):
+        """
+        :param endpoint: one of ENDPOINTS
+        :param weight: overrides the endpoint's weight, e.g. depth_weight(limit) for a deeper book
+        :return: a context manager to make the call in. Entering it waits for the budget
+        """
+        default_weight, priority = ENDPOINTS[endpoint]
+        return _GovernedRequest(self, weight if weight is not None else default_weight, priority)
+
+    def acquire(self, weight, priority):
+        """
+        :return: seconds waited for the budget
+        """
+        started_s = self.clock()
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    now_s = self.clock()
+                    self.__roll(now_s)
+                    if self.waiting[0] == ticket and now_s >= self.paused_until_s and self.__fits(weight, priority):
+                        break
+                    if self.waiting[0] != ticket:
+                        # Woken when the call ahead goes
+                        self.condition.wait()
+                    elif now_s < self.paused_until_s:
+                        self.condition.wait(self.paused_until_s - now_s)
+                    else:
+                        self.condition.wait(self.window_start_s + self.interval_s - now_s)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+            self.used += weight
+            waited_s = self.clock() - started_s
+            if waited_s > 0.001:
+                self.throttled_count[priority] += 1
+                self.throttled_s[priority] += waited_s
+            return waited_s
+
+    def observe(self, response):
+        """Takes the weight used so far this minute from a response's headers, when Binance gives it"""
+        headers = getattr(response, 'headers', None)
+        if headers is None:
+            return
+        for header in USED_WEIGHT_HEADERS:
+            used = headers.get(header)
+            if used is not None:
+                with self.condition:
+                    self.__roll(self.clock())
+                    # Never below our own count: responses to calls made after this one may not be in it yet
+                    self.used = max(self.used, int(used))
+                return
+
+    def on_error(self, error):
+        """Pauses every call after Binance answered 429 (slow down) or 418 (banned), for as long as it asked"""
+        status_code = getattr(error, 'status_code', None)
+        if status_code not in (418, 429):
+            return
+        response = getattr(error, 'response', None)
+        retry_after = getattr(response, 'headers', {}).get('Retry-After')
+        with self.condition:
+            now_s = self.clock()
+            self.__roll(now_s)
+            pause_s = float(retry_after) if retry_after is not None else \
+                self.window_start_s + self.interval_s - now_s
+            self.paused_until_s = max(self.paused_until_s, now_s + pause_s)
+            self.rate_limited_count += 1
+        logger().warning('Binance answered {}, pausing REST calls for {:.1f}s'.format(status_code, pause_s))
+
+    def get_stats(self):
+        with self.condition:
+            self.__roll(self.clock())
+            return {'limit': self.limit,
+                    'used': self.used,
+                    'waiting': len(self.waiting),
+                    'rate_limited': self.rate_limited_count,
+                    'throttled': {PRIORITY_NAMES[priority]: count for priority, count in self.throttled_count.items()},
+                    'throttled_s': {PRIORITY_NAMES[priority]: waited_s
+                                    for priority, waited_s in self.throttled_s.items()}}
+
+    def collect(self):
+        """For metrics.MetricsRegistry.add_collector"""
+        stats = self.get_stats()
+        yield 'request_weight_limit', 'gauge', 'Binance request weight allowed per interval', {}, stats['limit']
+        yield 'request_weight_used', 'gauge', 'Binance request weight used this interval', {}, stats['used']
+        yield 'request_weight_waiting', 'gauge', 'REST calls waiting for request weight', {}, stats['waiting']
+        yield 'rate_limited_total', 'counter', 'Responses telling us to slow down (429) or banning us (418)', {}, \
+            stats['rate_limited']
+        for priority, count in stats['throttled'].items():
+            labels = {'priority': priority}
+            yield 'request_weight_throttled_total', 'counter', 'REST calls that waited for request weight', \
+                labels, count
+            yield 'request_weight_throttled_seconds_total', 'counter', 'Time REST calls spent waiting for request ' \
+                'weight', labels, stats['throttled_s'][priority]
+
+    def __fits(self, weight, priority):
+        # A call heavier than its whole ceiling still goes, alone, at the start of an interval
+        return self.used == 0 or self.used + weight <= self.limit * CEILINGS[priority]
+
+    def __roll(self, now_s):
+        # Binance's windows start on the interval, e.g. on the minute
+        window_start_s = now_s - now_s % self.interval_s
+        if window_start_s != self.window_start_s:
+            self.window_start_s = window_start_s
+            self.used = 0
+
+
+class _GovernedRequest(object):
+
+    def __init__(self, governor, weight, priority):
+        self.governor = governor
+        self.weight = weight
+        self.priority = priority
+
+    def __enter__(self):
+        self.governor.acquire(self.weight, self.priority)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # The client keeps its last response. Another thread's may have replaced it, but any recent one tells the
+        # weight used
+        self.governor.observe(getattr(self.governor.client, 'response', None))
+        if exc_value is not None:
+            self.governor.on_error(exc_value)
+        return False
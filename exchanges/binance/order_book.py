@@ -1,130 +1,364 @@
-import sched
+import threading
 import time
-from decimal import Decimal
+from collections import deque
 
-from binance.websockets import BinanceSocketManager
 from datetime import datetime
 
+from aj_sns.log_service import logger
+
+from exchanges.binance.depth_socket import DepthSocketManager
+from exchanges.binance.snapshot_recovery import SnapshotRecoveryWorker
+from exchanges.common.book_snapshot import BookSnapshot
+from exchanges.common.events import BookEvent
+from exchanges.common.fixed_point import FixedPointCodec, PrecisionError
+from exchanges.common.metrics import ReceiveTime
+from exchanges.common.price_levels import PriceLevels
+from exchanges.common.scheduler import get_scheduler
+
+# What each order_book callback carries:
+#   full   - every level of both sides
+#   top_n  - the best `depth` levels of each side
+#   best   - the best bid and best ask only
+#   delta  - only the levels changed by the last diff (quantity '0' means removed). A full book is published with
+#            order_book_type='snapshot' whenever the book is (re)built from a REST snapshot, so deltas can be applied
+PUBLISH_MODES = ('full', 'top_n', 'best', 'delta')
+
+# Binance sends prices and quantities with 8 decimals. Used when a symbol's tick or step size is unknown
+DEFAULT_INCREMENT = '0.00000001'
+
+# Longest a conflation window given only a diff count stays open, so a quiet market never leaves subscribers on a
+# stale book waiting for diffs that do not come
+MAX_CONFLATION_MS = 100
+
 
-    
 class OrderBookService(object):
 
-    def __init__(self, client, base, quote, callback, name):
+    # Diffs buffered while a snapshot is fetched. When it overflows the oldest diffs are dropped, which the snapshot
+    # continuity check then reports as a too old snapshot
+    BUFFER_SIZE = 2000
+
+    def __init__(self, client, base, quote, callback, name, publish_mode='full', depth=10, depth_socket=None,
+                 recovery=None, buffer_size=BUFFER_SIZE, tick_size=DEFAULT_INCREMENT, step_size=DEFAULT_INCREMENT,
+                 capture=None, conflation_ms=None, conflation_count=None, latencies=None, metrics=None,
+                 scheduler=None):
+        if publish_mode not in PUBLISH_MODES:
+            raise ValueError('Unknown publish mode: {}. Expected one of {}'.format(publish_mode, PUBLISH_MODES))
         self.binance_client = client
-        self.buffer = []
+        self.lock = threading.Lock()
+        self.buffer = deque(maxlen=buffer_size)
         self.recovered = False
-        self.master_order_book = {'bids': dict(), 'asks': dict()}
+        self.recovering = False
+        # Levels are held as integer counts of the symbol's tick (price) and step (quantity) sizes. They are only
+        # turned back into strings when a book is handed out
+        self.prices = FixedPointCodec(tick_size)
+        self.quantities = FixedPointCodec(step_size)
+        self.master_order_book = {'bids': PriceLevels(descending=True), 'asks': PriceLevels()}
+        self.last_changes = None
         self.last_update_id_processed = 0
         self.base = base
         self.quote = quote
         self.cross = base + quote
-        self.schedule = sched.scheduler(time.time, time.sleep)
-        self.conn_key = None        
+        # Shared with the other crosses of the owning BinanceService. Only a standalone service owns its own
+        self.depth_socket = depth_socket if depth_socket is not None else DepthSocketManager(client)
+        self.recovery = recovery if recovery is not None else SnapshotRecoveryWorker(client)
+        # Optional DepthCapture recording every diff and snapshot as received, for offline replay
+        self.capture = capture
         self.last_update_time = None
+        # Arrival and exchange event time of the last diff applied, carried by the event that publishes it
+        self.last_receive_time = None
+        self.last_server_ms = None
+        self.latencies = latencies
+        # Kept rather than looked up in the metrics.MetricsRegistry, as they are counted on every diff
+        self.update_counter = None
+        self.gap_counter = None
+        self.recovery_counter = None
+        if metrics is not None:
+            self.update_counter = metrics.counter('book_updates_total', 'Depth diffs received', symbol=self.cross)
+            self.gap_counter = metrics.counter('book_gaps_total', 'Gaps found in depth diffs', symbol=self.cross)
+            self.recovery_counter = metrics.counter('book_recoveries_total', 'Books rebuilt from a snapshot',
+                                                    symbol=self.cross)
         self.callback = callback
         self.name = name
-        
+        self.publish_mode = publish_mode
+        self.depth = depth
+        # Diffs are always applied as they arrive. With conflation, the book is published every conflation_count
+        # diffs and at the end of every window of conflation_ms (MAX_CONFLATION_MS if only a count is given), carrying
+        # merged_updates: the diffs folded into it. Windows are closed by one task on the shared scheduler
+        self.conflation_ms = conflation_ms
+        self.conflation_count = conflation_count
+        self.scheduler = scheduler if scheduler is not None else get_scheduler()
+        self.conflation_task = None
+        self.pending_updates = 0
+        self.pending_first_update_id = None
+        self.pending_changes = None
+        self.published_count = 0
+        self.merged_count = 0
+        self.snapshot = None
+        self.__publish_snapshot(True, True)
+
     def start(self):
-        self.bm = BinanceSocketManager(self.binance_client)
-        self.conn_key = self.bm.start_depth_socket(self.cross, self.__process_depth_message)
-        self.bm.start()
-        time.sleep(2)
-        
+        if (self.conflation_ms is not None or self.conflation_count is not None) and self.conflation_task is None:
+            window_ms = self.conflation_ms if self.conflation_ms is not None else MAX_CONFLATION_MS
+            self.conflation_task = self.scheduler.schedule('binance {} conflation'.format(self.cross),
+                                                           self.__flush_conflated, window_ms / 1000.0)
+        self.depth_socket.subscribe(self.cross, self.__process_depth_message)
+
     def stop(self):
-        #TODO figure out how to split code so that you can call start, stop, start etc.
-        self.bm.stop_socket(self.conn_key)
-        self.bm.close()
-        
-    def __notify(self):
-        b = self.get_order_book()
-        self.callback('order_book', data=b)
+        # Only this cross's stream is dropped; the connection and the other crosses on it stay up
+        self.depth_socket.unsubscribe(self.cross)
+        if self.conflation_task is not None:
+            self.conflation_task.cancel()
+            self.conflation_task = None
+        with self.lock:
+            self.recovered = False
+            self.recovering = False
+            self.buffer.clear()
+            self.__reset_conflation()
+        if self.capture is not None:
+            self.capture.close()
+
+    def get_conflation_stats(self):
+        return {'published': self.published_count,
+                'merged': self.merged_count,
+                'pending': self.pending_updates}
+
+    def __notify(self, update=None, merged_updates=None):
+        if self.publish_mode == 'delta':
+            if update is None:
+                order_book_type, data = 'snapshot', self.snapshot.to_event()
+            else:
+                order_book_type, data = 'delta', self.__as_delta(update['U'], update['u'], self.last_changes)
+        elif self.publish_mode == 'top_n':
+            order_book_type, data = 'top_n', self.snapshot.to_event(self.depth)
+        elif self.publish_mode == 'best':
+            order_book_type, data = 'best', self.snapshot.to_event(1)
+        else:
+            order_book_type, data = 'full', self.snapshot.to_event()
+
+        data.receive_time = self.last_receive_time
+        data.server_ms = self.last_server_ms
+        if merged_updates is not None:
+            data['merged_updates'] = merged_updates
+        self.published_count += 1
+        self.callback('order_book', order_book_type=order_book_type, data=data)
+
+    def __on_update_applied(self, update):
+        if self.conflation_ms is None and self.conflation_count is None:
+            self.__notify(update)
+            return
+
+        if self.pending_updates == 0:
+            self.pending_first_update_id = update['U']
+            if self.publish_mode == 'delta':
+                self.pending_changes = {'bids': {}, 'asks': {}}
+        self.pending_updates += 1
+        if self.pending_changes is not None:
+            # Later diffs of a level overwrite earlier ones, so a delta carries each changed level once
+            for side in ('bids', 'asks'):
+                self.pending_changes[side].update(self.last_changes[side])
+
+        if self.conflation_count is not None and self.pending_updates >= self.conflation_count:
+            self.__publish_conflated(update['u'])
+
+    def __flush_conflated(self):
+        # End of the window: a burst's last diffs are published even when nothing follows them
+        with self.lock:
+            if self.pending_updates > 0:
+                self.__publish_conflated(self.last_update_id_processed)
+
+    def __publish_conflated(self, last_update_id):
+        merged_updates = self.pending_updates
+        if self.publish_mode == 'delta':
+            self.last_changes = {side: list(self.pending_changes[side].items()) for side in ('bids', 'asks')}
+            update = {'U': self.pending_first_update_id, 'u': last_update_id}
+        else:
+            update = None
+        self.__reset_conflation()
+        self.merged_count += merged_updates - 1
+        if update is None:
+            # Any mode but delta publishes the whole state, which __notify() without an update does
+            self.__notify(merged_updates=merged_updates)
+        else:
+            self.__notify(update, merged_updates=merged_updates)
 
-    def get_order_book(self):
-        sorted_book = self.__sort_order_book(self.master_order_book)
-        sorted_book['base'] = self.base
-        sorted_book['quote'] = self.quote
-        sorted_book['exchange'] = self.name
+    def __reset_conflation(self):
+        self.pending_updates = 0
+        self.pending_first_update_id = None
+        self.pending_changes = None
 
-        return sorted_book
+    def get_order_book(self, depth=None):
+        # Safe from any thread: reads the latest published snapshot, never the book the socket thread is changing
+        return self.snapshot.to_dict(depth)
 
-    @staticmethod
-    def __sort_order_book(unsorted_order_book):
-        sorted_book = {'bids': [], 'asks': []}
+    def get_snapshot(self):
+        return self.snapshot
 
-        for k in sorted(unsorted_order_book['bids'], reverse=True):
-            sorted_book['bids'].append([k, unsorted_order_book['bids'][k]])
+    def has_changed_since(self, version):
+        return self.snapshot.version != version
 
-        for k in sorted(unsorted_order_book['asks']):
-            sorted_book['asks'].append([k, unsorted_order_book['asks'][k]])
+    def __publish_snapshot(self, bids_changed, asks_changed):
+        # Freezing a side copies chunk references, not levels, and an unchanged side is shared with the last snapshot,
+        # unless the book has since moved to finer increments
+        previous = self.snapshot
+        if previous is not None and (previous.prices is not self.prices or previous.quantities is not self.quantities):
+            previous = None
+        bids = self.master_order_book['bids'].freeze() if bids_changed or previous is None else previous.bids
+        asks = self.master_order_book['asks'].freeze() if asks_changed or previous is None else previous.asks
+        self.snapshot = BookSnapshot(self.last_update_id_processed, int(round(time.time() * 1000)), bids, asks,
+                                     self.base, self.quote, self.name, self.prices, self.quantities)
 
-        return sorted_book
+    def __as_delta(self, first_update_id, last_update_id, changes):
+        return BookEvent(bids=self.snapshot.format_levels(changes['bids']),
+                         asks=self.snapshot.format_levels(changes['asks']),
+                         base=self.base,
+                         quote=self.quote,
+                         exchange=self.name,
+                         first_update_id=first_update_id,
+                         last_update_id=last_update_id)
 
     def __apply_snapshot(self, snapshot):
-        self.master_order_book = {'bids': dict(), 'asks': dict()}
-        for bid in snapshot['bids']:
-            self.master_order_book['bids'][bid[0]] = bid[1]
-        for ask in snapshot['asks']:
-            self.master_order_book['asks'][ask[0]] = ask[1]
+        self.master_order_book = {'bids': PriceLevels(descending=True), 'asks': PriceLevels()}
+        self.__apply_levels(self.master_order_book['bids'], snapshot['bids'], None)
+        self.__apply_levels(self.master_order_book['asks'], snapshot['asks'], None)
 
         self.last_update_id_processed = snapshot['lastUpdateId']
+        self.__publish_snapshot(True, True)
 
     def __process_update(self, update):
-        for bid in update['b']:
-            if Decimal(bid[1]) == 0:
-                self.master_order_book['bids'].pop(bid[0], None)
-            else:
-                self.master_order_book['bids'][bid[0]] = bid[1]
-        for ask in update['a']:
-            if Decimal(ask[1]) == 0:
-                self.master_order_book['asks'].pop(ask[0], None)
-            else:
-                self.master_order_book['asks'][ask[0]] = ask[1]
+        if self.publish_mode == 'delta':
+            self.last_changes = {'bids': [], 'asks': []}
+            self.__apply_levels(self.master_order_book['bids'], update['b'], self.last_changes['bids'])
+            self.__apply_levels(self.master_order_book['asks'], update['a'], self.last_changes['asks'])
+        else:
+            self.__apply_levels(self.master_order_book['bids'], update['b'], None)
+            self.__apply_levels(self.master_order_book['asks'], update['a'], None)
         self.last_update_id_processed = update['u']
         self.last_update_time = datetime.utcnow()
-        self.__notify()
-        
-        
-    def __process_snapshot(self, last_update_id, snapshot):
-        if snapshot['lastUpdateId'] < last_update_id:
-            print('Snapshot received is too old (last update id before recover triggered is more recent). '
-                  'Retrying in 5 seconds.')
-            self.schedule.enter(5000, 1, self.__recover_from_snapshot(last_update_id))
-        else:
+        self.__publish_snapshot(len(update['b']) > 0, len(update['a']) > 0)
+
+    def __apply_levels(self, price_levels, levels, changes):
+        to_price = self.prices.to_int
+        to_quantity = self.quantities.to_int
+        for i, level in enumerate(levels):
+            try:
+                price = to_price(level[0])
+                quantity = to_quantity(level[1])
+            except PrecisionError:
+                self.__widen(level)
+                self.__apply_levels(price_levels, levels[i:], changes)
+                return
+            if quantity == 0:
+                price_levels.remove(price)
+            else:
+                price_levels.set(price, quantity)
+            if changes is not None:
+                changes.append((price, quantity))
+
+    def __widen(self, level):
+        # Rounding would misplace the level, or delete it for a quantity below one step. The whole book moves to
+        # increments fine enough to hold it instead, for as long as the service runs
+        prices, price_factor = self.prices.finer(level[0])
+        quantities, quantity_factor = self.quantities.finer(level[1])
+        logger().warning('{} level {} @ {} is finer than the tick size {} or step size {}. Holding the book in '
+                         'increments of {} and {} instead'.format(self.cross, level[1], level[0], self.prices.increment,
+                                                                  self.quantities.increment, prices.increment,
+                                                                  quantities.increment))
+        for price_levels in self.master_order_book.values():
+            price_levels.rescale(price_factor, quantity_factor)
+        if self.last_changes is not None:
+            for changes in self.last_changes.values():
+                changes[:] = [(price * price_factor, quantity * quantity_factor) for price, quantity in changes]
+        if self.pending_changes is not None:
+            self.pending_changes = {side: {price * price_factor: quantity * quantity_factor
+                                           for price, quantity in changes.items()}
+                                    for side, changes in self.pending_changes.items()}
+        self.prices = prices
+        self.quantities = quantities
+
+    def on_snapshot(self, snapshot):
+        """Called by the recovery worker with a REST snapshot. Returns False when the snapshot cannot be used yet and
+        another one is needed, either because it predates the buffered diffs or the buffered diffs have a gap."""
+        receive_time = ReceiveTime()
+        with self.lock:
+            if self.capture is not None:
+                self.capture.record_snapshot(snapshot, receive_time.wall_ms)
+            if not self.recovering:
+                # Stopped, or already recovered, while the snapshot was in flight
+                return True
+
+            last_update_id = snapshot['lastUpdateId']
+            buffered = [update for update in self.buffer if update['u'] > last_update_id]
+
+            if len(buffered) > 0 and buffered[0]['U'] > last_update_id + 1:
+                logger().warning('Snapshot for {} is too old (last update id {}, first buffered update id {}). '
+                                 'Retrying'.format(self.cross, last_update_id, buffered[0]['U']))
+                return False
+
+            for previous, update in zip(buffered, buffered[1:]):
+                if update['U'] != previous['u'] + 1:
+                    # Everything before the gap is useless to any later snapshot, so only keep what follows it
+                    logger().warning('Gap in buffered updates for {} between update ids {} and {}. Retrying'
+                                     .format(self.cross, previous['u'], update['U']))
+                    while self.buffer[0] is not update:
+                        self.buffer.popleft()
+                    return False
+
             self.__apply_snapshot(snapshot)
-            # Process the buffered deltas
-            for update in self.buffer:
-                if update['U'] <= self.last_update_id_processed + 1 <= update['u']:
-                    self.__process_update(update)
-            self.recovered = True
+            self.last_receive_time = receive_time
+            self.last_server_ms = None
+            # Apply the buffered deltas. They are folded into the snapshot published below, not notified one by one
+            for update in buffered:
+                self.__process_update(update)
             self.buffer.clear()
-            print('Recovery from snapshot complete. Continuing to parse updates via WebSocket')
+            # The snapshot published below supersedes whatever was waiting for the conflation window
+            self.__reset_conflation()
+            self.recovered = True
+            self.recovering = False
+            if self.recovery_counter is not None:
+                self.recovery_counter.inc()
+            logger().info('Recovery from snapshot complete for {}. Continuing to parse updates via WebSocket'
+                          .format(self.cross))
             self.__notify()
-            
-    def __recover_from_snapshot(self, last_update_id):
-        print('Recover from snapshot triggered')
-        snapshot = self.binance_client.get_order_book(symbol=self.cross)
-        self.__process_snapshot(last_update_id, snapshot)
-
-    def __process_depth_message(self, msg):
-        if not self.recovered:
-            # If first depth message received, trigger snapshot recovery
-            if len(self.buffer) == 0:
+            return True
+
+    def __recover_from_snapshot(self):
+        # The snapshot is fetched off the websocket thread; diffs keep buffering until it arrives
+        if not self.recovering:
+            self.recovering = True
+            self.recovery.request(self)
+
+    def __process_depth_message(self, msg, receive_time=None):
+        if receive_time is None:
+            receive_time = ReceiveTime()
+        if self.latencies is not None:
+            self.latencies.record_receive('order_book', msg.get('E'), receive_time)
+        if self.update_counter is not None:
+            self.update_counter.inc()
+        with self.lock:
+            if self.capture is not None:
+                self.capture.record_diff(msg, receive_time.wall_ms)
+            if not self.recovered:
                 self.buffer.append(msg)
-                self.__recover_from_snapshot(msg['u'])
-            else:
-                # Warning - There is potential to get a gap here. Edge case, so avoiding for now
+                self.__recover_from_snapshot()
+            elif msg['u'] <= self.last_update_id_processed:
+                # Already covered by the snapshot
+                pass
+            elif msg['U'] > self.last_update_id_processed + 1:
+                logger().warning('Encountered gap in updates for {}. Last update id recorded: {}. '
+                                 'First update id in this new message: {}. '
+                                 'Last update id in this new message: {}'
+                                 .format(self.cross, self.last_update_id_processed, msg['U'], msg['u']))
+                if self.gap_counter is not None:
+                    self.gap_counter.inc()
+                self.recovered = False
+                self.buffer.clear()
                 self.buffer.append(msg)
-        else:
-            if msg['u'] >= self.last_update_id_processed + 1:
+                self.__reset_conflation()
+                self.__recover_from_snapshot()
+            else:
                 self.__process_update(msg)
-                if msg['U'] > (self.last_update_id_processed + 1):
-                    print('Encountered gap in updates. Last update id recorded: {}. '
-                          'First update id in this new message: {}. '
-                          'Last update id in this new message: {}'.format(self.last_update_id_processed, msg['U'],
-                                                                          msg['u']))
-                    self.recovered = False
-                    self.buffer.append(msg)
-                    self.__recover_from_snapshot(msg['u'])
-
+                self.last_receive_time = receive_time
+                self.last_server_ms = msg.get('E')
+                self.__on_update_applied(msg)
 
 example_sorted_book = {'bids': [[100.4, 100], [100.3, 50], [100.2, 200]], 'asks': [[101.2, 30], [101.3, 100], [101.4, 50]]}
\ No newline at end of file
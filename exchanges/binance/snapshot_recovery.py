@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import threading
+import time
+
+from aj_sns.log_service import logger
+
+
+class SnapshotRecoveryWorker(object):
+    """Fetches REST depth snapshots for order books that lost sync, on its own thread.
+
+    Order books call request() from the websocket thread and go on buffering diffs; the worker fetches the
+    snapshot and hands it back through OrderBookService.on_snapshot. Requests are spaced at least min_interval_s
+    apart across all symbols, and a symbol whose snapshot cannot be used is retried with exponential backoff, so
+    one misbehaving symbol neither blocks the socket thread nor starves recovery of the others.
+    """
+
+    MIN_INTERVAL_S = 0.25
+    INITIAL_BACKOFF_S = 1
+    MAX_BACKOFF_S = 60
+
+    def __init__(self, client, min_interval_s=MIN_INTERVAL_S, initial_backoff_s=INITIAL_BACKOFF_S,
+                 max_backoff_s=MAX_BACKOFF_S, metrics=None, governor=None):
+        self.client = client
+        # Optional metrics.MetricsRegistry to count snapshot requests and retries into
+        self.metrics = metrics
+        # Optional limits.WeightGovernor, which holds snapshots back while orders need the request weight
+        self.governor = governor
+        self.min_interval_s = min_interval_s
+        self.initial_backoff_s = initial_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.condition = threading.Condition()
+        self.queue = []
+        self.sequence = itertools.count()
+        self.pending = {}
+        self.failed_attempts = {}
+        self.last_request_time = 0
+        self.thread = None
+
+    def request(self, order_book_service, delay_s=0):
+        with self.condition:
+            if order_book_service.cross in self.pending:
+                return
+            self.pending[order_book_service.cross] = True
+            heapq.heappush(self.queue, (time.monotonic() + delay_s, next(self.sequence), order_book_service))
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name='binance-snapshot-recovery')
+                self.thread.daemon = True
+                self.thread.start()
+
+            self.condition.notify()
+
+    def __retry(self, order_book_service):
+        with self.condition:
+            attempts = self.failed_attempts.get(order_book_service.cross, 0)
+            self.failed_attempts[order_book_service.cross] = attempts + 1
+        delay_s = min(self.initial_backoff_s * 2 ** attempts, self.max_backoff_s)
+        if self.metrics is not None:
+            self.metrics.counter('book_recovery_retries_total', 'Snapshot recoveries retried',
+                                 symbol=order_book_service.cross).inc()
+        logger().warning('Retrying snapshot recovery of {} in {} seconds'.format(order_book_service.cross, delay_s))
+        self.request(order_book_service, delay_s)
+
+    def __next_request(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if len(self.queue) == 0:
+                    self.condition.wait()
+                elif self.queue[0][0] > now:
+                    self.condition.wait(self.queue[0][0] - now)
+                else:
+                    break
+
+            _, _, order_book_service = heapq.heappop(self.queue)
+            self.pending.pop(order_book_service.cross, None)
+            wait_s = self.last_request_time + self.min_interval_s - now
+            self.last_request_time = max(now, self.last_request_time + self.min_interval_s)
+
+        if wait_s > 0:
+            time.sleep(wait_s)
+
+        return order_book_service
+
+    def __get_snapshot(self, symbol):
+        if self.governor is not None:
+            with self.governor.request('depth'):
+                return self.__get_order_book(symbol)
+        return self.__get_order_book(symbol)
+
+    def __get_order_book(self, symbol):
+        if self.metrics is None:
+            return self.client.get_order_book(symbol=symbol)
+        with self.metrics.rest_call('depth'):
+            return self.client.get_order_book(symbol=symbol)
+
+    def __run(self):
+        while True:
+            order_book_service = self.__next_request()
+            try:
+                snapshot = self.__get_snapshot(order_book_service.cross)
+            except Exception as e:
+                logger().error('Failed to get snapshot for {}. Exception was: {}'.format(order_book_service.cross, e))
+                self.__retry(order_book_service)
+                continue
+
+            try:
+                recovered = order_book_service.on_snapshot(snapshot)
+            except Exception as e:
+                logger().error('Failed to apply snapshot for {}. Exception was: {}'
+                               .format(order_book_service.cross, e))
+                recovered = False
+
+            if recovered:
+                with self.condition:
+                    self.failed_attempts.pop(order_book_service.cross, None)
+            else:
+                self.__retry(order_book_service)
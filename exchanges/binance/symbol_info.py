@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal, ROUND_CEILING, ROUND_DOWN, ROUND_FLOOR
+
+from aj_sns.log_service import logger
+
+from exchanges.common.metadata_cache import MetadataCache
+
+SymbolInfo = namedtuple('SymbolInfo', ['symbol', 'base', 'quote', 'tick_size', 'step_size', 'min_notional'])
+
+# Used to split symbols that are missing from exchangeInfo (e.g. delisted), longest first so USDT wins over USD
+KNOWN_QUOTES = ('USDT', 'TUSD', 'USDC', 'PAX', 'BTC', 'ETH', 'BNB', 'XRP', 'USD')
+
+
+class SymbolInfoService(object):
+    """Symbol metadata from Binance's exchangeInfo, fetched once and shared by everything in a BinanceService.
+
+    exchangeInfo is a multi-megabyte payload, so it is loaded on first use from the local metadata cache when that
+    is younger than ttl_s and from REST otherwise, then refreshed in the background every ttl_s. Lookups are dict
+    reads: symbol -> SymbolInfo(base, quote, tick_size, step_size, min_notional).
+
+    When the REST call fails, the cached copy is used however old it is, and the next refresh is tried after
+    retry_s, doubling on every failure up to ttl_s. Until then lookups never call REST themselves, so during an
+    outage a thread such as the user data socket's is not blocked on every message.
+    """
+
+    CACHE_KEY = 'binance_exchange_info'
+    TTL_S = 3600
+    RETRY_S = 5
+
+    def __init__(self, client, cache=None, ttl_s=TTL_S, retry_s=RETRY_S, governor=None):
+        self.client = client
+        # Optional limits.WeightGovernor, told the request weight limit from exchangeInfo's rateLimits
+        self.governor = governor
+        self.cache = cache if cache is not None else MetadataCache()
+        self.ttl_s = ttl_s
+        self.retry_s = retry_s
+        self.lock = threading.Lock()
+        self.exchange_info = None
+        self.symbols = {}
+        self.refresh_timer = None
+        self.failed_count = 0
+
+    def load(self):
+        with self.lock:
+            if self.exchange_info is None:
+                entry = self.cache.load_entry(self.CACHE_KEY, self.ttl_s)
+                if entry is not None:
+                    # Expires ttl_s after it was fetched, not after it was loaded
+                    exchange_info, saved_at = entry
+                    self.__index(exchange_info)
+                    self.__schedule_refresh(max(saved_at + self.ttl_s - time.time(), 0))
+                else:
+                    try:
+                        exchange_info = self.__fetch()
+                    except Exception:
+                        self.__schedule_retry()
+                        exchange_info = self.cache.load(self.CACHE_KEY, float('inf'))
+                        if exchange_info is None:
+                            raise
+                        logger().warning('Failed to fetch Binance exchange info. Using the cached copy until the '
+                                         'next refresh')
+                        self.__index(exchange_info)
+                        return self.exchange_info
+                    self.__index(exchange_info)
+                    self.__schedule_refresh(self.ttl_s)
+
+        return self.exchange_info
+
+    def refresh(self):
+        try:
+            exchange_info = self.__fetch()
+        except Exception as e:
+            logger().error('Failed to refresh Binance exchange info. Keeping the current one. Exception was: {}'
+                           .format(e))
+            with self.lock:
+                self.__schedule_retry()
+            return
+
+        with self.lock:
+            self.__index(exchange_info)
+            self.failed_count = 0
+            self.__schedule_refresh(self.ttl_s)
+
+    def stop(self):
+        with self.lock:
+            if self.refresh_timer is not None:
+                self.refresh_timer.cancel()
+                self.refresh_timer = None
+
+    def get(self, symbol):
+        if self.exchange_info is None:
+            if self.refresh_timer is not None:
+                # Loading failed and the next try is scheduled
+                return None
+            try:
+                self.load()
+            except Exception as e:
+                logger().error('Failed to load Binance exchange info. Exception was: {}'.format(e))
+                return None
+        return self.symbols.get(symbol)
+
+    def split_symbol(self, symbol):
+        info = self.get(symbol)
+        if info is not None:
+            return info.base, info.quote
+
+        for quote in KNOWN_QUOTES:
+            if symbol.endswith(quote) and len(symbol) > len(quote):
+                return symbol[:-len(quote)], quote
+
+        return symbol[0:3], symbol[3:]
+
+    def format_price(self, symbol, price, side):
+        """The price as a multiple of the symbol's tick size, rounded the way that never worsens it for the side: a
+        buy down and a sell up. Logged when that changes it. An unknown side or symbol sends the price unchanged
+        """
+        info = self.get(symbol)
+        if info is None or info.tick_size is None:
+            return str(price)
+        rounding = {'BUY': ROUND_FLOOR, 'SELL': ROUND_CEILING}.get(str(side).upper())
+        if rounding is None:
+            logger().warning('Not rounding the {} price {} of unknown side {} to its tick size'
+                             .format(symbol, price, side))
+            return str(price)
+        return SymbolInfoService.__to_increment(symbol, 'price', price, info.tick_size, rounding)
+
+    def format_quantity(self, symbol, quantity):
+        """The quantity as a multiple of the symbol's step size, rounded down so no more is ever traded than asked.
+        Logged when that changes it. May come to 0, which create_order refuses to send
+        """
+        info = self.get(symbol)
+        if info is None or info.step_size is None:
+            return str(quantity)
+        return SymbolInfoService.__to_increment(symbol, 'quantity', quantity, info.step_size, ROUND_DOWN)
+
+    @staticmethod
+    def __to_increment(symbol, field, value, increment, rounding):
+        increment = Decimal(increment).normalize()
+        value = Decimal(str(value))
+        rounded = (value / increment).to_integral_value(rounding=rounding) * increment
+        if rounded != value:
+            logger().warning('Rounded the {} {} {} to {}, a multiple of {}'
+                             .format(symbol, field, value, '{:f}'.format(rounded), '{:f}'.format(increment)))
+        return '{:f}'.format(rounded)
+
+    def __fetch(self):
+        if self.governor is not None:
+            with self.governor.request('exchange_info'):
+                exchange_info = self.client.get_exchange_info()
+        else:
+            exchange_info = self.client.get_exchange_info()
+        self.cache.save(self.CACHE_KEY, exchange_info)
+        return exchange_info
+
+    def __index(self, exchange_info):
+        symbols = {}
+        for symbol in exchange_info['symbols']:
+            filters = {symbol_filter['filterType']: symbol_filter for symbol_filter in symbol['filters']}
+            min_notional = filters.get('MIN_NOTIONAL', filters.get('NOTIONAL', {})).get('minNotional')
+            symbols[symbol['symbol']] = SymbolInfo(symbol=symbol['symbol'],
+                                                   base=symbol['baseAsset'],
+                                                   quote=symbol['quoteAsset'],
+                                                   tick_size=filters.get('PRICE_FILTER', {}).get('tickSize'),
+                                                   step_size=filters.get('LOT_SIZE', {}).get('stepSize'),
+                                                   min_notional=min_notional)
+        self.symbols = symbols
+        self.exchange_info = exchange_info
+        if self.governor is not None:
+            self.governor.set_rate_limits(exchange_info.get('rateLimits', []))
+
+    def __schedule_retry(self):
+        self.__schedule_refresh(min(self.retry_s * 2 ** self.failed_count, self.ttl_s))
+        self.failed_count += 1
+
+    def __schedule_refresh(self, delay_s):
+        if self.refresh_timer is not None:
+            self.refresh_timer.cancel()
+        self.refresh_timer = threading.Timer(delay_s, self.refresh)
+        self.refresh_timer.daemon = True
+        self.refresh_timer.start()
@@ -5,21 +5,24 @@ import sys
 
 from aj_sns.log_service import logger
 from binance.websockets import BinanceSocketManager
-import time
 
-from exchanges.common.open_order_tracker import OrderTracker
+from exchanges.common.events import ExecutionEvent, LifecycleEvent
+from exchanges.common.metrics import ReceiveTime
+from exchanges.common.order_store import OrderStore
 
 
-class UserDataService(OrderTracker):
+class UserDataService(object):
 
-    def __init__(self, binance_client, callback, name):
-        OrderTracker.__init__(self)
+    def __init__(self, binance_client, callback, name, symbol_info, latencies=None):
+        self.orders = OrderStore()
         self.client = binance_client
+        self.symbol_info = symbol_info
         self.callback = callback
         self.bm = BinanceSocketManager(self.client)
         self.conn_key = None
         self.name = name
-        
+        self.latencies = latencies
+
     def start(self):
         self.conn_key = self.bm.start_user_socket(self.__process_user_data)
         self.bm.start()
@@ -31,30 +34,32 @@ class UserDataService(OrderTracker):
         self.bm.close()
 
     def get_open_orders(self):
-        return self.open_orders.copy()
+        return {order['exchange_order_id']: order for order in self.orders.get_all()}
 
     def __process_user_data(self, event):
+        receive_time = ReceiveTime()
         try:
             if event['e'] == 'executionReport':
                 symbol = event['s']
-                base = symbol[0:3]
-                quote = symbol[3:]  # TODO - Do this properly, so SALT/USDT would work
-                message = {
-                    'action': 'UNKNOWN',
-                    'exchange': self.name,
-                    'symbol': event['s'],
-                    'base': base,
-                    'quote': quote,
-                    'exchange_order_id': event['i'],
-                    'internal_order_id': event['c'],
-                    'side': str.lower(event['S']),
-                    'quantity': event['q'],
-                    'price': event['p'],
-                    'cum_quantity_filled': event['z'],
-                    'order_status': event['X'],
-                    'server_ms': event['T'],
-                    'received_ms': int(round(time.time() * 1000))
-                }
+                base, quote = self.symbol_info.split_symbol(symbol)
+                # A fill carries the execution fields too; everything else is a plain lifecycle event
+                message_type = ExecutionEvent if event['x'] == 'TRADE' else LifecycleEvent
+                message = message_type(
+                    action='UNKNOWN',
+                    exchange=self.name,
+                    symbol=event['s'],
+                    base=base,
+                    quote=quote,
+                    exchange_order_id=event['i'],
+                    internal_order_id=event['c'],
+                    side=str.lower(event['S']),
+                    quantity=event['q'],
+                    price=event['p'],
+                    cum_quantity_filled=event['z'],
+                    order_status=event['X'],
+                    server_ms=event['T'],
+                    receive_time=receive_time
+                )
 
                 if event['x'] == 'TRADE':
                     message['action'] = 'EXECUTION'
@@ -62,7 +67,7 @@ class UserDataService(OrderTracker):
                     message['last_executed_price'] = event['L']
                     message['trade_id'] = event['t']
 
-                    # TODO Check this logic is correct (both symbol split and if fee is an amount or a percent)
+                    # TODO Check this logic is correct (if fee is an amount or a percent)
                     commission_amount = event['n']
                     commission_asset = event['N']
 
@@ -77,18 +82,13 @@ class UserDataService(OrderTracker):
                         message['fee_base'] = fee_base
                         message['fee_quote'] = fee_quote
 
-                    if message['cum_quantity_filled'] == message['quantity']:
-                        self.open_orders.pop(message['exchange_order_id'], None)
-                        self.pending_cancel.pop(message['internal_order_id'], None)
-                        self.internal_to_external_id.pop(message['internal_order_id'], None)
+                    self.orders.fill(message['exchange_order_id'], message['cum_quantity_filled'],
+                                     done=message['cum_quantity_filled'] == message['quantity'])
                 elif event['x'] == 'NEW':
-                    self.open_orders[message['exchange_order_id']] = message
-                    self.internal_to_external_id[message['internal_order_id']] = message['exchange_order_id']
                     message['action'] = 'CREATED'
+                    self.orders.add(message)
                 elif event['x'] == 'CANCELED':
-                    self.open_orders.pop(message['exchange_order_id'], None)
-                    self.pending_cancel.pop(message['internal_order_id'], None)
-                    self.internal_to_external_id.pop(message['internal_order_id'], None)
+                    self.orders.remove(message['exchange_order_id'], message['internal_order_id'])
                     message['action'] = 'CANCELED'
                 elif event['x'] == 'REJECTED':
                     message['action'] = 'REJECTED'
@@ -97,6 +97,8 @@ class UserDataService(OrderTracker):
                 elif event['x'] == 'EXPIRED':
                     message['action'] = 'EXPIRED'
 
+                if self.latencies is not None:
+                    self.latencies.record_receive('trade_lifecycle', event['E'], receive_time)
                 self.callback('trade_lifecycle', trade_lifecycle_type=message['action'], data=message)
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
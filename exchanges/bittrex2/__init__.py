@@ -1,12 +1,15 @@
 from _decimal import Decimal
 
 from bittrex.bittrex import Bittrex, API_V1_1
-from time import sleep, time
+from time import sleep
 
 from aj_sns.creds_retriever import get_creds
 
 from exchanges.bittrex2.executions_socket import ExecutionsSocket
 from exchanges.bittrex2.order_book_socket import OrderBookSocket
+from exchanges.common.events import BookEvent, LifecycleEvent
+from exchanges.common.metrics import ReceiveTime
+from exchanges.common.order_store import OrderStore
 from exchanges.exchange import Exchange
 
 
@@ -19,7 +22,7 @@ class BittrexService(Exchange):
         self.ex_ws = ExecutionsSocket(self)
         self.ex_ws.authenticate(public_key, private_key)
         self.markets_following = {}
-        self.open_orders = []
+        self.orders = OrderStore()
         self.rest_client = Bittrex(public_key, private_key, api_version=API_V1_1)
 
     def get_order_book(self, base, quote):
@@ -28,7 +31,7 @@ class BittrexService(Exchange):
         if resp['success'] is True:
             book = resp['result']
 
-            internal_book = {'bids': [], 'asks': []}
+            internal_book = BookEvent(bids=[], asks=[], receive_time=ReceiveTime())
 
             for bid in book['buy']:
                 internal_book['bids'].append([str(bid['Rate']), str(bid['Quantity'])])
@@ -44,26 +47,7 @@ class BittrexService(Exchange):
             return internal_book
 
     def get_our_orders_by_decimal_price(self):
-        our_orders_by_price = {'bids': {}, 'asks': {}}
-
-        open_orders_copy = self.open_orders.copy()
-
-        for order in open_orders_copy:
-            order['price'] = Decimal(str(order['price']))
-            order['quantity'] = Decimal(str(order['quantity']))
-            order['cum_quantity_filled'] = Decimal(str(order['cum_quantity_filled']))
-            if order['side'] == 'buy':
-                if str(order['price']) not in our_orders_by_price['bids']:
-                    our_orders_by_price['bids'][order['price']] = order['quantity'] - order['cum_quantity_filled']
-                else:
-                    our_orders_by_price['bids'][order['price']] += order['quantity'] - order['cum_quantity_filled']
-            elif order['side'] == 'sell':
-                if str(order['price']) not in our_orders_by_price['bids']:
-                    our_orders_by_price['asks'][order['price']] = order['quantity'] - order['cum_quantity_filled']
-                else:
-                    our_orders_by_price['asks'][order['price']] += order['quantity'] - order['cum_quantity_filled']
-
-        return our_orders_by_price
+        return self.orders.get_quantities_by_price()
 
     def follow_market(self, base, quote):
         self.ob_ws.add_subscription(BittrexService._to_market(base, quote))   # bittrex has it backwards
@@ -118,101 +102,81 @@ class BittrexService(Exchange):
         price = str(price)
 
         if response is None:
-            internal_response = {
-                'action': 'CREATE_FAILED',
-                'reason': 'UNKNOWN',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'received_ms': time() * 1000
-            }
+            internal_response = LifecycleEvent(
+                action='CREATE_FAILED',
+                reason='UNKNOWN',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                receive_time=ReceiveTime()
+            )
 
         elif 'success' in response and response['success'] is False:
             reason = 'UNKNOWN'
             if response['message'] == 'INSUFFICIENT_FUNDS':
                 reason = response['message']
-            internal_response = {
-                'action': 'CREATE_FAILED',
-                'reason': reason,
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'received_ms': time() * 1000
-            }
+            internal_response = LifecycleEvent(
+                action='CREATE_FAILED',
+                reason=reason,
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                receive_time=ReceiveTime()
+            )
         else:
             exchange_id = response['result']['uuid']
-            internal_response = {
-                'action': 'CREATED',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'exchange_order_id': exchange_id,
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'order_status': 'OPEN',
-                'server_ms': time() * 1000,
-                'received_ms': time() * 1000
-            }
-
-            open_order = internal_response.copy()
-            open_order['price'] = Decimal(open_order['price'])
-            open_order['quantity'] = Decimal(open_order['quantity'])
-            self.open_orders.append(internal_response)
+            internal_response = LifecycleEvent(
+                action='CREATED',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                exchange_order_id=exchange_id,
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                order_status='OPEN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            )
+
+            self.orders.add(internal_response)
 
         self.notify_callbacks('trade_lifecycle', data=internal_response)
 
         return internal_response
 
     def cancel_order(self, base, quote, internal_order_id, request_id, requester_id=None, exchange_order_id=None):
-        index_to_pop = None
         if exchange_order_id is None:
-            i = 0
-            for open_order in self.open_orders:
-                if open_order['internal_order_id'] == internal_order_id:
-                    exchange_order_id = open_order['exchange_order_id']
-                    index_to_pop = i
-                    break
-                i += 1
+            exchange_order_id = self.orders.get_exchange_id(internal_order_id)
 
         response = self.rest_client.cancel(exchange_order_id)
 
         if response['success'] is True:
-            i = 0
-
-            if index_to_pop is None:
-                for order in self.open_orders:
-                    if order['exchange_order_id'] == exchange_order_id:
-                        index_to_pop = i
-                        break
-                    i += 1
-
-            if index_to_pop is not None:
-                self.open_orders.pop(index_to_pop)
-
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CANCELED',
-                'base': base,
-                'quote': quote,
-                'exchange': self.name,
-                'exchange_order_id': exchange_order_id,
-                'internal_order_id': internal_order_id,
-                'order_status': 'CANCELED',
-                'server_ms': int(round(time() * 1000)),
-                'received_ms': int(round(time() * 1000))
-            })
+            self.orders.remove(exchange_order_id, internal_order_id)
+
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CANCELED',
+                base=base,
+                quote=quote,
+                exchange=self.name,
+                exchange_order_id=exchange_order_id,
+                internal_order_id=internal_order_id,
+                order_status='CANCELED',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            ))
         else:
             reason = response['message']
             if response['message'] == 'INVALID_ORDER' or\
@@ -220,18 +184,18 @@ class BittrexService(Exchange):
                response['message'] == 'UUID_INVALID':
                 reason = 'order_not_found'
 
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CANCEL_FAILED',
-                'base': base,
-                'quote': quote,
-                'reason': reason,
-                'exchange': self.name,
-                'exchange_order_id': exchange_order_id,
-                'internal_order_id': internal_order_id,
-                'order_status': 'UNKNOWN',
-                'server_ms': int(round(time() * 1000)),
-                'received_ms': int(round(time() * 1000))
-            })
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CANCEL_FAILED',
+                base=base,
+                quote=quote,
+                reason=reason,
+                exchange=self.name,
+                exchange_order_id=exchange_order_id,
+                internal_order_id=internal_order_id,
+                order_status='UNKNOWN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            ))
 
     def cancel_all(self, base, quote):
         open_orders_resp = self.rest_client.get_open_orders(BittrexService._to_market(base, quote))
@@ -239,12 +203,8 @@ class BittrexService(Exchange):
         for open_order in open_orders:
 
             exchange_order_id = open_order['OrderUuid']
-            internal_order_id = None
-
-            for order in self.open_orders:
-                if order['exchange_order_id'] == exchange_order_id:
-                    internal_order_id = order['internal_order_id']
-                    break
+            order = self.orders.get_by_exchange_id(exchange_order_id)
+            internal_order_id = order['internal_order_id'] if order is not None else None
 
             self.cancel_order(base, quote, internal_order_id, 'a_request_id', exchange_order_id=exchange_order_id)
 
@@ -271,11 +231,7 @@ class BittrexService(Exchange):
         return self.rest_client.get_withdrawal_history(currency)
 
     def get_order_by_exchange_id(self, exchange_id):
-        for open_order in self.open_orders.copy():
-            if open_order['exchange_order_id'] == exchange_id:
-                return open_order
-
-        return None
+        return self.orders.get_by_exchange_id(exchange_id)
 
     def get_public_trades(self, base, quote, start_s, end_s):
         pass
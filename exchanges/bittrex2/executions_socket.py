@@ -1,11 +1,13 @@
 import traceback
 from _decimal import Decimal
-from time import time
 
 import sys
 from aj_sns.log_service import logger
 from bittrex_websocket import BittrexSocket
 
+from exchanges.common.events import ExecutionEvent
+from exchanges.common.metrics import ReceiveTime
+
 
 class ExecutionsSocket(BittrexSocket):
 
@@ -25,6 +27,7 @@ class ExecutionsSocket(BittrexSocket):
         pass
 
     def on_private(self, msg):
+        receive_time = ReceiveTime()
         try:
             if 'TY' in msg:
                 update_type = msg['TY']
@@ -35,52 +38,37 @@ class ExecutionsSocket(BittrexSocket):
 
                     if market in self.markets_following:
                         exchange_order_id = str(order['OU'])
-                        internal_order = self.owner.get_order_by_exchange_id(exchange_order_id)
+                        quantity = Decimal(str(order['Q']))
+                        quantity_remaining = Decimal(str(order['q']))
+                        price = str(order['PU'])
+                        if update_type == 1:
+                            status = 'PARTIALLY_FILLED'
+                        else:
+                            status = 'FILLED'
+                        # A filled order leaves the store in the same step that records its last fill
+                        internal_order, new_fill_amount = self.owner.orders.fill(
+                            exchange_order_id, quantity - quantity_remaining, done=status == 'FILLED')
                         if internal_order is not None:
-                            quantity = Decimal(str(order['Q']))
-                            quantity_remaining = Decimal(str(order['q']))
-                            price = str(order['PU'])
-                            if update_type == 1:
-                                status = 'PARTIALLY_FILLED'
-                            else:
-                                status = 'FILLED'
-                            new_fill_amount = str(quantity - quantity_remaining -
-                                                  Decimal(str(internal_order['cum_quantity_filled'])))
-                            internal_order['cum_quantity_filled'] = str(Decimal(str(internal_order['quantity'])) -
-                                                                        quantity_remaining)
-                            message = {
-                                'action': 'EXECUTION',
-                                'exchange': self.owner.name,
-                                'base': base,
-                                'quote': quote,
-                                'exchange_order_id': str(internal_order['exchange_order_id']),
-                                'internal_order_id': str(internal_order['internal_order_id']),
-                                'side': internal_order['side'],
-                                'quantity': internal_order['quantity'],
-                                'price': internal_order['price'],
-                                'cum_quantity_filled': internal_order['cum_quantity_filled'],
-                                'order_status': status,
-                                'server_ms': int(round(time() * 1000)),
-                                'received_ms': int(round(time() * 1000)),
-                                'last_executed_quantity': new_fill_amount,
-                                'last_executed_price': price,
-                                'fee_base': 0,
-                                'fee_quote': 0,
-                                'trade_id': '-1'
-                            }
-
-                            if status == 'FILLED':
-                                index_to_del = None
-                                i = 0
-
-                                for order in self.owner.open_orders:
-                                    if order['exchange_order_id'] == exchange_order_id:
-                                        index_to_del = i
-                                        break
-                                    i += 1
-
-                                if index_to_del is not None:
-                                    self.owner.open_orders.pop(index_to_del)
+                            message = ExecutionEvent(
+                                action='EXECUTION',
+                                exchange=self.owner.name,
+                                base=base,
+                                quote=quote,
+                                exchange_order_id=str(internal_order['exchange_order_id']),
+                                internal_order_id=str(internal_order['internal_order_id']),
+                                side=internal_order['side'],
+                                quantity=internal_order['quantity'],
+                                price=internal_order['price'],
+                                cum_quantity_filled=str(internal_order['cum_quantity_filled']),
+                                order_status=status,
+                                server_ms=None,
+                                receive_time=receive_time,
+                                last_executed_quantity=str(new_fill_amount),
+                                last_executed_price=price,
+                                fee_base=0,
+                                fee_quote=0,
+                                trade_id='-1'
+                            )
 
                             self.owner.notify_callbacks('trade_lifecycle', trade_lifecycle_type=message['action'], data=message)
                         else:
@@ -5,6 +5,8 @@ from aj_sns.log_service import logger
 from bittrex_websocket import OrderBook
 from time import time
 
+from exchanges.common.events import BookEvent
+from exchanges.common.metrics import ReceiveTime
 from exchanges.exchange import Exchange
 
 
@@ -27,7 +29,7 @@ class OrderBookSocket(OrderBook):
         try:
             if msg in self.books_following:
                 book = self.get_order_book(msg)
-                internal_book = {'bids': [], 'asks': []}
+                internal_book = BookEvent(bids=[], asks=[], receive_time=ReceiveTime())
 
                 bids = book['Z']
                 asks = book['S']
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aj_sns.log_service import logger
+
+POOL_SIZE = 8
+TIMEOUT_S = 15
+RETRIES = 2
+BACKOFF_S = 0.25
+# Worth asking again: the exchange or a proxy in front of it was briefly unavailable
+RETRY_STATUSES = (502, 503, 504)
+
+
+class Response(object):
+    """A response read in full. Has the parts of requests.Response adapters use (status_code, content, text, headers
+    and json()), so their existing response handling takes either.
+    """
+
+    def __init__(self, status_code, content, headers, url):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        # Some exchanges (Cryptopia) start their JSON with a byte order mark
+        return json.loads(self.text.lstrip('\ufeff'))
+
+
+class AsyncHttpClient(object):
+    """An asyncio event loop on a daemon thread of its own, with one aiohttp session whose keep-alive connections
+    every request shares.
+
+    Adapters keep their synchronous API. They build the requests of a tick as coroutines (request(), or in_thread()
+    for a call into a blocking client library) and hand them all to run_all(), which runs them at once and returns
+    when the last one is done. A tick then takes about as long as its slowest call, rather than the sum of them all.
+
+        books = http.run_all([http.request('GET', url + market) for market in markets])
+
+    GETs that fail to connect, time out, or get a 502, 503 or 504 are retried up to retries times with exponential
+    backoff. Other methods are not, unless asked: an order must not be sent twice.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, timeout_s=TIMEOUT_S, retries=RETRIES, backoff_s=BACKOFF_S,
+                 name='async-http'):
+        """
+        :param pool_size: most connections open to one host at once. Requests beyond it wait for a free connection
+        :param timeout_s: for the whole of a request, connecting and reading included
+        """
+        self.pool_size = pool_size
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.loop = asyncio.new_event_loop()
+        # For in_thread. Separate from the loop's default executor so its size is ours
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.session = None
+        self.thread = threading.Thread(target=self.__run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.__open(), self.loop).result()
+
+    async def request(self, method, url, params=None, data=None, json_body=None, headers=None, retry=None):
+        """
+        :param retry: whether to retry failures, see the class. By default only GETs are
+        :return: a Response, whatever its status code. Raises if there was none, after any retries
+        """
+        if retry is None:
+            retry = method.upper() == 'GET'
+        attempts = 1 + (self.retries if retry else 0)
+        for attempt in range(attempts):
+            last_attempt = attempt + 1 == attempts
+            try:
+                async with self.session.request(method, url, params=params, data=data, json=json_body,
+                                                headers=headers) as response:
+                    content = await response.read()
+                    result = Response(response.status, content, response.headers, str(response.url))
+                if result.status_code not in RETRY_STATUSES or last_attempt:
+                    return result
+                logger().warning('{} {} answered {}, retrying'.format(method, url, result.status_code))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+                logger().warning('{} {} failed, retrying. Exception was: {!r}'.format(method, url, e))
+            await asyncio.sleep(self.backoff_s * 2 ** attempt)
+
+    async def in_thread(self, function, *args, **kwargs):
+        """Runs a blocking call on a worker thread, so it can be run_all'ed alongside requests"""
+        return await self.loop.run_in_executor(self.executor, lambda: function(*args, **kwargs))
+
+    def run(self, coroutine, timeout_s=None):
+        """Runs one coroutine on the loop and waits for its result, raising what it raised"""
+        self.__check_thread()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout_s)
+
+    def run_all(self, coroutines, timeout_s=None):
+        """Runs coroutines at once on the loop and waits for them all. Call from any thread but the loop's.
+
+        :return: their results, in order, with the exception in place of the result of any that raised
+        """
+        coroutines = list(coroutines)
+        if len(coroutines) == 0:
+            return []
+        self.__check_thread()
+        return asyncio.run_coroutine_threadsafe(self.__gather(coroutines), self.loop).result(timeout_s)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+    async def __open(self):
+        # The session belongs to the loop it is made on
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self.pool_size),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout_s))
+
+    @staticmethod
+    async def __gather(coroutines):
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+
+    def __check_thread(self):
+        if threading.current_thread() is self.thread:
+            # Waiting on the loop from the loop would wait forever
+            raise RuntimeError('AsyncHttpClient.run and run_all cannot be called from a coroutine, await instead')
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_async_http():
+    """The AsyncHttpClient shared by every service in the process, started on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AsyncHttpClient()
+        return _client
@@ -0,0 +1,63 @@
+from exchanges.common.events import BookEvent
+
+
+class BookSnapshot(object):
+    """An immutable, versioned copy of an order book, published by the thread that maintains the book.
+
+    Readers on any thread take the latest one with a plain attribute read: no lock, no copy. version is the
+    exchange's last update id, so comparing it to a version seen earlier tells a reader whether the book changed.
+    Levels are held as integer counts of the tick and step sizes; prices and quantities turn them back into strings.
+    """
+
+    __slots__ = ('version', 'received_ms', 'bids', 'asks', 'base', 'quote', 'exchange', 'prices', 'quantities')
+
+    def __init__(self, version, received_ms, bids, asks, base, quote, exchange, prices, quantities):
+        self.version = version
+        self.received_ms = received_ms
+        self.bids = bids
+        self.asks = asks
+        self.base = base
+        self.quote = quote
+        self.exchange = exchange
+        self.prices = prices
+        self.quantities = quantities
+
+    def has_changed_since(self, version):
+        return self.version != version
+
+    def best_bid(self):
+        return self.__format_level(self.bids.best())
+
+    def best_ask(self):
+        return self.__format_level(self.asks.best())
+
+    def to_dict(self, depth=None):
+        return {'bids': self.format_levels(self.bids.top(depth)),
+                'asks': self.format_levels(self.asks.top(depth)),
+                'base': self.base,
+                'quote': self.quote,
+                'exchange': self.exchange,
+                'last_update_id': self.version,
+                'received_ms': self.received_ms}
+
+    def to_event(self, depth=None):
+        # Called on every publish, so the fields are set directly rather than through BookEvent's keyword arguments
+        event = BookEvent()
+        event.bids = self.format_levels(self.bids.top(depth))
+        event.asks = self.format_levels(self.asks.top(depth))
+        event.base = self.base
+        event.quote = self.quote
+        event.exchange = self.exchange
+        event.last_update_id = self.version
+        event.received_ms = self.received_ms
+        return event
+
+    def format_levels(self, levels):
+        to_price = self.prices.to_str
+        to_quantity = self.quantities.to_str
+        return [[to_price(price), to_quantity(quantity)] for price, quantity in levels]
+
+    def __format_level(self, level):
+        if level is None:
+            return None
+        return [self.prices.to_str(level[0]), self.quantities.to_str(level[1])]
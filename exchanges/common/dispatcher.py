@@ -0,0 +1,290 @@
+import threading
+import time
+from collections import deque
+
+from aj_sns.log_service import logger
+
+from exchanges.common.events import Event
+
+# What happens when a message arrives for a subscriber whose queue is full:
+#   block        - the publishing thread waits for room. Nothing is lost, but a slow subscriber slows the publisher
+#   drop_oldest  - the oldest queued message is dropped to make room
+#   conflate     - a queued message for the same market (topic, subtype, exchange, base, quote) is replaced in place by
+#                  the new one, so a subscriber that falls behind only sees the latest state of each market. Applies
+#                  whether or not the queue is full. Messages without a market fall back to drop_oldest
+POLICIES = ('block', 'drop_oldest', 'conflate')
+
+# Books are state, so only the latest matters; lifecycle and account events are not, and must never be lost.
+# Order book deltas are not state either and are never conflated (see Subscriber.market_key)
+DEFAULT_POLICIES = {'order_book': 'conflate',
+                    'trade_lifecycle': 'block',
+                    'account': 'block'}
+DEFAULT_POLICY = 'block'
+QUEUE_SIZE = 1000
+
+
+class Subscriber(object):
+    """One callback with its own bounded queue, drained in order by its own worker thread.
+
+    Publishing only enqueues, so a slow callback delays its own messages and no one else's. What a full queue does
+    depends on the message's topic, see POLICIES.
+    """
+
+    def __init__(self, name, callback, queue_size=QUEUE_SIZE, policies=None, topics=None, markets=None,
+                 latencies=None):
+        self.name = name
+        self.callback = callback
+        self.latencies = latencies
+        # None means every topic / every market. Only read by Dispatcher when it builds its routes
+        self.topics = frozenset(topics) if topics is not None else None
+        self.markets = frozenset(tuple(market) for market in markets) if markets is not None else None
+        self.queue_size = queue_size
+        self.policies = dict(DEFAULT_POLICIES)
+        if policies is not None:
+            for topic, policy in policies.items():
+                if policy not in POLICIES:
+                    raise ValueError('Unknown overflow policy for {}: {}. Expected one of {}'
+                                     .format(topic, policy, POLICIES))
+                self.policies[topic] = policy
+        self.condition = threading.Condition()
+        # Entries are [market_key, topic, kwargs, dispatched_s] lists so a conflated message can be swapped in without
+        # moving it
+        self.queue = deque()
+        self.queued_by_market = {}
+        self.running = True
+        self.delivered_count = 0
+        self.dropped_count = 0
+        self.conflated_count = 0
+        self.blocked_count = 0
+        self.failed_count = 0
+        self.max_depth = 0
+        self.thread = threading.Thread(target=self.__run, name='dispatch-{}'.format(name))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def market_key(topic, kwargs):
+        if kwargs.get('order_book_type') in ('delta', 'snapshot'):
+            # A delta only makes sense on top of every delta before it
+            return None
+        data = kwargs.get('data')
+        if not isinstance(data, (dict, Event)) or 'base' not in data or 'quote' not in data:
+            return None
+        subtype = kwargs.get('order_book_type', kwargs.get('trade_lifecycle_type', kwargs.get('account_type')))
+        return topic, subtype, data.get('exchange'), data['base'], data['quote']
+
+    def put(self, topic, kwargs, dispatched_s):
+        policy = self.policies.get(topic, DEFAULT_POLICY)
+        market_key = Subscriber.market_key(topic, kwargs) if policy == 'conflate' else None
+
+        with self.condition:
+            if not self.running:
+                return
+
+            if market_key is not None:
+                queued = self.queued_by_market.get(market_key)
+                if queued is not None:
+                    queued[2] = kwargs
+                    queued[3] = dispatched_s
+                    self.conflated_count += 1
+                    return
+
+            if len(self.queue) >= self.queue_size:
+                if policy == 'block' and threading.current_thread() is not self.thread:
+                    # A callback publishing to its own subscriber would wait on itself, so it overflows instead
+                    self.blocked_count += 1
+                    while self.running and len(self.queue) >= self.queue_size:
+                        self.condition.wait()
+                    if not self.running:
+                        return
+                elif policy != 'block':
+                    dropped = self.queue.popleft()
+                    if dropped[0] is not None:
+                        del self.queued_by_market[dropped[0]]
+                    self.dropped_count += 1
+
+            entry = [market_key, topic, kwargs, dispatched_s]
+            self.queue.append(entry)
+            if market_key is not None:
+                self.queued_by_market[market_key] = entry
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.queue.clear()
+            self.queued_by_market = {}
+            self.condition.notify_all()
+
+    def get_stats(self):
+        with self.condition:
+            return {'queue_depth': len(self.queue),
+                    'max_queue_depth': self.max_depth,
+                    'queue_size': self.queue_size,
+                    'delivered': self.delivered_count,
+                    'dropped': self.dropped_count,
+                    'conflated': self.conflated_count,
+                    'blocked': self.blocked_count,
+                    'failed': self.failed_count}
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                market_key, topic, kwargs, dispatched_s = self.queue.popleft()
+                if market_key is not None:
+                    del self.queued_by_market[market_key]
+                # Wakes publishers blocked on a full queue
+                self.condition.notify_all()
+
+            try:
+                self.callback(topic, **kwargs)
+                self.delivered_count += 1
+            except Exception as e:
+                self.failed_count += 1
+                logger().error('Callback {} failed on {}. Exception was: {}'.format(self.name, topic, e))
+            if self.latencies is not None:
+                self.latencies.histogram(topic, 'dispatch_to_done', self.name).observe(
+                    (time.monotonic() - dispatched_s) * 1000.0)
+
+
+class _Route(object):
+    """The subscribers of one topic: those taking every market, and those filtered on (base, quote)."""
+
+    __slots__ = ('unfiltered', 'filtered', 'by_market')
+
+    def __init__(self, subscribers):
+        self.unfiltered = tuple(subscriber for subscriber in subscribers if subscriber.markets is None)
+        self.filtered = tuple(subscriber for subscriber in subscribers if subscriber.markets is not None)
+        by_market = {}
+        for subscriber in self.filtered:
+            for market in subscriber.markets:
+                by_market.setdefault(market, []).append(subscriber)
+        self.by_market = {market: tuple(subscribers) for market, subscribers in by_market.items()}
+
+
+class Dispatcher(object):
+    """Fans messages out to named subscribers, each behind its own queue and worker thread (see Subscriber).
+
+    Subscribers can be limited to some topics and some (base, quote) markets. Who gets what is worked out once per
+    change of subscribers into a table of topic -> _Route, so a message is only ever handed to the subscribers that
+    asked for it. A message without a base and quote (balances, for one) goes to every subscriber of its topic.
+
+    As the callbacks of a message run at the same time, each gets its own copy of the message's events (see
+    copy_message) to set or pop fields on. What an event holds, such as a book's levels, is shared and read-only.
+    """
+
+    def __init__(self, latencies=None, metrics=None):
+        """
+        :param latencies: a metrics.LatencyHistograms to time messages into, from receive to dispatch and from
+                          dispatch to each callback returning
+        :param metrics: a metrics.MetricsRegistry to count dispatched messages per topic into
+        """
+        self.latencies = latencies
+        self.metrics = metrics
+        self.dispatched_counters = {}
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        # (topic -> _Route, route of every other topic), swapped as one so dispatch() never sees half of a change
+        self.routing = ({}, _Route([]))
+
+    def add(self, name, callback, queue_size=QUEUE_SIZE, policies=None, topics=None, markets=None):
+        subscriber = Subscriber(name, callback, queue_size, policies, topics, markets, self.latencies)
+        with self.lock:
+            previous = self.subscribers.get(name)
+            # Copied rather than changed in place, so dispatch() can read without the lock
+            subscribers = dict(self.subscribers)
+            subscribers[name] = subscriber
+            self.__set_subscribers(subscribers)
+        if previous is not None:
+            previous.stop()
+
+    def remove(self, name):
+        with self.lock:
+            subscribers = dict(self.subscribers)
+            subscriber = subscribers.pop(name)
+            self.__set_subscribers(subscribers)
+        subscriber.stop()
+
+    def remove_all(self):
+        with self.lock:
+            subscribers = self.subscribers
+            self.__set_subscribers({})
+        for subscriber in subscribers.values():
+            subscriber.stop()
+
+    def dispatch(self, topic, **kwargs):
+        dispatched_s = time.monotonic()
+        if self.metrics is not None:
+            counter = self.dispatched_counters.get(topic)
+            if counter is None:
+                counter = self.dispatched_counters[topic] = self.metrics.counter(
+                    'messages_total', 'Messages published to callbacks', topic=topic)
+            counter.inc()
+        if self.latencies is not None:
+            receive_time = getattr(kwargs.get('data'), 'receive_time', None)
+            if receive_time is not None:
+                self.latencies.histogram(topic, 'receive_to_dispatch').observe(
+                    (dispatched_s - receive_time.monotonic_s) * 1000.0)
+
+        routes, default_route = self.routing
+        route = routes.get(topic, default_route)
+        subscribers = route.unfiltered
+        if len(route.filtered) > 0:
+            data = kwargs.get('data')
+            if isinstance(data, (dict, Event)) and 'base' in data and 'quote' in data:
+                subscribers = subscribers + route.by_market.get((data['base'], data['quote']), ())
+            else:
+                subscribers = subscribers + route.filtered
+
+        # Callbacks run at once on their own threads, so each but the first gets its own copy to change
+        for i, subscriber in enumerate(subscribers):
+            subscriber.put(topic, kwargs if i == 0 else Dispatcher.copy_message(kwargs), dispatched_s)
+
+    @staticmethod
+    def copy_message(kwargs):
+        """A copy of a message's arguments and of the events and dicts in them, one level deep. Levels and other
+        lists inside an event are shared
+        """
+        return {key: Dispatcher.__copy_value(value) for key, value in kwargs.items()}
+
+    @staticmethod
+    def __copy_value(value):
+        if isinstance(value, (dict, Event)):
+            return value.copy()
+        if isinstance(value, list):
+            return [item.copy() if isinstance(item, (dict, Event)) else item for item in value]
+        return value
+
+    def __set_subscribers(self, subscribers):
+        # Topics nobody named explicitly go to the subscribers that take every topic
+        topics = set()
+        for subscriber in subscribers.values():
+            if subscriber.topics is not None:
+                topics.update(subscriber.topics)
+        everything = [subscriber for subscriber in subscribers.values() if subscriber.topics is None]
+
+        routes = {}
+        for topic in topics:
+            routes[topic] = _Route([subscriber for subscriber in subscribers.values()
+                                    if subscriber.topics is None or topic in subscriber.topics])
+        self.routing = (routes, _Route(everything))
+        self.subscribers = subscribers
+
+    def get_stats(self):
+        return {name: subscriber.get_stats() for name, subscriber in self.subscribers.items()}
+
+    def collect(self):
+        """For metrics.MetricsRegistry.add_collector"""
+        for name, stats in self.get_stats().items():
+            labels = {'callback': name}
+            yield 'callback_queue_depth', 'gauge', 'Messages queued for a callback', labels, stats['queue_depth']
+            yield ('callback_max_queue_depth', 'gauge', 'Most messages ever queued for a callback', labels,
+                   stats['max_queue_depth'])
+            for outcome in ('delivered', 'dropped', 'conflated', 'blocked', 'failed'):
+                yield ('callback_messages_total', 'counter', 'Messages per callback by what became of them',
+                       dict(labels, outcome=outcome), stats[outcome])
@@ -0,0 +1,161 @@
+class Event(object):
+    """Base of the events adapters publish to their callbacks, in place of dicts with the same keys.
+
+    Fields live in __slots__, so an event carries no per-instance dict and no copy of its key strings. Events still
+    read and write like the dicts they replace: event['price'], event.get('fee_base'), 'fee_base' in event and
+    event['price'] = ... all work, and a field that was never set is missing, just as an absent key was. Keys that
+    are not fields of the type are kept aside rather than refused. to_dict() builds a plain dict for consumers that
+    need one (serialisers, pandas), only when they ask for it.
+
+    receive_time, if given, is the metrics.ReceiveTime of the exchange message the event was built from. It fills
+    received_ms, and lets the dispatcher time the event from arrival to each callback. It is not one of the fields.
+    """
+
+    __slots__ = ('_extra', 'receive_time')
+    # Each subclass lists its fields in FIELDS, in the order to_dict() gives them, and as a set in _field_set
+    FIELDS = ()
+    _field_set = frozenset()
+
+    def __init__(self, receive_time=None, **fields):
+        if receive_time is not None:
+            self.receive_time = receive_time
+            if 'received_ms' in self._field_set:
+                self.received_ms = receive_time.wall_ms
+        field_set = self._field_set
+        for key, value in fields.items():
+            if key in field_set:
+                setattr(self, key, value)
+            else:
+                self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self.__extra()[key]
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+            return
+        try:
+            self._extra[key] = value
+        except AttributeError:
+            self._extra = {key: value}
+
+    def __delitem__(self, key):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            del self.__extra()[key]
+
+    def __contains__(self, key):
+        if key in self._field_set:
+            return hasattr(self, key)
+        return key in self.__extra()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Event, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, self.to_dict())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if len(default) > 0:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def keys(self):
+        keys = [field for field in self.FIELDS if hasattr(self, field)]
+        keys.extend(self.__extra().keys())
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    def copy(self):
+        event = type(self)(receive_time=getattr(self, 'receive_time', None))
+        for key, value in self.items():
+            event[key] = value
+        return event
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __extra(self):
+        try:
+            return self._extra
+        except AttributeError:
+            return {}
+
+
+class LifecycleEvent(Event):
+    """A trade_lifecycle event about one order: sent, created, canceled, rejected or failed."""
+
+    __slots__ = ('action', 'reason', 'exchange', 'symbol', 'base', 'quote', 'exchange_order_id', 'internal_order_id',
+                 'request_id', 'requester_id', 'side', 'quantity', 'price', 'cum_quantity_filled', 'order_status',
+                 'rejected_reason', 'server_ms', 'received_ms')
+    FIELDS = __slots__
+    _field_set = frozenset(FIELDS)
+
+
+class ExecutionEvent(LifecycleEvent):
+    """A trade_lifecycle event reporting a fill, with what was filled and what it cost."""
+
+    __slots__ = ('last_executed_quantity', 'last_executed_price', 'fee_base', 'fee_quote', 'trade_id')
+    FIELDS = LifecycleEvent.FIELDS + __slots__
+    _field_set = frozenset(FIELDS)
+
+
+class BookEvent(Event):
+    """An order_book event: the levels of a book, or of a change to one, as [price, quantity] lists."""
+
+    __slots__ = ('bids', 'asks', 'base', 'quote', 'exchange', 'first_update_id', 'last_update_id', 'merged_updates',
+                 'server_ms', 'received_ms')
+    FIELDS = __slots__
+    _field_set = frozenset(FIELDS)
+
+
+class BalanceEvent(Event):
+    """One asset of an account balance event."""
+
+    __slots__ = ('asset', 'free', 'locked')
+    FIELDS = __slots__
+    _field_set = frozenset(FIELDS)
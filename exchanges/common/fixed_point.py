@@ -0,0 +1,55 @@
+from decimal import Decimal
+
+
+class PrecisionError(ValueError):
+    """A value is not a whole number of a FixedPointCodec's increment"""
+
+
+class FixedPointCodec(object):
+    """Converts decimal strings to integer counts of an increment (a tick or step size) and back.
+
+    Parsing is plain string slicing and int(), so the depth hot path never builds a Decimal, zero checks and
+    comparisons are integer operations, and '0.001' and '0.00100000' map to the same key. A value that is not a whole
+    number of increments raises PrecisionError rather than being rounded, as rounding a quantity below one step would
+    turn it into 0. finer() gives a codec that can hold it.
+    """
+
+    def __init__(self, increment):
+        self.increment = str(increment)
+        whole, _, fraction = self.increment.partition('.')
+        fraction = fraction.rstrip('0')
+        self.decimals = len(fraction)
+        self.unit = int(whole + fraction)
+        if self.unit <= 0:
+            raise ValueError('Increment must be positive, got {}'.format(increment))
+
+    def to_int(self, value):
+        whole, _, fraction = value.partition('.')
+        if len(fraction) > self.decimals and fraction[self.decimals:].rstrip('0') != '':
+            raise PrecisionError('{} has more decimals than the increment {}'.format(value, self.increment))
+        scaled = int(whole + fraction[:self.decimals].ljust(self.decimals, '0'))
+        if self.unit == 1:
+            return scaled
+        count, leftover = divmod(scaled, self.unit)
+        if leftover != 0:
+            raise PrecisionError('{} is not a multiple of the increment {}'.format(value, self.increment))
+        return count
+
+    def to_str(self, count):
+        scaled = str(count * self.unit)
+        if self.decimals == 0:
+            return scaled
+        scaled = scaled.rjust(self.decimals + 1, '0')
+        return scaled[:-self.decimals] + '.' + scaled[-self.decimals:]
+
+    def to_decimal(self, count):
+        return Decimal(self.to_str(count))
+
+    def finer(self, value):
+        """
+        :return: a codec whose increment divides both this one's and value, and the factor that turns counts of this
+                 codec into counts of the new one
+        """
+        decimals = max(self.decimals, len(value.partition('.')[2].rstrip('0')))
+        increment = '0.' + '0' * (decimals - 1) + '1' if decimals > 0 else '1'
+        return FixedPointCodec(increment), self.unit * 10 ** (decimals - self.decimals)
@@ -0,0 +1,55 @@
+import json
+import os
+import time
+
+from aj_sns.log_service import logger
+
+
+class MetadataCache(object):
+    """JSON files on local disk holding exchange metadata that rarely changes (symbols, currencies, addresses).
+
+    Each entry records when it was saved and is ignored once older than the ttl the reader asks for, so a restart
+    reuses recent metadata instead of waiting on the network. The directory defaults to ~/.cache/exchanges and can
+    be moved with the EXCHANGES_CACHE_DIR environment variable.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get('EXCHANGES_CACHE_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'exchanges'))
+        self.directory = directory
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def load(self, key, ttl_s):
+        entry = self.load_entry(key, ttl_s)
+        return entry[0] if entry is not None else None
+
+    def load_entry(self, key, ttl_s):
+        """
+        :return: (value, saved_at) where saved_at is the time.time() it was saved at, or None if missing or too old
+        """
+        try:
+            with open(self.__path(key)) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if time.time() - entry['saved_at'] > ttl_s:
+            return None
+
+        return entry['value'], entry['saved_at']
+
+    def save(self, key, value):
+        path = self.__path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Written aside and renamed so a reader never sees a half written file
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'w') as cache_file:
+                json.dump({'saved_at': time.time(), 'value': value}, cache_file)
+            os.replace(temp_path, path)
+        except (IOError, OSError, TypeError) as e:
+            logger().warning('Failed to cache {} to {}. Exception was: {}'.format(key, path, e))
@@ -0,0 +1,369 @@
+import threading
+import time
+from bisect import bisect_left
+from threading import get_ident
+
+# Every exported metric name is prefixed with this, and every sample labelled with its exchange
+PREFIX = 'exchanges_'
+
+# Upper bounds, in milliseconds, of the latency histogram buckets: roughly 1-2-5 steps from 10µs to 1 minute.
+# Anything slower lands in a last, unbounded bucket
+LATENCY_BUCKETS_MS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+                      30000, 60000)
+
+# Stages a message goes through, each timed into its own histogram:
+#   exchange_to_receive  - exchange timestamp (corrected by the clock offset) to our receive time. Only for messages
+#                          that carry an exchange timestamp
+#   receive_to_dispatch  - receive time to notify_callbacks, i.e. parsing and book maintenance
+#   dispatch_to_done     - notify_callbacks to a callback returning, i.e. queueing plus the callback itself. One
+#                          histogram per callback
+STAGES = ('exchange_to_receive', 'receive_to_dispatch', 'dispatch_to_done')
+
+
+class ReceiveTime(object):
+    """When a message arrived, taken once where it enters the process: a socket callback or an HTTP response.
+
+    wall_ms is epoch milliseconds, comparable with exchange timestamps; monotonic_s is for measuring how long we
+    took afterwards, immune to the wall clock being stepped.
+    """
+
+    __slots__ = ('wall_ms', 'monotonic_s')
+
+    def __init__(self):
+        self.monotonic_s = time.monotonic()
+        self.wall_ms = int(round(time.time() * 1000))
+
+    def elapsed_ms(self):
+        return (time.monotonic() - self.monotonic_s) * 1000.0
+
+
+class Histogram(object):
+    """Counts of observations per bucket, with their sum, min and max. Percentiles are read off the buckets, so are
+    only as precise as the bucket bounds."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+        with self.lock:
+            return self.__percentile(list(self.counts), self.count, fraction)
+
+    def get_stats(self):
+        with self.lock:
+            counts = list(self.counts)
+            count, total, minimum, maximum = self.count, self.sum, self.min, self.max
+        return {'count': count,
+                'mean': total / count if count > 0 else None,
+                'min': minimum,
+                'max': maximum,
+                'p50': self.__percentile(counts, count, 0.5),
+                'p90': self.__percentile(counts, count, 0.9),
+                'p99': self.__percentile(counts, count, 0.99),
+                'p999': self.__percentile(counts, count, 0.999)}
+
+    def __percentile(self, counts, count, fraction):
+        if count == 0:
+            return None
+        rank = fraction * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count > 0:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+
+class Counter(object):
+    """A count that only goes up. Callers on a hot path should keep the Counter rather than look it up each time.
+
+    Each thread counts into its own cell, which no other thread writes, so inc() takes no lock once a thread has
+    counted once. The value is the sum of the cells.
+    """
+
+    __slots__ = ('lock', 'cells')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cells = {}
+
+    def inc(self, amount=1):
+        try:
+            self.cells[get_ident()][0] += amount
+        except KeyError:
+            with self.lock:
+                self.cells[get_ident()] = [amount]
+
+    @property
+    def value(self):
+        with self.lock:
+            cells = list(self.cells.values())
+        return sum(cell[0] for cell in cells)
+
+
+class Gauge(object):
+    """A value that goes up and down, e.g. a queue depth or a connection count."""
+
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class ClockOffset(object):
+    """Estimates how far an exchange's clock is ahead of ours, from request/response timestamp samples.
+
+    Each sample is a server timestamp taken somewhere between our send and receive times, so the offset is read
+    against the midpoint and is off by at most half the round trip. The estimate kept is the one from the sample with
+    the shortest round trip among the last `samples`.
+    """
+
+    SAMPLES = 8
+
+    def __init__(self, samples=SAMPLES):
+        self.max_samples = samples
+        self.lock = threading.Lock()
+        self.samples = []
+        self.offset_ms = 0
+        self.round_trip_ms = None
+
+    def add_sample(self, server_ms, sent_ms, received_ms):
+        round_trip_ms = received_ms - sent_ms
+        offset_ms = server_ms - (sent_ms + received_ms) / 2.0
+        with self.lock:
+            self.samples.append((round_trip_ms, offset_ms))
+            self.samples = self.samples[-self.max_samples:]
+            self.round_trip_ms, self.offset_ms = min(self.samples)
+
+    def to_local_ms(self, server_ms):
+        return server_ms - self.offset_ms
+
+
+class LatencyHistograms(object):
+    """Latency histograms of one exchange, per topic and stage (see STAGES), plus the clock offset used to compare
+    the exchange's timestamps with ours."""
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.clock = ClockOffset()
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def histogram(self, topic, stage, callback=None):
+        key = (topic, stage, callback)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def record_receive(self, topic, server_ms, receive_time):
+        if server_ms is not None:
+            self.histogram(topic, 'exchange_to_receive').observe(
+                receive_time.wall_ms - self.clock.to_local_ms(server_ms))
+
+    def collect(self):
+        """For MetricsRegistry.add_collector"""
+        for (topic, stage, callback), histogram in list(self.histograms.items()):
+            labels = {'topic': topic, 'stage': stage}
+            if callback is not None:
+                labels['callback'] = callback
+            yield 'latency_ms', 'histogram', 'Message latency per topic and stage', labels, histogram
+
+    def get_stats(self):
+        """
+        :return: {topic: {stage: stats}}, where dispatch_to_done is further split per callback:
+                 {topic: {'dispatch_to_done': {callback name: stats}}}. stats as in Histogram.get_stats, in ms
+        """
+        stats = {}
+        for (topic, stage, callback), histogram in list(self.histograms.items()):
+            stages = stats.setdefault(topic, {})
+            if callback is None:
+                stages[stage] = histogram.get_stats()
+            else:
+                stages.setdefault(stage, {})[callback] = histogram.get_stats()
+        return stats
+
+
+class MetricsRegistry(object):
+    """Counters, gauges and histograms of one exchange, keyed by name and labels.
+
+    counter(), gauge() and histogram() create the metric on first use and return the same one afterwards. Looking a
+    metric up costs a dict lookup and updating a Counter takes no lock, so code on a hot path looks its metrics up
+    once and keeps them. State that is already counted elsewhere, like the dispatcher's queues, is read only when
+    metrics are collected, through add_collector.
+    """
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.lock = threading.Lock()
+        self.metrics = {}
+        # name -> (type, description)
+        self.families = {}
+        self.collectors = []
+
+    def counter(self, name, description='', **labels):
+        return self.__get(name, 'counter', Counter, description, labels)
+
+    def gauge(self, name, description='', **labels):
+        return self.__get(name, 'gauge', Gauge, description, labels)
+
+    def histogram(self, name, description='', **labels):
+        return self.__get(name, 'histogram', Histogram, description, labels)
+
+    def rest_call(self, endpoint):
+        """Counts and times a REST call, and counts it as an error if it raises:
+            with self.metrics.rest_call('order'):
+                self.client.create_order(...)
+        """
+        return _RestCall(self, endpoint)
+
+    def add_collector(self, collector):
+        """
+        :param collector: called on every collection, returning (name, type, description, labels, value) tuples. value
+                          is a number, or a Histogram for the histogram type
+        """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def collect(self):
+        """
+        :return: [(name, type, description, labels, value)], labels including the exchange
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+            families = dict(self.families)
+            collectors = list(self.collectors)
+
+        samples = []
+        for (name, labels), metric in metrics:
+            metric_type, description = families[name]
+            value = metric if metric_type == 'histogram' else metric.value
+            samples.append((name, metric_type, description, dict(labels, exchange=self.exchange), value))
+        for collector in collectors:
+            for name, metric_type, description, labels, value in collector():
+                samples.append((name, metric_type, description, dict(labels, exchange=self.exchange), value))
+        return samples
+
+    def get_metrics(self):
+        """
+        :return: {name: {'type', 'description', 'samples': [{'labels': {...}, 'value': value}]}}. A histogram's value
+                 is its Histogram.get_stats()
+        """
+        metrics = {}
+        for name, metric_type, description, labels, value in self.collect():
+            family = metrics.setdefault(name, {'type': metric_type, 'description': description, 'samples': []})
+            if metric_type == 'histogram':
+                value = value.get_stats()
+            family['samples'].append({'labels': labels, 'value': value})
+        return metrics
+
+    def __get(self, name, metric_type, metric_class, description, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                known_type, _ = self.families.setdefault(name, (metric_type, description))
+                if known_type != metric_type:
+                    raise ValueError('{} is a {}, not a {}'.format(name, known_type, metric_type))
+                metric = self.metrics.setdefault(key, metric_class())
+        return metric
+
+
+class _RestCall(object):
+
+    def __init__(self, registry, endpoint):
+        self.registry = registry
+        self.endpoint = endpoint
+        self.started_s = None
+
+    def __enter__(self):
+        self.started_s = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.registry.histogram('rest_request_ms', 'REST call duration', endpoint=self.endpoint).observe(
+            (time.monotonic() - self.started_s) * 1000.0)
+        self.registry.counter('rest_requests_total', 'REST calls made', endpoint=self.endpoint).inc()
+        if exc_type is not None:
+            self.registry.counter('rest_errors_total', 'REST calls that raised', endpoint=self.endpoint).inc()
+        return False
+
+
+def to_prometheus(registries):
+    """Renders the metrics of some registries in the Prometheus text exposition format, each family once."""
+    families = {}
+    for registry in registries:
+        for name, metric_type, description, labels, value in registry.collect():
+            family = families.setdefault(name, (metric_type, description, []))
+            family[2].append((labels, value))
+
+    lines = []
+    for name in sorted(families.keys()):
+        metric_type, description, samples = families[name]
+        full_name = PREFIX + name
+        if description:
+            lines.append('# HELP {} {}'.format(full_name, description))
+        lines.append('# TYPE {} {}'.format(full_name, metric_type))
+        for labels, value in samples:
+            if metric_type == 'histogram':
+                lines.extend(_histogram_lines(full_name, labels, value))
+            else:
+                lines.append('{}{} {}'.format(full_name, _format_labels(labels), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(name, labels, histogram):
+    with histogram.lock:
+        counts = list(histogram.counts)
+        count, total = histogram.count, histogram.sum
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(histogram.bounds, counts):
+        cumulative += bucket_count
+        lines.append('{}_bucket{} {}'.format(name, _format_labels(dict(labels, le=_format_value(bound))), cumulative))
+    lines.append('{}_bucket{} {}'.format(name, _format_labels(dict(labels, le='+Inf')), count))
+    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(total)))
+    lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+    return lines
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
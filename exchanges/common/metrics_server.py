@@ -0,0 +1,52 @@
+import threading
+
+from aj_sns.log_service import logger
+from flask import Flask, Response
+from werkzeug.serving import make_server
+
+from exchanges.common.metrics import to_prometheus
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def create_app(services):
+    """A Flask app serving the metrics of some exchange services at /metrics, in the Prometheus text format."""
+    app = Flask(__name__)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(to_prometheus([service.metrics for service in services]), content_type=CONTENT_TYPE)
+
+    return app
+
+
+class MetricsServer(object):
+    """Serves create_app on its own daemon thread. Binds to localhost by default: it is meant to be scraped by a
+    Prometheus on the same host, not exposed.
+
+        server = MetricsServer([binance, bittrex], port=9102)
+        server.start()
+    """
+
+    HOST = '127.0.0.1'
+    PORT = 9102
+
+    def __init__(self, services, host=HOST, port=PORT):
+        self.services = services
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        self.server = make_server(self.host, self.port, create_app(self.services), threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server')
+        self.thread.daemon = True
+        self.thread.start()
+        logger().info('Serving metrics on http://{}:{}/metrics'.format(self.host, self.port))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+            self.thread = None
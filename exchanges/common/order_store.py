@@ -0,0 +1,211 @@
+import threading
+from decimal import Decimal
+from types import MappingProxyType
+
+from aj_sns.log_service import logger
+
+ZERO = Decimal(0)
+# Order side, in any case, -> the side of get_quantities_by_price it counts in
+BOOK_SIDES = {'buy': 'bids', 'sell': 'asks'}
+
+
+def to_decimal(value):
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+
+def to_book_side(side):
+    """
+    :return: 'bids' for a buy, 'asks' for a sell, None for any other side
+    """
+    return BOOK_SIDES.get(side.lower()) if isinstance(side, str) else None
+
+
+def remaining(order):
+    # An order filled beyond its quantity (which exchanges do report) has nothing left, rather than less than nothing
+    return max(order['quantity'] - order['cum_quantity_filled'], ZERO)
+
+
+class OrderStore(object):
+    """The open orders of one account on one exchange, indexed by internal id, exchange id, market and (side, price).
+
+    Every lookup is a dict lookup, and every change goes through a method that updates all the indexes under one
+    lock, so a fill reported by a socket thread and a cancel made by the quoting thread cannot leave an order half
+    removed or count a fill twice.
+
+    An order is kept as a copy of the CREATED event (or dict) it was added from, with price, quantity and
+    cum_quantity_filled as Decimals. The orders handed out are the stored ones: read them, but change them only
+    through fill() and remove(), or the indexes go stale.
+
+    The quantity we have open at each price is kept up to date as orders are added, filled and removed, rather than
+    summed when asked for. Each change copies the side it touches and swaps the copy in, so get_quantities_by_price()
+    hands out the current, read-only, sides as they are, without copying or taking the lock. Buys count as bids and
+    sells as asks, in any case. An order of any other side is stored and logged but not counted.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_exchange_id = {}
+        self.by_internal_id = {}
+        # (base, quote) -> {exchange_order_id: order}
+        self.by_market = {}
+        # (side, price) -> {exchange_order_id: order}
+        self.by_price = {}
+        self.pending_cancel = set()
+        # 'bids'/'asks' -> read-only {price: quantity open}, replaced whole on every change
+        self.quantities = {'bids': MappingProxyType({}), 'asks': MappingProxyType({})}
+
+    def __len__(self):
+        return len(self.by_exchange_id)
+
+    def __contains__(self, exchange_order_id):
+        return exchange_order_id in self.by_exchange_id
+
+    def add(self, order):
+        """
+        :param order: the order's CREATED event, with at least exchange_order_id, base, quote, side, price and
+                      quantity. Added as a copy
+        :return: the stored order
+        """
+        order = order.copy()
+        order['price'] = to_decimal(order['price'])
+        order['quantity'] = to_decimal(order['quantity'])
+        order['cum_quantity_filled'] = to_decimal(order.get('cum_quantity_filled') or 0)
+        exchange_order_id = order['exchange_order_id']
+        if to_book_side(order['side']) is None:
+            logger().warning('Order {} has unknown side {}, so is not counted in the quantities by price'
+                             .format(exchange_order_id, order['side']))
+
+        with self.lock:
+            self.__remove(exchange_order_id)
+            self.by_exchange_id[exchange_order_id] = order
+            if order.get('internal_order_id') is not None:
+                self.by_internal_id[order['internal_order_id']] = order
+            self.by_market.setdefault((order['base'], order['quote']), {})[exchange_order_id] = order
+            self.by_price.setdefault((order['side'], order['price']), {})[exchange_order_id] = order
+            self.__adjust(order['side'], order['price'], remaining(order))
+        return order
+
+    def get(self, internal_order_id):
+        return self.by_internal_id.get(internal_order_id)
+
+    def get_by_exchange_id(self, exchange_order_id):
+        return self.by_exchange_id.get(exchange_order_id)
+
+    def get_exchange_id(self, internal_order_id):
+        """
+        :return: the exchange id of an open order, or None if there is no open order with that internal id
+        """
+        order = self.by_internal_id.get(internal_order_id)
+        return order['exchange_order_id'] if order is not None else None
+
+    def get_all(self):
+        with self.lock:
+            return list(self.by_exchange_id.values())
+
+    def get_market(self, base, quote):
+        with self.lock:
+            return list(self.by_market.get((base, quote), {}).values())
+
+    def get_at_price(self, side, price):
+        with self.lock:
+            return list(self.by_price.get((side, to_decimal(price)), {}).values())
+
+    def fill(self, exchange_order_id, cum_quantity_filled, done=False, **fields):
+        """Records how much of an order is filled so far.
+
+        :param cum_quantity_filled: total filled, as reported by the exchange
+        :param done: the order is closed (fully filled, or canceled after a partial fill) and leaves the store
+        :param fields: other fields of the order to set at the same time, e.g. fee_base
+        :return: (order, quantity newly filled by this call), or (None, None) if the order is not open
+        """
+        cum_quantity_filled = to_decimal(cum_quantity_filled)
+        with self.lock:
+            order = self.by_exchange_id.get(exchange_order_id)
+            if order is None:
+                return None, None
+            newly_filled = cum_quantity_filled - order['cum_quantity_filled']
+            remaining_before = remaining(order)
+            order['cum_quantity_filled'] = cum_quantity_filled
+            order.update(fields)
+            self.__adjust(order['side'], order['price'], remaining(order) - remaining_before)
+            if done:
+                self.__remove(exchange_order_id)
+            return order, newly_filled
+
+    def remove(self, exchange_order_id=None, internal_order_id=None):
+        """
+        :return: the order removed, or None if it was not open
+        """
+        with self.lock:
+            if exchange_order_id is None:
+                exchange_order_id = self.get_exchange_id(internal_order_id)
+            order = self.__remove(exchange_order_id)
+            # An order we never saw created (so not in the store) may still have had a cancel pending
+            self.pending_cancel.discard(internal_order_id)
+            return order
+
+    def remove_market(self, base, quote):
+        """
+        :return: the orders removed
+        """
+        with self.lock:
+            orders = list(self.by_market.get((base, quote), {}).values())
+            for order in orders:
+                self.__remove(order['exchange_order_id'])
+            return orders
+
+    def set_pending_cancel(self, internal_order_id):
+        with self.lock:
+            self.pending_cancel.add(internal_order_id)
+
+    def clear_pending_cancel(self, internal_order_id):
+        with self.lock:
+            self.pending_cancel.discard(internal_order_id)
+
+    def is_pending_cancel(self, internal_order_id):
+        return internal_order_id in self.pending_cancel
+
+    def get_quantities_by_price(self):
+        """
+        :return: {'bids': {price: quantity}, 'asks': {price: quantity}}, the quantity still open at each price,
+                 summed over our orders, as Decimals. The sides are read-only and never change once handed out
+        """
+        quantities = self.quantities
+        return {'bids': quantities['bids'], 'asks': quantities['asks']}
+
+    def __remove(self, exchange_order_id):
+        order = self.by_exchange_id.pop(exchange_order_id, None)
+        if order is None:
+            return None
+
+        internal_order_id = order.get('internal_order_id')
+        if internal_order_id is not None:
+            if self.by_internal_id.get(internal_order_id) is order:
+                del self.by_internal_id[internal_order_id]
+            self.pending_cancel.discard(internal_order_id)
+        self.__unindex(self.by_market, (order['base'], order['quote']), exchange_order_id)
+        self.__unindex(self.by_price, (order['side'], order['price']), exchange_order_id)
+        self.__adjust(order['side'], order['price'], -remaining(order))
+        return order
+
+    def __adjust(self, side, price, change):
+        book_side = to_book_side(side)
+        if change == 0 or book_side is None:
+            return
+        levels = dict(self.quantities[book_side])
+        quantity = levels.get(price, ZERO) + change
+        if quantity > 0:
+            levels[price] = quantity
+        else:
+            levels.pop(price, None)
+        quantities = dict(self.quantities)
+        quantities[book_side] = MappingProxyType(levels)
+        self.quantities = quantities
+
+    @staticmethod
+    def __unindex(index, key, exchange_order_id):
+        orders = index.get(key)
+        if orders is not None:
+            orders.pop(exchange_order_id, None)
+            if len(orders) == 0:
+                del index[key]
@@ -0,0 +1,133 @@
+from bisect import bisect_left
+
+# Levels per chunk before a chunk is split in two. Applying a level copies one chunk, freezing copies one reference
+# per chunk, so this trades the cost of the first against the second
+CHUNK_SIZE = 128
+
+
+class _Levels(object):
+
+    def __init__(self, descending, chunks, maxes, size):
+        self.descending = descending
+        self.chunks = chunks
+        self.maxes = maxes
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, price):
+        return self.get(price) is not None
+
+    def get(self, price, default=None):
+        i = bisect_left(self.maxes, price)
+        if i == len(self.maxes):
+            return default
+        prices, quantities = self.chunks[i]
+        j = bisect_left(prices, price)
+        if prices[j] != price:
+            return default
+        return quantities[j]
+
+    def best(self):
+        top = self.top(1)
+        return top[0] if len(top) > 0 else None
+
+    def top(self, depth=None):
+        levels = []
+        if depth is not None and depth <= 0:
+            return levels
+
+        chunks = reversed(self.chunks) if self.descending else self.chunks
+        for prices, quantities in chunks:
+            if self.descending:
+                prices = reversed(prices)
+                quantities = reversed(quantities)
+            for price, quantity in zip(prices, quantities):
+                levels.append([price, quantity])
+                if len(levels) == depth:
+                    return levels
+
+        return levels
+
+
+class PriceLevels(_Levels):
+    """One side of an order book, kept sorted by price as levels are applied.
+
+    Levels are stored in sorted chunks of immutable tuples, found by bisecting the last price of each chunk. Applying
+    a level rebuilds only the chunk it falls in, reading the best N levels walks chunks from the best end, and
+    freeze() hands out a read-only copy by copying chunk references, not levels, so it stays cheap on deep books.
+    Bids are built with descending=True, which only changes the order levels are read back in.
+    """
+
+    def __init__(self, descending=False):
+        _Levels.__init__(self, descending, [], [], 0)
+
+    def set(self, price, quantity):
+        chunks = self.chunks
+        maxes = self.maxes
+        if len(maxes) == 0:
+            chunks.append(((price,), (quantity,)))
+            maxes.append(price)
+            self.size = 1
+            return
+
+        i = bisect_left(maxes, price)
+        if i == len(maxes):
+            i -= 1
+        prices, quantities = chunks[i]
+        j = bisect_left(prices, price)
+
+        if j < len(prices) and prices[j] == price:
+            chunks[i] = (prices, quantities[:j] + (quantity,) + quantities[j + 1:])
+            return
+
+        prices = prices[:j] + (price,) + prices[j:]
+        quantities = quantities[:j] + (quantity,) + quantities[j:]
+        self.size += 1
+
+        if len(prices) > 2 * CHUNK_SIZE:
+            chunks[i:i + 1] = [(prices[:CHUNK_SIZE], quantities[:CHUNK_SIZE]),
+                               (prices[CHUNK_SIZE:], quantities[CHUNK_SIZE:])]
+            maxes[i:i + 1] = [prices[CHUNK_SIZE - 1], prices[-1]]
+        else:
+            chunks[i] = (prices, quantities)
+            maxes[i] = prices[-1]
+
+    def remove(self, price):
+        i = bisect_left(self.maxes, price)
+        if i == len(self.maxes):
+            return
+        prices, quantities = self.chunks[i]
+        j = bisect_left(prices, price)
+        if prices[j] != price:
+            return
+
+        self.size -= 1
+        if len(prices) == 1:
+            del self.chunks[i]
+            del self.maxes[i]
+        else:
+            prices = prices[:j] + prices[j + 1:]
+            self.chunks[i] = (prices, quantities[:j] + quantities[j + 1:])
+            self.maxes[i] = prices[-1]
+
+    def clear(self):
+        self.chunks = []
+        self.maxes = []
+        self.size = 0
+
+    def rescale(self, price_factor, quantity_factor):
+        """Multiplies every price and quantity, e.g. when integer levels move to a finer increment. A positive
+        price_factor leaves the order unchanged"""
+        self.chunks = [(tuple(price * price_factor for price in prices),
+                        tuple(quantity * quantity_factor for quantity in quantities))
+                       for prices, quantities in self.chunks]
+        self.maxes = [price * price_factor for price in self.maxes]
+
+    def freeze(self):
+        return FrozenPriceLevels(self.descending, tuple(self.chunks), tuple(self.maxes), self.size)
+
+
+class FrozenPriceLevels(_Levels):
+    """A read-only copy of PriceLevels, safe to read from any thread while the original keeps changing."""
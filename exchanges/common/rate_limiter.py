@@ -0,0 +1,97 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Limits requests to rate_per_s on average while letting up to burst of them through at once.
+
+    The bucket holds up to burst tokens and refills at rate_per_s. acquire() takes tokens, and only waits when there
+    are not enough, for just as long as the refill takes. Safe to share between threads: waiters are served one at a
+    time, in turn, so a burst of callers spreads out at the rate rather than all waking at once.
+    """
+
+    def __init__(self, rate_per_s, burst, name='', clock=time.monotonic, sleep=time.sleep):
+        """
+        :param clock: seconds from any fixed point, and sleep to wait with. Given together, e.g. by tests
+        """
+        if rate_per_s <= 0 or burst < 1:
+            raise ValueError('rate_per_s must be positive and burst at least 1, got {} and {}'
+                             .format(rate_per_s, burst))
+        self.name = name
+        self.rate_per_s = float(rate_per_s)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_s = clock()
+        self.lock = threading.Lock()
+        # Held by the caller waiting for tokens, so the next one waits behind it
+        self.turn = threading.Lock()
+        self.acquired_count = 0
+        self.throttled_count = 0
+        self.throttled_s = 0.0
+
+    def acquire(self, tokens=1):
+        """
+        :return: seconds waited, 0 if the budget was not exhausted
+        """
+        with self.turn:
+            with self.lock:
+                wait_s = self.__take(tokens)
+            if wait_s <= 0:
+                return 0.0
+            self.sleep(wait_s)
+            with self.lock:
+                self.throttled_count += 1
+                self.throttled_s += wait_s
+            return wait_s
+
+    def get_stats(self):
+        with self.lock:
+            self.__refill()
+            return {'tokens': self.tokens,
+                    'acquired': self.acquired_count,
+                    'throttled': self.throttled_count,
+                    'throttled_s': self.throttled_s}
+
+    def collect(self):
+        """For metrics.MetricsRegistry.add_collector"""
+        stats = self.get_stats()
+        labels = {'bucket': self.name}
+        yield 'rate_limit_tokens', 'gauge', 'Requests that can be made now without waiting', labels, stats['tokens']
+        yield 'rate_limit_acquired_total', 'counter', 'Requests let through the rate limiter', labels, \
+            stats['acquired']
+        yield 'rate_limit_throttled_total', 'counter', 'Requests that had to wait for the rate limiter', labels, \
+            stats['throttled']
+        yield 'rate_limit_throttled_seconds_total', 'counter', 'Time spent waiting for the rate limiter', labels, \
+            stats['throttled_s']
+
+    def __take(self, tokens):
+        # Tokens are taken even when there are not enough yet, leaving the bucket in debt for the time returned,
+        # which the caller sleeps off before anyone else gets a turn
+        self.__refill()
+        self.tokens -= tokens
+        self.acquired_count += 1
+        return -self.tokens / self.rate_per_s if self.tokens < 0 else 0.0
+
+    def __refill(self):
+        now_s = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now_s - self.updated_s) * self.rate_per_s)
+        self.updated_s = now_s
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key, rate_per_s, burst, name=None):
+    """The TokenBucket shared by everything in the process limited under key, e.g. one per exchange and API key.
+    Created with rate_per_s and burst the first time the key is asked for
+
+    :param name: the bucket's name in metrics, the key by default. Give one when the key is a secret
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate_per_s, burst, name=name if name is not None else key)
+        return bucket
@@ -0,0 +1,193 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aj_sns.log_service import logger
+
+WORKERS = 4
+
+
+class Task(object):
+    """A function the Scheduler runs every period_s, see Scheduler.schedule."""
+
+    def __init__(self, scheduler, name, function, period_s, jitter_s):
+        self.scheduler = scheduler
+        self.name = name
+        self.function = function
+        self.period_s = period_s
+        self.jitter_s = jitter_s
+        # When the current period started, on time.monotonic so a step of the wall clock neither stalls nor bunches
+        # runs. Runs are due at slot_s plus jitter, and the next slot is period_s after this one however long the run
+        # took, so ticks do not drift
+        self.slot_s = None
+        self.running = False
+        self.cancelled = False
+        self.run_count = 0
+        self.skipped_count = 0
+        self.overrun_count = 0
+        self.failed_count = 0
+        self.last_duration_s = None
+        self.max_duration_s = 0.0
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def get_stats(self):
+        return {'period_s': self.period_s,
+                'runs': self.run_count,
+                'skipped': self.skipped_count,
+                'overruns': self.overrun_count,
+                'failed': self.failed_count,
+                'running': self.running,
+                'last_duration_s': self.last_duration_s,
+                'max_duration_s': self.max_duration_s}
+
+    def collect(self):
+        """For metrics.MetricsRegistry.add_collector"""
+        stats = self.get_stats()
+        labels = {'task': self.name}
+        for outcome in ('runs', 'skipped', 'overruns', 'failed'):
+            yield ('task_ticks_total', 'counter', 'Scheduled runs of a polling task by what became of them',
+                   dict(labels, outcome=outcome), stats[outcome])
+        if stats['last_duration_s'] is not None:
+            yield ('task_last_duration_seconds', 'gauge', 'How long the last run of a polling task took', labels,
+                   stats['last_duration_s'])
+
+
+class Scheduler(object):
+    """Runs periodic tasks, such as the polling of every REST-only exchange, on one timer thread and a bounded pool
+    of workers, instead of a new threading.Timer thread per tick per service.
+
+    A task that is still running when its next run is due skips that run rather than running twice at once or
+    queueing up behind itself. A run that took longer than its period is counted and logged as an overrun. Both show
+    in get_stats() and in Task.collect.
+
+        task = get_scheduler().schedule('cryptopia tick', service.on_tick, 5, jitter_s=0.5)
+        ...
+        task.cancel()
+    """
+
+    def __init__(self, workers=WORKERS, name='scheduler'):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.condition = threading.Condition()
+        # Heap of (due_s, sequence, task); sequence breaks ties so tasks themselves are never compared
+        self.queue = []
+        self.sequence = itertools.count()
+        self.tasks = set()
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, name, function, period_s, jitter_s=0.0, first_run_s=None):
+        """
+        :param name: used in logs and stats
+        :param function: called with no arguments, on a worker thread. Exceptions are logged and counted
+        :param period_s: time from the start of one period to the start of the next
+        :param jitter_s: each run starts up to this much after its slot, at random, so services polling at the same
+                         period do not all hit the network at the same moment
+        :param first_run_s: delay before the first period starts, period_s by default
+        :return: the Task, whose cancel() stops it
+        """
+        if period_s <= 0:
+            raise ValueError('period_s must be positive, got {}'.format(period_s))
+        task = Task(self, name, function, period_s, jitter_s)
+        with self.condition:
+            self.tasks.add(task)
+            task.slot_s = time.monotonic() + (period_s if first_run_s is None else first_run_s)
+            self.__push(task)
+        return task
+
+    def cancel(self, task):
+        """Stops a task. A run already started finishes"""
+        with self.condition:
+            task.cancelled = True
+            self.tasks.discard(task)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            for task in self.tasks:
+                task.cancelled = True
+            self.tasks = set()
+            self.condition.notify()
+        self.executor.shutdown(wait=False)
+
+    def get_stats(self):
+        with self.condition:
+            return {task.name: task.get_stats() for task in self.tasks}
+
+    def __push(self, task):
+        jitter_s = random.uniform(0, task.jitter_s) if task.jitter_s > 0 else 0.0
+        heapq.heappush(self.queue, (task.slot_s + jitter_s, next(self.sequence), task))
+        self.condition.notify()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    if len(self.queue) > 0 and self.queue[0][2].cancelled:
+                        heapq.heappop(self.queue)
+                        continue
+                    wait_s = self.queue[0][0] - time.monotonic() if len(self.queue) > 0 else None
+                    if wait_s is not None and wait_s <= 0:
+                        break
+                    self.condition.wait(wait_s)
+                if not self.running:
+                    return
+
+                _, _, task = heapq.heappop(self.queue)
+                if task.running:
+                    task.skipped_count += 1
+                    logger().warning('{} is still running, skipping its next run'.format(task.name))
+                else:
+                    task.running = True
+                    self.executor.submit(self.__run_task, task)
+
+                # The next slot after now. Slots missed while the timer thread was late are skipped, not caught up
+                now_s = time.monotonic()
+                task.slot_s += task.period_s
+                if task.slot_s <= now_s:
+                    task.slot_s += ((now_s - task.slot_s) // task.period_s + 1) * task.period_s
+                self.__push(task)
+
+    def __run_task(self, task):
+        started_s = time.monotonic()
+        failed = False
+        try:
+            task.function()
+        except Exception as e:
+            failed = True
+            logger().error('{} failed with error: {}'.format(task.name, e))
+        finally:
+            duration_s = time.monotonic() - started_s
+            # Counted together, so stats never show a run as failed before it is counted as run
+            with self.condition:
+                task.running = False
+                task.run_count += 1
+                if failed:
+                    task.failed_count += 1
+                task.last_duration_s = duration_s
+                task.max_duration_s = max(task.max_duration_s, duration_s)
+                if duration_s > task.period_s:
+                    task.overrun_count += 1
+                    logger().warning('{} took {:.3f}s, longer than its {}s period'
+                                     .format(task.name, duration_s, task.period_s))
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """The scheduler shared by every service in the process, started on first use"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
@@ -0,0 +1,44 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from aj_sns.log_service import logger
+
+TIMEOUT_S = 60
+
+
+def warm_up(services, timeout_s=TIMEOUT_S):
+    """Calls warm_up() on every service at once, each on its own thread, so startup waits on the slowest exchange
+    rather than on all of them one after the other. A service that fails or times out is logged and left to fetch
+    its metadata on first use, as it would have without warming up.
+
+    :return: {service name: seconds its warm up took, or None if it failed or did not finish in timeout_s}
+    """
+    if len(services) == 0:
+        return {}
+
+    def timed_warm_up(service):
+        started = time.time()
+        service.warm_up()
+        return time.time() - started
+
+    executor = ThreadPoolExecutor(max_workers=len(services))
+    try:
+        futures = {executor.submit(timed_warm_up, service): service for service in services}
+        wait(futures, timeout=timeout_s)
+
+        durations = {}
+        for future, service in futures.items():
+            if not future.done():
+                logger().warning('Warming up {} took longer than {}s, continuing without it'
+                                 .format(service.name, timeout_s))
+                durations[service.name] = None
+            elif future.exception() is not None:
+                logger().error('Failed to warm up {}. Exception was: {}'.format(service.name, future.exception()))
+                durations[service.name] = None
+            else:
+                durations[service.name] = future.result()
+                logger().info('Warmed up {} in {:.3f}s'.format(service.name, durations[service.name]))
+        return durations
+    finally:
+        # Does not wait for a service still warming up, it finishes in the background
+        executor.shutdown(wait=False)
@@ -1,4 +1,3 @@
-import threading
 import traceback
 from _decimal import Decimal
 
@@ -8,34 +7,47 @@ import sys
 from aj_sns.creds_retriever import get_creds
 from aj_sns.log_service import logger
 
+from exchanges.common.async_http import get_async_http
+from exchanges.common.events import BalanceEvent, BookEvent, ExecutionEvent, LifecycleEvent
+from exchanges.common.metrics import ReceiveTime
+from exchanges.common.order_store import OrderStore
+from exchanges.common.scheduler import get_scheduler
 from exchanges.exchange import Exchange
-from exchanges.cryptopia.api import Api
+from exchanges.cryptopia.api import Api, chunk_markets
 
 class CryptopiaService(Exchange):
 
     def __init__(self, name, public_key, private_key, poll_time_s=5, tick_tock=True):
         Exchange.__init__(self, name)
-        self.open_orders_by_exchange_id = {}
-        self.external_to_internal_id = {}
-        self.internal_to_external_id = {}
+        self.orders = OrderStore()
         self.poll_time_s = poll_time_s
         self.tick_tock = True
         self.markets_following = {}
-        self.client = Api(public_key, private_key)
-        self.open_orders = []
+        self.http = get_async_http()
+        self.client = Api(public_key, private_key, metrics=self.metrics, http=self.http)
 
+        # Polled by the scheduler shared with the other services, see common.scheduler
+        self.tick_task = None
         if tick_tock is True:
-            threading.Timer(self.poll_time_s, self.on_tick).start()
+            self.tick_task = get_scheduler().schedule('{} tick'.format(name), self.on_tick, self.poll_time_s,
+                                                      jitter_s=self.poll_time_s / 10.0)
+            self.metrics.add_collector(self.tick_task.collect)
 
     def get_order_book(self, base, quote):
         market = base + '_' + quote
-        response = self.client.get_orders(market)
-        response = response[0]
-        book = {'bids': [], 'asks': []}
+        with self.metrics.rest_call('get_orders'):
+            response = self.client.get_orders(market)
+        return self._to_book(base, quote, response[0], ReceiveTime())
 
-        for bid in response['Buy']:
+    def _to_book(self, base, quote, orders, receive_time):
+        """
+        :param orders: the Buy and Sell orders of one market, from GetMarketOrders or GetMarketOrderGroups
+        """
+        book = BookEvent(bids=[], asks=[], receive_time=receive_time)
+
+        for bid in orders['Buy']:
             book['bids'].append([Decimal(str(bid['Price'])), Decimal(str(bid['Volume']))])
-        for ask in response['Sell']:
+        for ask in orders['Sell']:
             book['asks'].append([Decimal(str(ask['Price'])), Decimal(str(ask['Volume']))])
 
         book['base'] = base
@@ -56,104 +68,143 @@ class CryptopiaService(Exchange):
         try:
             logger().info('tick')
             if len(self.callbacks) > 0 and len(self.markets_following) > 0:
-                for market in self.markets_following.copy().values():
-                    base = market['base']
-                    quote = market['quote']
-                    self._send_executions_to_cb(base, quote)
-                    self._send_order_book_to_cb(base, quote)
+                self._poll_markets(list(self.markets_following.values()))
             else:
                 logger().info('Not following any markets')
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
             logger().error('on_tick failed with error: ' + str(e))
+            self.metrics.counter('errors_total', 'Failures caught and logged', where='on_tick').inc()
 
         logger().info('tock')
 
-        threading.Timer(self.poll_time_s, self.on_tick).start()
+    def _poll_markets(self, markets):
+        """Requests the open orders of every market we have orders in, and the books of every market in as few
+        GetMarketOrderGroups requests as chunk_markets allows, all at once, so a tick takes about one round trip
+        however many markets are followed. Then handles the responses market by market, executions first
+        """
+        requests = []
+        for market in markets:
+            base, quote = market['base'], market['quote']
+            open_orders = self.orders.get_market(base, quote)
+            if len(open_orders) > 0:
+                requests.append(('executions', [(base, quote)], open_orders,
+                                 self._timed('get_openorders', self.client.get_openorders_async(base + '/' + quote))))
+        by_name = {market['base'] + '_' + market['quote']: (market['base'], market['quote']) for market in markets}
+        for chunk in chunk_markets(list(by_name.keys())):
+            requests.append(('order_books', [by_name[name] for name in chunk], None,
+                             self._timed('get_ordergroups', self.client.get_ordergroups_async('-'.join(chunk)))))
+
+        responses = self.http.run_all([request[3] for request in requests])
+        for (kind, pairs, open_orders, _), response in zip(requests, responses):
+            try:
+                if isinstance(response, Exception):
+                    raise response
+                result, receive_time = response
+                if result[1] is not None:
+                    raise IOError(result[1])
+                if kind == 'executions':
+                    base, quote = pairs[0]
+                    self._apply_open_orders(base, quote, open_orders, result[0], receive_time)
+                else:
+                    self._send_order_groups_to_cb(pairs, result[0], receive_time)
+            except Exception as e:
+                logger().error('Polling {} of {} failed with error: {}'
+                               .format(kind, ', '.join('/'.join(pair) for pair in pairs), e))
+                self.metrics.counter('errors_total', 'Failures caught and logged', where='on_tick').inc()
+
+    def _send_order_groups_to_cb(self, pairs, order_groups, receive_time):
+        """Fans the books of one GetMarketOrderGroups response out to an order_book callback per market"""
+        groups_by_name = {group['Market']: group for group in order_groups if 'Market' in group}
+        for i, (base, quote) in enumerate(pairs):
+            group = groups_by_name.get(base + '_' + quote)
+            if group is None and len(groups_by_name) == 0 and i < len(order_groups):
+                # Not named: the groups come back in the order the markets were asked for
+                group = order_groups[i]
+            if group is None:
+                logger().warning('No book for {}/{} in GetMarketOrderGroups response'.format(base, quote))
+                continue
+            self.notify_callbacks('order_book', data=self._to_book(base, quote, group, receive_time))
+
+    async def _timed(self, endpoint, request):
+        with self.metrics.rest_call(endpoint):
+            result = await request
+        return result, ReceiveTime()
 
     def _send_executions_to_cb(self, base, quote):
-        if len(self.open_orders_by_exchange_id) == 0:
+        open_orders = self.orders.get_market(base, quote)
+        if len(open_orders) == 0:
             return
 
         market = base + '/' + quote
-        exchange_orders, error = self.client.get_openorders(market)
-        unmatched_orders = {}
+        with self.metrics.rest_call('get_openorders'):
+            exchange_orders, error = self.client.get_openorders(market)
+        self._apply_open_orders(base, quote, open_orders, exchange_orders, ReceiveTime())
 
-        for exchange_id in self.open_orders_by_exchange_id.keys():
-            unmatched_orders[exchange_id] = True
+    def _apply_open_orders(self, base, quote, open_orders, exchange_orders, receive_time):
+        unmatched_orders = {order['exchange_order_id']: order for order in open_orders}
 
         for exchange_order in exchange_orders:
             exchange_id = str(exchange_order['OrderId'])
-            if exchange_id in self.open_orders_by_exchange_id:
-                unmatched_orders.pop(exchange_id, None)
-                open_order = self.open_orders_by_exchange_id[exchange_id]
-
+            if unmatched_orders.pop(exchange_id, None) is not None:
                 exchange_executed = Decimal(str(exchange_order['Amount'])) - Decimal(str(exchange_order['Remaining']))
-                internal_executed = Decimal(str(open_order['cum_quantity_filled']))
-                newly_executed_amount = exchange_executed - internal_executed
-
-                if newly_executed_amount > Decimal(0):
-                    open_order['cum_quantity_filled'] = Decimal(str(open_order['cum_quantity_filled'])) + \
-                                                        newly_executed_amount
-
-                    message = {
-                        'action': 'EXECUTION',
-                        'exchange': self.name,
-                        'base': base,
-                        'quote': quote,
-                        'exchange_order_id': str(open_order['exchange_order_id']),
-                        'internal_order_id': str(open_order['internal_order_id']),
-                        'side': open_order['side'],
-                        'quantity': open_order['quantity'],
-                        'price': open_order['price'],
-                        'cum_quantity_filled': open_order['cum_quantity_filled'],
-                        'order_status': 'PARTIALLY_FILLED',
-                        'server_ms': int(round(time.time() * 1000)),
-                        'received_ms': int(round(time.time() * 1000)),
-                        'last_executed_quantity': newly_executed_amount,
-                        'last_executed_price': open_order['price'],
-                        'fee_base': Decimal('0'),
-                        'fee_quote': Decimal('0'),
-                        'trade_id': '-1'
-                    }
+                open_order, newly_executed_amount = self.orders.fill(exchange_id, exchange_executed)
+
+                if open_order is not None and newly_executed_amount > Decimal(0):
+                    message = ExecutionEvent(
+                        action='EXECUTION',
+                        exchange=self.name,
+                        base=base,
+                        quote=quote,
+                        exchange_order_id=str(open_order['exchange_order_id']),
+                        internal_order_id=str(open_order['internal_order_id']),
+                        side=open_order['side'],
+                        quantity=open_order['quantity'],
+                        price=open_order['price'],
+                        cum_quantity_filled=open_order['cum_quantity_filled'],
+                        order_status='PARTIALLY_FILLED',
+                        server_ms=None,
+                        receive_time=receive_time,
+                        last_executed_quantity=newly_executed_amount,
+                        last_executed_price=open_order['price'],
+                        fee_base=Decimal('0'),
+                        fee_quote=Decimal('0'),
+                        trade_id='-1'
+                    )
 
                     self.notify_callbacks('trade_lifecycle', trade_lifecycle_type=message['action'], data=message)
 
         # If it's unmatched, the exchange has it closed and us open, so it must've been filled
         five_seconds_ago_in_ms = (time.time() - 5) * 1000
 
-        for unmatched_order_exchange_id in unmatched_orders.keys():
-            open_order = self.open_orders_by_exchange_id[unmatched_order_exchange_id]
-            if open_order['received_ms'] < five_seconds_ago_in_ms and \
-                            market == open_order['base'] + '/' + open_order['quote']:
-                newly_executed_amount = Decimal(str(open_order['quantity'])) - \
-                                        Decimal(str(open_order['cum_quantity_filled']))
-                open_order['cum_quantity_filled'] = Decimal(str(open_order['quantity']))
-
-                message = {
-                    'action': 'EXECUTION',
-                    'exchange': self.name,
-                    'base': base,
-                    'quote': quote,
-                    'exchange_order_id': str(open_order['exchange_order_id']),
-                    'internal_order_id': str(open_order['internal_order_id']),
-                    'side': open_order['side'],
-                    'quantity': open_order['quantity'],
-                    'price': open_order['price'],
-                    'cum_quantity_filled': open_order['cum_quantity_filled'],
-                    'order_status': 'FILLED',
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000)),
-                    'last_executed_quantity': newly_executed_amount,
-                    'last_executed_price': open_order['price'],
-                    'fee_base': Decimal('0'),
-                    'fee_quote': Decimal('0'),
-                    'trade_id': '-1'
-                }
-
-                self.internal_to_external_id.pop(str(open_order['internal_order_id']), None)
-                self.external_to_internal_id.pop(str(open_order['exchange_order_id']), None)
-                self.open_orders_by_exchange_id.pop(str(str(open_order['exchange_order_id'])), None)
+        for unmatched_order_exchange_id, unmatched_order in unmatched_orders.items():
+            if unmatched_order['received_ms'] < five_seconds_ago_in_ms:
+                open_order, newly_executed_amount = self.orders.fill(unmatched_order_exchange_id,
+                                                                     unmatched_order['quantity'], done=True)
+                if open_order is None:
+                    # Canceled meanwhile
+                    continue
+
+                message = ExecutionEvent(
+                    action='EXECUTION',
+                    exchange=self.name,
+                    base=base,
+                    quote=quote,
+                    exchange_order_id=str(open_order['exchange_order_id']),
+                    internal_order_id=str(open_order['internal_order_id']),
+                    side=open_order['side'],
+                    quantity=open_order['quantity'],
+                    price=open_order['price'],
+                    cum_quantity_filled=open_order['cum_quantity_filled'],
+                    order_status='FILLED',
+                    server_ms=None,
+                    receive_time=receive_time,
+                    last_executed_quantity=newly_executed_amount,
+                    last_executed_price=open_order['price'],
+                    fee_base=Decimal('0'),
+                    fee_quote=Decimal('0'),
+                    trade_id='-1'
+                )
 
                 self.notify_callbacks('trade_lifecycle', trade_lifecycle_type=message['action'], data=message)
 
@@ -172,11 +223,7 @@ class CryptopiaService(Exchange):
             free = Decimal(str(balance['Available']))
             locked = Decimal(str(balance['HeldForTrades']))
             if free + locked > Decimal('0'):
-                internal_balances_format.append({
-                    'asset': balance['Symbol'],
-                    'free': free,
-                    'locked': locked
-                })
+                internal_balances_format.append(BalanceEvent(asset=balance['Symbol'], free=free, locked=locked))
 
         self.notify_callbacks('account', account_type='balance', data=internal_balances_format)
 
@@ -188,43 +235,40 @@ class CryptopiaService(Exchange):
         response, error = self.client.submit_trade(market, side, str(price), str(quantity))
 
         if error is not None:
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CREATE_FAILED',
-                'reason': 'Unknown exception type',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'internal_order_id': str(internal_order_id),
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'received_ms': int(round(time.time() * 1000))
-            })
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CREATE_FAILED',
+                reason='Unknown exception type',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                internal_order_id=str(internal_order_id),
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                receive_time=ReceiveTime()
+            ))
             logger().error('Failed to create cryptopia order with error: {}'.format(str(error)))
             return
 
         exchange_order_id = response['OrderId']
 
-        self.internal_to_external_id[str(internal_order_id)] = str(exchange_order_id)
-        self.external_to_internal_id[str(exchange_order_id)] = str(internal_order_id)
-
-        internal_response = {
-            'action': 'CREATED',
-            'exchange': self.name,
-            'base': base,
-            'quote': quote,
-            'exchange_order_id': str(exchange_order_id),
-            'internal_order_id': str(internal_order_id),
-            'side': side,
-            'quantity': Decimal(str(quantity)),
-            'price': Decimal(str(price)),
-            'cum_quantity_filled': Decimal('0'),
-            'order_status': 'OPEN',
-            'server_ms': int(round(time.time() * 1000)),
-            'received_ms': int(round(time.time() * 1000))
-        }
-        self.open_orders_by_exchange_id[str(exchange_order_id)] = internal_response
+        internal_response = LifecycleEvent(
+            action='CREATED',
+            exchange=self.name,
+            base=base,
+            quote=quote,
+            exchange_order_id=str(exchange_order_id),
+            internal_order_id=str(internal_order_id),
+            side=side,
+            quantity=Decimal(str(quantity)),
+            price=Decimal(str(price)),
+            cum_quantity_filled=Decimal('0'),
+            order_status='OPEN',
+            server_ms=None,
+            receive_time=ReceiveTime()
+        )
+        self.orders.add(internal_response)
         self.notify_callbacks('trade_lifecycle', data=internal_response)
 
     def cancel_order(self, base, quote, internal_order_id, request_id, requester_id=None, exchange_order_id=None):
@@ -232,18 +276,18 @@ class CryptopiaService(Exchange):
             if exchange_order_id is None:
                 exchange_order_id = self.get_exchange_id(internal_order_id)
         except LookupError:
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CANCEL_FAILED',
-                'reason': 'order_not_found',
-                'base': base,
-                'quote': quote,
-                'exchange': self.name,
-                'exchange_order_id': str(exchange_order_id),
-                'internal_order_id': str(internal_order_id),
-                'order_status': 'UNKNOWN',
-                'server_ms': int(round(time.time() * 1000)),
-                'received_ms': int(round(time.time() * 1000))
-            })
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CANCEL_FAILED',
+                reason='order_not_found',
+                base=base,
+                quote=quote,
+                exchange=self.name,
+                exchange_order_id=str(exchange_order_id),
+                internal_order_id=str(internal_order_id),
+                order_status='UNKNOWN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            ))
             return
 
         resp, error = self.client.cancel_trade('Trade', exchange_order_id, None)
@@ -253,46 +297,43 @@ class CryptopiaService(Exchange):
             reason = str(error)
             if error == 'No matching trades found':
                 reason = 'order_not_found'
-                self.internal_to_external_id.pop(str(internal_order_id), None)
-                self.external_to_internal_id.pop(str(exchange_order_id), None)
-                self.open_orders_by_exchange_id.pop(str(exchange_order_id), None)
-
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CANCEL_FAILED',
-                'reason': reason,
-                'base': base,
-                'quote': quote,
-                'exchange': self.name,
-                'exchange_order_id': str(exchange_order_id),
-                'internal_order_id': str(internal_order_id),
-                'order_status': 'UNKNOWN',
-                'server_ms': int(round(time.time() * 1000)),
-                'received_ms': int(round(time.time() * 1000))
-            })
+                self.orders.remove(str(exchange_order_id), str(internal_order_id))
+
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CANCEL_FAILED',
+                reason=reason,
+                base=base,
+                quote=quote,
+                exchange=self.name,
+                exchange_order_id=str(exchange_order_id),
+                internal_order_id=str(internal_order_id),
+                order_status='UNKNOWN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            ))
 
             return
 
-        self.internal_to_external_id.pop(str(internal_order_id), None)
-        self.external_to_internal_id.pop(str(exchange_order_id), None)
-        self.open_orders_by_exchange_id.pop(str(exchange_order_id), None)
+        self.orders.remove(str(exchange_order_id), str(internal_order_id))
 
         time.sleep(2)
 
-        self.notify_callbacks('trade_lifecycle', data={
-            'action': 'CANCELED',
-            'exchange': self.name,
-            'base': base,
-            'quote': quote,
-            'exchange_order_id': str(exchange_order_id),
-            'internal_order_id': str(internal_order_id),
-            'order_status': 'CANCELED',
-            'server_ms': int(round(time.time() * 1000)),
-            'received_ms': int(round(time.time() * 1000))
-        })
+        self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+            action='CANCELED',
+            exchange=self.name,
+            base=base,
+            quote=quote,
+            exchange_order_id=str(exchange_order_id),
+            internal_order_id=str(internal_order_id),
+            order_status='CANCELED',
+            server_ms=None,
+            receive_time=ReceiveTime()
+        ))
 
     def get_exchange_id(self, internal_id):
-        if internal_id in self.internal_to_external_id:
-            return self.internal_to_external_id[internal_id]
+        exchange_id = self.orders.get_exchange_id(internal_id)
+        if exchange_id is not None:
+            return exchange_id
 
         raise LookupError('Could not find open order with internal id: {}'.format(internal_id))
 
@@ -303,10 +344,7 @@ class CryptopiaService(Exchange):
             try:
                 exchange_order_id = str(exchange_order['OrderId'])
                 resp, error = self.client.cancel_trade('Trade', exchange_order_id, None)
-                if exchange_order_id in self.open_orders_by_exchange_id:
-                    self.open_orders_by_exchange_id.pop(exchange_order_id, None)
-                    internal_id = self.external_to_internal_id.pop(exchange_order, None)
-                    self.internal_to_external_id.pop(internal_id, None)
+                self.orders.remove(exchange_order_id)
                 if error is not None:
                     raise Exception('Failed to cancel order with reason: {}'.format(str(error)))
             except Exception as e:
@@ -341,27 +379,7 @@ class CryptopiaService(Exchange):
         return trade_history
 
     def get_open_orders_by_side_and_price(self):
-        open_orders_by_side_and_price = {'bids': {}, 'asks': {}}
-
-        for order in self.open_orders_by_exchange_id.values():
-            if order['side'] == 'buy':
-                if Decimal(order['price']) in open_orders_by_side_and_price['bids']:
-                    open_orders_by_side_and_price['bids'][Decimal(order['price'])] \
-                        = open_orders_by_side_and_price['bids'][order['price']] + \
-                          order['quantity'] - order['cum_quantity_filled']
-                else:
-                    open_orders_by_side_and_price['bids'][Decimal(order['price'])] = order['quantity'] - \
-                                                                                     order['cum_quantity_filled']
-            elif order['side'] == 'sell':
-                if Decimal(order['price']) in open_orders_by_side_and_price['asks']:
-                    open_orders_by_side_and_price['asks'][Decimal(order['price'])] \
-                        = open_orders_by_side_and_price['asks'][order['price']] + \
-                          order['quantity'] - order['cum_quantity_filled']
-                else:
-                    open_orders_by_side_and_price['asks'][Decimal(order['price'])] = order['quantity'] - \
-                                                                                     order['cum_quantity_filled']
-
-        return open_orders_by_side_and_price
+        return self.orders.get_quantities_by_price()
 
 
 if __name__ == '__main__':
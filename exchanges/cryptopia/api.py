@@ -4,15 +4,44 @@ import hmac
 import hashlib
 import base64
 import requests
+from requests.adapters import HTTPAdapter
+
+from exchanges.common.async_http import get_async_http
+from exchanges.common.rate_limiter import get_bucket
 
 # using requests.compat to wrap urlparse
-from requests.compat import quote_plus
+from requests.compat import quote_plus, urlencode
+
+API_URL = "https://www.cryptopia.co.nz/Api/"
+# Requests per second on average, and at once, per API key. Replaces a sleep of a second before every request
+RATE_PER_S = 4
+BURST = 8
+POOL_SIZE = 4
+# Longest URL to send. Servers and proxies commonly refuse longer ones
+MAX_URL_LENGTH = 2000
+# Most markets asked for in one GetMarketOrderGroups request, so a failed request loses few books
+MAX_MARKETS_PER_REQUEST = 50
+
 
 class Api(object):
 
-    def __init__(self, key, secret):
+    def __init__(self, key, secret, rate_per_s=RATE_PER_S, burst=BURST, metrics=None, http=None):
+        """
+        :param rate_per_s: requests per second allowed on average, shared by every Api in the process with this key
+        :param burst: requests allowed at once after a quiet spell
+        :param metrics: a common.metrics.MetricsRegistry to export the rate limiter's throttling to
+        :param http: the common.async_http.AsyncHttpClient the *_async calls use, the shared one by default
+        """
         self.key = key
         self.secret = secret
+        key_hash = hashlib.sha256((key or '').encode('utf-8')).hexdigest()[:8]
+        self.rate_limiter = get_bucket('cryptopia:' + key_hash, rate_per_s, burst, name='cryptopia_' + key_hash)
+        if metrics is not None:
+            metrics.add_collector(self.rate_limiter.collect)
+        # Keep-alive connections, reused across requests
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+        self.http = http
         self.public = ['GetCurrencies', 'GetTradePairs', 'GetMarkets',
                        'GetMarket', 'GetMarketHistory', 'GetMarketOrders', 'GetMarketOrderGroups']
         self.private = ['GetBalance', 'GetDepositAddress', 'GetOpenOrders',
@@ -20,47 +49,72 @@ class Api(object):
                         'CancelTrade', 'SubmitTip', 'SubmitWithdraw', 'SubmitTransfer']
 
     def api_query(self, feature_requested, get_parameters=None, post_parameters=None):
-        time.sleep(1)
         if feature_requested in self.private:
-            url = "https://www.cryptopia.co.nz/Api/" + feature_requested
+            url = API_URL + feature_requested
             post_data = json.dumps(post_parameters)
+            self.rate_limiter.acquire()
+            # Signed after waiting, so the nonce is fresh
             headers = self.secure_headers(url=url, post_data=post_data)
-            req = requests.post(url, data=post_data, headers=headers)
+            req = self.session.post(url, data=post_data, headers=headers)
             if req.status_code != 200:
                 try:
                     req.raise_for_status()
                 except requests.exceptions.RequestException as ex:
                     return None, "Status Code : " + str(ex)
             req.encoding = "utf-8-sig"
-            req = req.json()
-            if 'Success' in req and req['Success'] is True:
-                result = req['Data']
-                error = None
-            else:
-                result = None
-                error = req['Error'] if 'Error' in req else 'Unknown Error'
-            return (result, error)
+            return Api.unwrap(req.json())
         elif feature_requested in self.public:
-            url = "https://www.cryptopia.co.nz/Api/" + feature_requested + "/" + \
-                  ('/'.join(i for i in get_parameters.values()
-                            ) if get_parameters is not None else "")
-            req = requests.get(url, params=get_parameters)
+            url = Api.public_url(feature_requested, get_parameters)
+            self.rate_limiter.acquire()
+            req = self.session.get(url, params=get_parameters)
             if req.status_code != 200:
                 try:
                     req.raise_for_status()
                 except requests.exceptions.RequestException as ex:
                     return None, "Status Code : " + str(ex)
-            req = req.json()
-            if 'Success' in req and req['Success'] is True:
-                result = req['Data']
-                error = None
-            else:
-                result = None
-                error = req['Error'] if 'Error' in req else 'Unknown Error'
-            return (result, error)
+            return Api.unwrap(req.json())
+        else:
+            return None, "Unknown feature"
+
+    async def api_query_async(self, feature_requested, get_parameters=None, post_parameters=None):
+        """api_query as a coroutine, for common.async_http to run alongside other requests"""
+        http = self.http if self.http is not None else get_async_http()
+        if feature_requested in self.private:
+            url = API_URL + feature_requested
+            post_data = json.dumps(post_parameters)
+            await http.in_thread(self.rate_limiter.acquire)
+            headers = self.secure_headers(url=url, post_data=post_data)
+            response = await http.request('POST', url, data=post_data, headers=headers)
+        elif feature_requested in self.public:
+            url = Api.public_url(feature_requested, get_parameters)
+            await http.in_thread(self.rate_limiter.acquire)
+            response = await http.request('GET', url, params=get_parameters)
         else:
             return None, "Unknown feature"
 
+        if response.status_code != 200:
+            return None, "Status Code : {} for url: {}".format(response.status_code, response.url)
+        return Api.unwrap(response.json())
+
+    @staticmethod
+    def public_url(feature_requested, get_parameters):
+        return API_URL + feature_requested + "/" + \
+            ('/'.join(i for i in get_parameters.values()) if get_parameters is not None else "")
+
+    @staticmethod
+    def public_url_length(feature_requested, get_parameters):
+        # api_query sends the parameters in the path and again in the query string
+        return len(Api.public_url(feature_requested, get_parameters)) + 1 + len(urlencode(get_parameters))
+
+    @staticmethod
+    def unwrap(response):
+        """
+        :return: (result, error) from a response's JSON
+        """
+        if 'Success' in response and response['Success'] is True:
+            return response['Data'], None
+        return None, response['Error'] if 'Error' in response else 'Unknown Error'
+
     def get_currencies(self):
         return self.api_query(feature_requested='GetCurrencies')
 
@@ -84,11 +138,20 @@ class Api(object):
         return self.api_query(feature_requested='GetMarketOrders',
                               get_parameters={'market': market})
 
+    async def get_orders_async(self, market):
+        return await self.api_query_async(feature_requested='GetMarketOrders',
+                                          get_parameters={'market': market})
+
     def get_ordergroups(self, markets):
         """ Gets the order groups for the specified market """
         return self.api_query(feature_requested='GetMarketOrderGroups',
                               get_parameters={'markets': markets})
 
+    async def get_ordergroups_async(self, markets):
+        """ Gets the books of several markets, e.g. 'DOT_BTC-GRS_BTC', in one request. See chunk_markets """
+        return await self.api_query_async(feature_requested='GetMarketOrderGroups',
+                                          get_parameters={'markets': markets})
+
     def get_balance(self, currency=None):
 
         post_parameters = {'Currency': currency} if currency is not None else {}
@@ -104,6 +167,10 @@ class Api(object):
         return self.api_query(feature_requested='GetOpenOrders',
                               post_parameters={'Market': market})
 
+    async def get_openorders_async(self, market):
+        return await self.api_query_async(feature_requested='GetOpenOrders',
+                                          post_parameters={'Market': market})
+
     def get_deposit_address(self, currency):
         return self.api_query(feature_requested='GetDepositAddress',
                               post_parameters={'Currency': currency})
@@ -161,4 +228,23 @@ class Api(object):
                                                   signature.encode('utf-8'),
                                                   hashlib.sha256).digest())
         header_value = "amx " + self.key + ":" + hmacsignature.decode('utf-8') + ":" + nonce
-        return {'Authorization': header_value, 'Content-Type': 'application/json; charset=utf-8'}
\ No newline at end of file
+        return {'Authorization': header_value, 'Content-Type': 'application/json; charset=utf-8'}
+
+
+def chunk_markets(markets, max_url_length=MAX_URL_LENGTH, max_markets=MAX_MARKETS_PER_REQUEST):
+    """Splits market names (e.g. 'DOT_BTC') into as few GetMarketOrderGroups requests as keep every URL within
+    max_url_length and every request within max_markets. A market too long to share a URL gets one to itself
+
+    :return: [[market]], in the order given
+    """
+    chunks = []
+    chunk = []
+    for market in markets:
+        length = Api.public_url_length('GetMarketOrderGroups', {'markets': '-'.join(chunk + [market])})
+        if len(chunk) > 0 and (length > max_url_length or len(chunk) >= max_markets):
+            chunks.append(chunk)
+            chunk = []
+        chunk.append(market)
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
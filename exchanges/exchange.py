@@ -3,7 +3,9 @@ from _decimal import Decimal
 from abc import abstractmethod
 
 from aj_sns.transfer_service import TransferService
-from pandas import DataFrame, concat, to_numeric
+
+from exchanges.common.dispatcher import Dispatcher, QUEUE_SIZE
+from exchanges.common.metrics import LatencyHistograms, MetricsRegistry
 
 
 class Exchange(TransferService):
@@ -11,21 +13,62 @@ class Exchange(TransferService):
     def __init__(self, name):
         super().__init__()
         self.callbacks = {}
+        self.latencies = LatencyHistograms(name)
+        self.metrics = MetricsRegistry(name)
+        self.dispatcher = Dispatcher(self.latencies, self.metrics)
+        self.metrics.add_collector(self.latencies.collect)
+        self.metrics.add_collector(self.dispatcher.collect)
         self.name = name
 
     def notify_callbacks(self, topic, **data):
-        for f in self.callbacks.values():
-            f(topic, **data)
-
-    def add_callback(self, name, callback):
+        # Only queues the message for each callback, see common.dispatcher
+        self.dispatcher.dispatch(topic, **data)
+
+    def add_callback(self, name, callback, topics=None, markets=None, queue_size=QUEUE_SIZE, policies=None):
+        """
+        :param topics: topics to receive, e.g. ['trade_lifecycle', 'account']. All of them by default
+        :param markets: (base, quote) pairs to receive messages of, e.g. [('ETH', 'BTC')]. All of them by default.
+                        Messages that are not about one market, like balances, are always received
+        :param queue_size: messages queued for this callback before its overflow policy applies
+        :param policies: overflow policy per topic, overriding dispatcher.DEFAULT_POLICIES. E.g. {'order_book': 'block'}
+        """
+        self.dispatcher.add(name, callback, queue_size, policies, topics, markets)
         self.callbacks[name] = callback
 
     def remove_callback(self, name):
+        self.dispatcher.remove(name)
         del self.callbacks[name]
 
     def remove_all_callbacks(self):
+        self.dispatcher.remove_all()
         self.callbacks = {}
 
+    def get_dispatch_stats(self):
+        """
+        :return: {callback name: {'queue_depth', 'max_queue_depth', 'delivered', 'dropped', 'conflated', ...}}
+        """
+        return self.dispatcher.get_stats()
+
+    def get_latency_stats(self):
+        """
+        :return: latency histograms per topic and stage, in ms. See common.metrics.STAGES
+        """
+        return self.latencies.get_stats()
+
+    def get_metrics(self):
+        """
+        :return: every counter, gauge and histogram of this exchange, see common.metrics.MetricsRegistry.get_metrics.
+                 common.metrics_server serves them to Prometheus
+        """
+        return self.metrics.get_metrics()
+
+    def warm_up(self):
+        """Fetches the metadata the exchange needs before its first order (symbols, increments, addresses), so the
+        first order does not wait on it. Nothing to fetch by default. common.warm_up calls this for several services
+        at once
+        """
+        pass
+
     def can_withdraw(self, currency):
         return False
 
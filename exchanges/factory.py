@@ -1,32 +1,77 @@
-from exchanges.cryptopia import CryptopiaService
-from exchanges.binance import BinanceService
-from exchanges.idex import IdexService
-from exchanges.bittrex2 import BittrexService
-import ccxt
+import importlib
 
-from exchanges.qryptos import QryptosService
+# Adapters are only imported when CreateExchangeService first asks for them, so a process using one exchange does not
+# pay for importing every exchange's client library.
+# name -> module, service class and the keyword arguments it defaults to
+dispatch = {'binance': {'module': 'exchanges.binance', 'class': 'BinanceService', 'args': {}},
+            'bittrex': {'module': 'exchanges.bittrex2', 'class': 'BittrexService',
+                        'args': {'poll_time_s': 5, 'tick_tock': True}},
+            'cryptopia': {'module': 'exchanges.cryptopia', 'class': 'CryptopiaService',
+                          'args': {'poll_time_s': 5, 'tick_tock': True}},
+            'idex': {'module': 'exchanges.idex', 'class': 'IdexService', 'args': {'poll_time_s': 5, 'tick_tock': True}},
+            'qryptos': {'module': 'exchanges.qryptos', 'class': 'QryptosService',
+                        'args': {'poll_time_s': 5, 'tick_tock': True}}}
 
-dispatch = {'binance': {'constructor': BinanceService, 'args': {}},
-            'bittrex': {'constructor': BittrexService, 'args': {'poll_time_s': 5, 'tick_tock': True}},
-            'cryptopia': {'constructor': CryptopiaService, 'args': {'poll_time_s': 5, 'tick_tock': True}},
-            'idex': {'constructor': IdexService, 'args': {'poll_time_s': 5, 'tick_tock': True}},
-            'qryptos': {'constructor': QryptosService, 'args': {'poll_time_s': 5, 'tick_tock': True}}}
+# Other packages can add adapters by declaring an entry point in this group, named after the exchange, e.g. in
+# their setup.py: entry_points={'exchanges.adapters': ['kraken = kraken_adapter:KrakenService']}
+ENTRY_POINT_GROUP = 'exchanges.adapters'
 
+_constructors = {}
+_plugins = None
+
+
+def _find_plugins():
+    try:
+        from importlib.metadata import entry_points
+        found = entry_points()
+        # Python 3.10+ selects by group; earlier versions return a dict of group -> entry points
+        found = found.select(group=ENTRY_POINT_GROUP) if hasattr(found, 'select') else \
+            found.get(ENTRY_POINT_GROUP, [])
+    except ImportError:
+        import pkg_resources
+        found = pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+    return {entry_point.name: entry_point for entry_point in found}
+
+
+def get_constructor(exchange):
+    """
+    :return: the service class of an exchange, importing its adapter on first use, or None if there is no adapter
+             for it, built in or plugged in
+    """
+    global _plugins
+    constructor = _constructors.get(exchange)
+    if constructor is not None:
+        return constructor
 
-def CreateExchangeService(exchange, public_key, private_key, **args):
     if exchange in dispatch:
         params = dispatch[exchange]
-        constructor = params['constructor']
-        default_args = params['args']
-        my_args = {}
-        for key in default_args.keys():
-            if key in args:
-                my_args[key] = args[key]
-            else:
-                my_args[key] = default_args[key]
+        constructor = getattr(importlib.import_module(params['module']), params['class'])
+    else:
+        # Entry points are only looked for once, and only for exchanges that are not built in
+        if _plugins is None:
+            _plugins = _find_plugins()
+        if exchange not in _plugins:
+            return None
+        constructor = _plugins[exchange].load()
+
+    _constructors[exchange] = constructor
+    return constructor
+
+
+def available_exchanges():
+    global _plugins
+    if _plugins is None:
+        _plugins = _find_plugins()
+    return sorted(set(dispatch.keys()) | set(_plugins.keys()))
+
+
+def CreateExchangeService(exchange, public_key, private_key, **args):
+    constructor = get_constructor(exchange)
+    if constructor is not None:
         return constructor(exchange, public_key, private_key, **args)
     else:
         try:
+            import ccxt
             return getattr(ccxt, exchange)
         except:
             raise NotImplementedError(exchange, 'has no exchange service implemented')
@@ -5,7 +5,6 @@ import codecs
 import re
 import traceback
 import sys
-import threading
 import uuid
 from collections import OrderedDict
 
@@ -19,13 +18,18 @@ from aj_sns.creds_retriever import get_creds
 from aj_sns.transfer_service import TransferService
 from ethereum.utils import sha3, ecsign, encode_int32
 from aj_sns.log_service import logger
-from pandas import DataFrame, concat, to_numeric
 
 from exchanges.idex.exceptions import IdexException, IdexWalletAddressNotFoundException, IdexPrivateKeyNotFoundException, IdexAPIException, IdexRequestException, IdexCurrencyNotFoundException
-from exchanges.common.open_order_tracker import OrderTracker
+from exchanges.common.async_http import get_async_http
+from exchanges.common.dispatcher import Dispatcher, QUEUE_SIZE
+from exchanges.common.events import BalanceEvent, BookEvent, ExecutionEvent, LifecycleEvent
+from exchanges.common.metadata_cache import MetadataCache
+from exchanges.common.metrics import LatencyHistograms, MetricsRegistry, ReceiveTime
+from exchanges.common.order_store import OrderStore
+from exchanges.common.scheduler import get_scheduler
 
 
-class IdexService(OrderTracker, TransferService):
+class IdexService(TransferService):
 
     API_URL = 'https://api.idex.market'
     #API_URL = 'https://api-regional.idex.market'
@@ -35,14 +39,27 @@ class IdexService(OrderTracker, TransferService):
     _contract_address = None
     _currency_addresses = {}
 
+    CURRENCIES_CACHE_KEY = 'idex_currencies'
+    CONTRACT_ADDRESS_CACHE_KEY = 'idex_contract_address'
+    METADATA_TTL_S = 24 * 3600
+
     def __init__(self, name, address=None, private_key=None, poll_time_s=5.0, tick_tock=True):
-        OrderTracker.__init__(self)
+        self.orders = OrderStore()
         self.name = name
 
         self._start_nonce = None
         self._client_started = int(time.time() * 1000)
 
         self.session = self._init_session()
+        self.http = get_async_http()
+        self.cache = MetadataCache()
+        self.callbacks = {}
+        # Before any request, which _request times into metrics
+        self.latencies = LatencyHistograms(name)
+        self.metrics = MetricsRegistry(name)
+        self.dispatcher = Dispatcher(self.latencies, self.metrics)
+        self.metrics.add_collector(self.latencies.collect)
+        self.metrics.add_collector(self.dispatcher.collect)
 
         if address:
             self.set_wallet_address(address, private_key)
@@ -53,12 +70,15 @@ class IdexService(OrderTracker, TransferService):
         self.trades_following = {}
         self.following = {}
         self.websocket = None
-        self.callbacks = {}
         self.poll_time_s = poll_time_s
         self.name = name
 
+        # Polled by the scheduler shared with the other services, see common.scheduler
+        self.tick_task = None
         if tick_tock is True:
-            threading.Timer(self.poll_time_s, self.on_tick).start()
+            self.tick_task = get_scheduler().schedule('{} tick'.format(name), self.on_tick, self.poll_time_s,
+                                                      jitter_s=self.poll_time_s / 10.0)
+            self.metrics.add_collector(self.tick_task.collect)
 
     def _init_session(self):
 
@@ -129,8 +149,9 @@ class IdexService(OrderTracker, TransferService):
             del(kwargs['hash_data'])
 
         f = getattr(self.session, method)
-        response = f(uri, **kwargs, timeout=15)
-        return self._handle_response(response)
+        with self.metrics.rest_call(path):
+            response = f(uri, **kwargs, timeout=15)
+            return self._handle_response(response)
 
     def _handle_response(self, response):
         """Internal helper for handling API responses from the Quoine server.
@@ -176,7 +197,7 @@ class IdexService(OrderTracker, TransferService):
         """
         self._wallet_address = address.lower()
         nonce_res = self.get_my_next_nonce()
-        if hasattr(nonce_res, 'nonce'):
+        if nonce_res is not None and 'nonce' in nonce_res:
             self._start_nonce = nonce_res['nonce']
         else:
             time_ms = int(time.time() * 1000)
@@ -461,6 +482,19 @@ class IdexService(OrderTracker, TransferService):
         #response = getattr(self.session, 'get')('https://api-regional.idex.market/returnOrderBook?market=' + market)
         #book = self._handle_response(response)
 
+        return self._index_book(book)
+
+    async def get_order_book_async(self, base, quote):
+        """get_order_book as a coroutine, for common.async_http to run alongside other requests"""
+        uri = self._create_uri('returnOrderBook', 'https://api-regional.idex.market')
+        with self.metrics.rest_call('returnOrderBook'):
+            # Fetching a book changes nothing, so it is safe to retry
+            response = await self.http.request('POST', uri, json_body={'market': self.to_market(base, quote)},
+                                               headers=dict(self.session.headers), retry=True)
+            return self._index_book(self._handle_response(response))
+
+    @staticmethod
+    def _index_book(book):
         book_by_hash = {'bids': OrderedDict(), 'asks': OrderedDict()}
         for bid in book['bids']:
             book_by_hash['bids'][bid['orderHash']] = bid
@@ -481,74 +515,69 @@ class IdexService(OrderTracker, TransferService):
     def on_tick(self):
         logger().info('tick')
         try:
-            for market in self.markets_following.keys():
-                logger().info('Getting market: ' + market)
+            markets = list(self.markets_following.keys())
+            # Every book at once, so the tick takes about one round trip however many markets are followed
+            books = self.http.run_all([self.get_order_book_async(*self.to_base_and_quote(market))
+                                       for market in markets])
+            receive_time = ReceiveTime()
+            for market, book in zip(markets, books):
+                logger().info('Got market: ' + market)
                 base, quote = self.to_base_and_quote(market)
-                book = self.get_order_book(base, quote)
-                open_orders_to_del = []
-                internal_order_to_del_from_map = []
+                if isinstance(book, Exception):
+                    logger().error('Failed to get the book of {}. Exception was: {}'.format(market, book))
+                    self.metrics.counter('errors_total', 'Failures caught and logged', where='on_tick').inc()
+                    continue
+
                 trade_lifecycle_actions = []
-                for open_order in self.open_orders.values():
-                    if open_order['base'] == base and open_order['quote'] == quote:
-                        side = 'bids' if open_order['side'] == 'buy' else 'asks'
-
-                        if open_order['exchange_order_id'] in book[side]:
-                            book_match = book[side][open_order['exchange_order_id']]
-                            expected_quantity_on_book = open_order['quantity'] - open_order['cum_quantity_filled']
-                            actual_quantity_on_book = Decimal(book_match['amount'])
-                            new_fill_amount = expected_quantity_on_book - actual_quantity_on_book
-                            status = 'PARTIALLY_FILLED'
-                            open_order['cum_quantity_filled'] = open_order['cum_quantity_filled'] + new_fill_amount
+                for open_order in self.orders.get_market(base, quote):
+                    side = 'bids' if open_order['side'] == 'buy' else 'asks'
+
+                    if open_order['exchange_order_id'] in book[side]:
+                        book_match = book[side][open_order['exchange_order_id']]
+                        actual_quantity_on_book = Decimal(book_match['amount'])
+                        status = 'PARTIALLY_FILLED'
+                        open_order, new_fill_amount = self.orders.fill(
+                            open_order['exchange_order_id'], open_order['quantity'] - actual_quantity_on_book)
+                    elif not self.orders.is_pending_cancel(open_order['internal_order_id']):
+                        # If it's not in the book, and it's open on our end, it must have been fully filled, so it
+                        # leaves the store
+                        status = 'FILLED'
+                        open_order, new_fill_amount = self.orders.fill(open_order['exchange_order_id'],
+                                                                       open_order['quantity'], done=True)
+                    else:
+                        # Order is missing because it's being/been canceled. In the off chance the cancel fails
+                        # Due to a full fill happening, the fill will get picked up in the next tick
+                        new_fill_amount = 0
+
+                    if open_order is not None and new_fill_amount > 0:
+                        if open_order['side'] == 'buy':
+                            fee_base = Decimal('0.1') * new_fill_amount
+                            fee_quote = Decimal('0')
                         else:
-                            # If it's not in the book, and it's open on our end, it must have been fully filled
-                            # If it's a pending cancel, ignore it for now. It'll either be canceled thus not in the book
-                            # Or fail to cancel and be picked up next time as a full execution
-                            if open_order['internal_order_id'] not in self.pending_cancel:
-                                new_fill_amount = open_order['quantity'] - open_order['cum_quantity_filled']
-                                status = 'FILLED'
-                                open_order['cum_quantity_filled'] = open_order['quantity']
-                                # Since it's fully filled, let's remove it from our open_orders
-                                open_orders_to_del.append(open_order['exchange_order_id'])
-                                internal_order_to_del_from_map.append(open_order['internal_order_id'])
-                            else:
-                                # Order is missing because it's being/been canceled. In the off chance the cancel fails
-                                # Due to a full fill happening, the fill will get picked up in the next tick
-                                new_fill_amount = 0
-
-                        if new_fill_amount > 0:
-
-                            if open_order['side'] == 'buy':
-                                fee_base = Decimal('0.1') * new_fill_amount
-                                fee_quote = Decimal('0')
-                            else:
-                                fee_base = Decimal('0')
-                                fee_quote = Decimal('0.1') * new_fill_amount * open_order['price']
-
-                            message = {
-                                'action': 'EXECUTION',
-                                'exchange': self.name,
-                                'base': base,
-                                'quote': quote,
-                                'exchange_order_id': open_order['exchange_order_id'],
-                                'internal_order_id': open_order['internal_order_id'],
-                                'side': open_order['side'],
-                                'quantity': open_order['quantity'],
-                                'price': open_order['price'],
-                                'cum_quantity_filled': open_order['cum_quantity_filled'],
-                                'order_status': status,
-                                'server_ms': int(round(time.time() * 1000)),
-                                'received_ms': int(round(time.time() * 1000)),
-                                'last_executed_quantity': new_fill_amount,
-                                'last_executed_price': open_order['price'],
-                                'fee_base': fee_base,
-                                'fee_quote': fee_quote,
-                                'trade_id': '-1'
-                            }
-                            trade_lifecycle_actions.append(message)
-                for order_id in open_orders_to_del:
-                    self.open_orders.pop(order_id, None)
-                for internal_id in internal_order_to_del_from_map:
-                    self.internal_to_external_id.pop(internal_id, None)
+                            fee_base = Decimal('0')
+                            fee_quote = Decimal('0.1') * new_fill_amount * open_order['price']
+
+                        message = ExecutionEvent(
+                            action='EXECUTION',
+                            exchange=self.name,
+                            base=base,
+                            quote=quote,
+                            exchange_order_id=open_order['exchange_order_id'],
+                            internal_order_id=open_order['internal_order_id'],
+                            side=open_order['side'],
+                            quantity=open_order['quantity'],
+                            price=open_order['price'],
+                            cum_quantity_filled=open_order['cum_quantity_filled'],
+                            order_status=status,
+                            server_ms=None,
+                            receive_time=receive_time,
+                            last_executed_quantity=new_fill_amount,
+                            last_executed_price=open_order['price'],
+                            fee_base=fee_base,
+                            fee_quote=fee_quote,
+                            trade_id='-1'
+                        )
+                        trade_lifecycle_actions.append(message)
                 for action in trade_lifecycle_actions:
                     self.notify_callbacks('trade_lifecycle', trade_lifecycle_type=message['action'], data=action)
 
@@ -587,13 +616,13 @@ class IdexService(OrderTracker, TransferService):
         except Exception as e:
             traceback.print_exc(file=sys.stdout)
             logger().error('on_tick failed with error: ' + str(e))
+            self.metrics.counter('errors_total', 'Failures caught and logged', where='on_tick').inc()
         finally:
             logger().info('tock')
-            threading.Timer(self.poll_time_s, self.on_tick).start()
 
     @staticmethod
     def _as_order_book_list(book):
-        sorted_book = {'bids': [], 'asks': []}
+        sorted_book = BookEvent(bids=[], asks=[])
 
         for k in book['bids']:
             sorted_book['bids'].append([k, book['bids'][k]])
@@ -925,8 +954,11 @@ class IdexService(OrderTracker, TransferService):
 
         """
 
-        if currency not in self._currency_addresses:
-            self._currency_addresses = self.get_currencies()
+        if not self._currency_addresses:
+            self._load_currencies()
+        elif currency[:2] != '0x' and currency not in self._currency_addresses:
+            # Listed since the currencies were loaded
+            self._load_currencies(refresh=True)
 
         res = None
         if currency[:2] == '0x':
@@ -1018,15 +1050,13 @@ class IdexService(OrderTracker, TransferService):
         if success:
             for asset in response:
                 if 'available' in response[asset]:
-                    internal_format.append({
-                        'asset': asset,
-                        'free': Decimal(response[asset]['available']),
-                        'locked': Decimal(response[asset]['onOrders'])})
+                    internal_format.append(BalanceEvent(asset=asset,
+                                                        free=Decimal(response[asset]['available']),
+                                                        locked=Decimal(response[asset]['onOrders'])))
                 else:
-                    internal_format.append({
-                        'asset': asset,
-                        'free': Decimal(response[asset]),
-                        'locked': Decimal('0')})
+                    internal_format.append(BalanceEvent(asset=asset,
+                                                        free=Decimal(response[asset]),
+                                                        locked=Decimal('0')))
             self.notify_callbacks('account', account_type='balance', data=internal_format)
         else:
             self.notify_callbacks('account', account_type='balances_failed', data={})
@@ -1249,6 +1279,7 @@ class IdexService(OrderTracker, TransferService):
 
         retries = 4
         success = False
+        nonce = None
 
         while retries >= 0 and not success:
             try:
@@ -1296,11 +1327,34 @@ class IdexService(OrderTracker, TransferService):
 
         """
         if not self._contract_address:
-            res = self.get_contract_address()
-            self._contract_address = res['address']
+            contract_address = self.cache.load(self.CONTRACT_ADDRESS_CACHE_KEY, self.METADATA_TTL_S)
+            if contract_address is None:
+                contract_address = self.get_contract_address()['address']
+                self.cache.save(self.CONTRACT_ADDRESS_CACHE_KEY, contract_address)
+            self._contract_address = contract_address
 
         return self._contract_address
 
+    def _load_currencies(self, refresh=False):
+        """Loads the currencies get_currency looks up, from the metadata cache unless refresh or it is older than
+        METADATA_TTL_S
+
+        """
+        currencies = None if refresh else self.cache.load(self.CURRENCIES_CACHE_KEY, self.METADATA_TTL_S)
+        if currencies is None:
+            currencies = self.get_currencies()
+            self.cache.save(self.CURRENCIES_CACHE_KEY, currencies)
+        self._currency_addresses = currencies
+
+        return currencies
+
+    def warm_up(self):
+        """Loads the currencies and the contract address, which every order needs, before the first order
+
+        """
+        self._load_currencies()
+        self._get_contract_address()
+
     def get_contract_address(self):
         """Get the contract address used for depositing, withdrawing, and posting orders
 
@@ -1440,38 +1494,37 @@ class IdexService(OrderTracker, TransferService):
                 retries = retries - 1
 
         if success:
-            internal_response = {
-                'action': 'CREATED',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'exchange_order_id': response['orderHash'],
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'order_status': 'OPEN',
-                'server_ms': response['timestamp'] * 1000,
-                'received_ms': int(round(time.time() * 1000))
-            }
-
-            self.open_orders[internal_response['exchange_order_id']] = internal_response
-            self.internal_to_external_id[internal_order_id] = internal_response['exchange_order_id']
+            internal_response = LifecycleEvent(
+                action='CREATED',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                exchange_order_id=response['orderHash'],
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                order_status='OPEN',
+                server_ms=response['timestamp'] * 1000,
+                receive_time=ReceiveTime()
+            )
+
+            self.orders.add(internal_response)
         else:
-            internal_response = {
-                'action': 'CREATE_FAILED',
-                'reason': reason,
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'received_ms': int(round(time.time() * 1000))
-            }
+            internal_response = LifecycleEvent(
+                action='CREATE_FAILED',
+                reason=reason,
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                receive_time=ReceiveTime()
+            )
 
         self.notify_callbacks('trade_lifecycle', data=internal_response)
 
@@ -1691,15 +1744,15 @@ class IdexService(OrderTracker, TransferService):
         if not self._private_key:
             raise IdexPrivateKeyNotFoundException()
 
-        self.pending_cancel[internal_order_id] = True
+        self.orders.set_pending_cancel(internal_order_id)
 
         order_in_map = False
         order_in_book = False
         # exchange_order_id will be set when cancelling unknown orders
         # (ie, orders we thought failed to create but didn't)
         if exchange_order_id is None:
-            if internal_order_id in self.internal_to_external_id:
-                exchange_order_id = self.internal_to_external_id[internal_order_id]
+            exchange_order_id = self.orders.get_exchange_id(internal_order_id)
+            if exchange_order_id is not None:
                 order_in_map = True
             else:
                 exchange_order_id = None
@@ -1752,72 +1805,69 @@ class IdexService(OrderTracker, TransferService):
             finally:
                 retries = retries - 1
 
-        self.pending_cancel.pop(internal_order_id, None)
+        self.orders.clear_pending_cancel(internal_order_id)
 
         if success:
             # we think that there is undocumented rate limiting...
             time.sleep(2)
 
             if cb is True:
-                self.open_orders.pop(exchange_order_id, None)
-                self.internal_to_external_id.pop(internal_order_id, None)
-                self.notify_callbacks('trade_lifecycle', data={
-                    'action': 'CANCELED',
-                    'exchange': self.name,
-                    'base': base,
-                    'quote': quote,
-                    'exchange_order_id': exchange_order_id,
-                    'internal_order_id': internal_order_id,
-                    'order_status': 'CANCELED',
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000))
-                })
+                self.orders.remove(exchange_order_id, internal_order_id)
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CANCELED',
+                    exchange=self.name,
+                    base=base,
+                    quote=quote,
+                    exchange_order_id=exchange_order_id,
+                    internal_order_id=internal_order_id,
+                    order_status='CANCELED',
+                    server_ms=None,
+                    receive_time=ReceiveTime()
+                ))
         elif not order_in_map:
             if cb is True:
-                self.open_orders.pop(exchange_order_id, None)
-                self.internal_to_external_id.pop(internal_order_id, None)
-                self.notify_callbacks('trade_lifecycle', data={
-                    'action': 'CANCEL_FAILED',
-                    'reason': 'order_not_found',
-                    'base': base,
-                    'quote': quote,
-                    'exchange': self.name,
-                    'exchange_order_id': exchange_order_id,
-                    'internal_order_id': internal_order_id,
-                    'order_status': 'UNKNOWN',
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000))
-                })
+                self.orders.remove(exchange_order_id, internal_order_id)
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CANCEL_FAILED',
+                    reason='order_not_found',
+                    base=base,
+                    quote=quote,
+                    exchange=self.name,
+                    exchange_order_id=exchange_order_id,
+                    internal_order_id=internal_order_id,
+                    order_status='UNKNOWN',
+                    server_ms=None,
+                    receive_time=ReceiveTime()
+                ))
         elif not order_in_book:
             if cb is True:
-                self.open_orders.pop(exchange_order_id, None)
-                self.internal_to_external_id.pop(internal_order_id, None)
-                self.notify_callbacks('trade_lifecycle', data={
-                    'action': 'CANCEL_FAILED',
-                    'reason': 'order_not_found',
-                    'base': base,
-                    'quote': quote,
-                    'exchange': self.name,
-                    'exchange_order_id': exchange_order_id,
-                    'internal_order_id': internal_order_id,
-                    'order_status': 'UNKNOWN',
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000))
-                })
+                self.orders.remove(exchange_order_id, internal_order_id)
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CANCEL_FAILED',
+                    reason='order_not_found',
+                    base=base,
+                    quote=quote,
+                    exchange=self.name,
+                    exchange_order_id=exchange_order_id,
+                    internal_order_id=internal_order_id,
+                    order_status='UNKNOWN',
+                    server_ms=None,
+                    receive_time=ReceiveTime()
+                ))
         else:
             if cb is True:
-                self.notify_callbacks('trade_lifecycle', data={
-                    'action': 'CANCEL_FAILED',
-                    'reason': reason,
-                    'base': base,
-                    'quote': quote,
-                    'exchange': self.name,
-                    'exchange_order_id': exchange_order_id,
-                    'internal_order_id': internal_order_id,
-                    'order_status': 'OPEN',
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000))
-                })
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CANCEL_FAILED',
+                    reason=reason,
+                    base=base,
+                    quote=quote,
+                    exchange=self.name,
+                    exchange_order_id=exchange_order_id,
+                    internal_order_id=internal_order_id,
+                    order_status='OPEN',
+                    server_ms=None,
+                    receive_time=ReceiveTime()
+                ))
 
     # Withdraw Endpoints
 
@@ -1952,15 +2002,26 @@ class IdexService(OrderTracker, TransferService):
     #            self.notify_callbacks('order_book', data=self.to_internal_book_format(self.books[market]))
 
     def notify_callbacks(self, topic, **data):
-        for f in self.callbacks.values():
-            f(topic, **data)
+        # Only queues the message for each callback, see common.dispatcher
+        self.dispatcher.dispatch(topic, **data)
 
-    def add_callback(self, name, callback):
+    def add_callback(self, name, callback, topics=None, markets=None, queue_size=QUEUE_SIZE, policies=None):
+        self.dispatcher.add(name, callback, queue_size, policies, topics, markets)
         self.callbacks[name] = callback
 
     def remove_callback(self, name):
+        self.dispatcher.remove(name)
         del self.callbacks[name]
 
+    def get_dispatch_stats(self):
+        return self.dispatcher.get_stats()
+
+    def get_latency_stats(self):
+        return self.latencies.get_stats()
+
+    def get_metrics(self):
+        return self.metrics.get_metrics()
+
         #def process_execution(self, data):
         #    # If it's our open order
         #    if data['orderHash'] in self.open_orders:
@@ -1,8 +1,11 @@
 from _decimal import Decimal
+from exchanges.common.events import LifecycleEvent
+from exchanges.common.metrics import ReceiveTime
+from exchanges.common.order_store import OrderStore
 from exchanges.exchange import Exchange
 from exchanges.okex_service.order_book_socket import OrderBookSocket
-from exchanges.okex_service.rest_client import RestClient
-from time import sleep, time
+from exchanges.okex_service.rest_client import POOL_SIZE, RestClient
+from time import sleep
 from aj_sns.creds_retriever import get_creds
 import hashlib
 from pandas import to_datetime
@@ -15,34 +18,15 @@ except ImportError:
 
 class OkexService(Exchange):
 
-    def __init__(self, name, public_key, private_key):
+    def __init__(self, name, public_key, private_key, pool_size=POOL_SIZE):
         Exchange.__init__(self, name)
         self.order_book_socket = OrderBookSocket()
         self.markets_following = {}
-        self.rest_client = RestClient(public_key, private_key)
-        self.open_orders = []
+        self.rest_client = RestClient(public_key, private_key, pool_size=pool_size, metrics=self.metrics)
+        self.orders = OrderStore()
 
     def get_our_orders_by_decimal_price(self):
-        our_orders_by_price = {'bids': {}, 'asks': {}}
-
-        open_orders_copy = self.open_orders.copy()
-
-        for order in open_orders_copy:
-            order['price'] = Decimal(str(order['price']))
-            order['quantity'] = Decimal(str(order['quantity']))
-            order['cum_quantity_filled'] = Decimal(str(order['cum_quantity_filled']))
-            if order['side'] == 'buy':
-                if str(order['price']) not in our_orders_by_price['bids']:
-                    our_orders_by_price['bids'][order['price']] = order['quantity'] - order['cum_quantity_filled']
-                else:
-                    our_orders_by_price['bids'][order['price']] += order['quantity'] - order['cum_quantity_filled']
-            elif order['side'] == 'sell':
-                if str(order['price']) not in our_orders_by_price['bids']:
-                    our_orders_by_price['asks'][order['price']] = order['quantity'] - order['cum_quantity_filled']
-                else:
-                    our_orders_by_price['asks'][order['price']] += order['quantity'] - order['cum_quantity_filled']
-
-        return our_orders_by_price
+        return self.orders.get_quantities_by_price()
 
     def get_order_book(self, base, quote):
         resp = self.rest_client.market_depth(OkexService._to_market(base, quote))
@@ -65,117 +49,97 @@ class OkexService(Exchange):
         price = str(price)
 
         if response is None:
-            internal_response = {
-                'action': 'CREATE_FAILED',
-                'reason': 'UNKNOWN',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'received_ms': time() * 1000
-            }
+            internal_response = LifecycleEvent(
+                action='CREATE_FAILED',
+                reason='UNKNOWN',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                receive_time=ReceiveTime()
+            )
 
         elif 'error_code' in response:
             reason = 'UNKNOWN'
             if response['error_code'] == 1002:    # OKEX API error code
                                                   # 'https://github.com/okcoin-okex/API-docs-OKEx.com/blob/master/API-For-Spot-EN/Error%20Code%20For%20Spot.md'
                 reason = 'INSUFFICIENT_FUNDS'
-            internal_response = {
-                'action': 'CREATE_FAILED',
-                'reason': reason,
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'received_ms': time() * 1000
-            }
+            internal_response = LifecycleEvent(
+                action='CREATE_FAILED',
+                reason=reason,
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                receive_time=ReceiveTime()
+            )
         elif response['result'] is True:
             exchange_id = response['order_id']
-            internal_response = {
-                'action': 'CREATED',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'exchange_order_id': exchange_id,
-                'internal_order_id': internal_order_id,
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'order_status': 'OPEN',
-                'server_ms': time() * 1000,
-                'received_ms': time() * 1000
-            }
-
-            open_order = internal_response.copy()
-            open_order['price'] = Decimal(open_order['price'])
-            open_order['quantity'] = Decimal(open_order['quantity'])
-            self.open_orders.append(internal_response)
+            internal_response = LifecycleEvent(
+                action='CREATED',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                exchange_order_id=exchange_id,
+                internal_order_id=internal_order_id,
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                order_status='OPEN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            )
+
+            self.orders.add(internal_response)
 
         self.notify_callbacks('trade_lifecycle', data=internal_response)
 
         return internal_response
 
     def cancel_order(self, base, quote, internal_order_id, request_id, requester_id=None, exchange_order_id=None):
-        index_to_pop = None
         if exchange_order_id is None:
-            i = 0
-            for open_order in self.open_orders:
-                if open_order['internal_order_id'] == internal_order_id:
-                    exchange_order_id = open_order['exchange_order_id']
-                    index_to_pop = i
-                    break
-                i += 1
+            exchange_order_id = self.orders.get_exchange_id(internal_order_id)
 
         response = self.rest_client.cancel_order(symbol=OkexService._to_market(base,quote), order_id=exchange_order_id)
 
         if response['result'] is True:
-            i = 0
-
-            if index_to_pop is None:
-                for order in self.open_orders:
-                    if order['exchange_order_id'] == exchange_order_id:
-                        index_to_pop = i
-                        break
-                    i += 1
-
-            if index_to_pop is not None:
-                self.open_orders.pop(index_to_pop)
-
-            internal_response = {
-                'action': 'CANCELED',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'exchange_order_id': exchange_order_id,
-                'internal_order_id': internal_order_id,
-                'order_status': 'CANCELED',
-                'server_ms': int(round(time() * 1000)),
-                'received_ms': int(round(time() * 1000))
-            }
+            self.orders.remove(exchange_order_id, internal_order_id)
+
+            internal_response = LifecycleEvent(
+                action='CANCELED',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                exchange_order_id=exchange_order_id,
+                internal_order_id=internal_order_id,
+                order_status='CANCELED',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            )
 
             self.notify_callbacks('trade_lifecycle', data=internal_response)
         else:
-            internal_response = {
-                'action': 'CANCEL_FAILED',
-                'reason': 'order_not_found',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'exchange_order_id': exchange_order_id,
-                'internal_order_id': internal_order_id,
-                'order_status': 'UNKNOWN',
-                'server_ms': int(round(time() * 1000)),
-                'received_ms': int(round(time() * 1000))
-            }
+            internal_response = LifecycleEvent(
+                action='CANCEL_FAILED',
+                reason='order_not_found',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                exchange_order_id=exchange_order_id,
+                internal_order_id=internal_order_id,
+                order_status='UNKNOWN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            )
             self.notify_callbacks('trade_lifecycle', data=internal_response)
 
         # return internal_response
@@ -192,12 +156,8 @@ class OkexService(Exchange):
         for open_order in open_orders:
 
             exchange_order_id = open_order['orders_id']
-            internal_order_id = None
-
-            for order in self.open_orders:
-                if order['exchange_order_id'] == exchange_order_id:
-                    internal_order_id = order['internal_order_id']
-                    break
+            order = self.orders.get_by_exchange_id(exchange_order_id)
+            internal_order_id = order['internal_order_id'] if order is not None else None
 
             self.cancel_order(base, quote, internal_order_id, 'a_request_id', exchange_order_id=exchange_order_id)
 
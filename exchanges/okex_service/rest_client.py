@@ -1,8 +1,20 @@
 import http.client
+import select
+import threading
 import urllib
 import json
 import hashlib
+from collections import deque
 
+POOL_SIZE = 4
+TIMEOUT_S = 10
+
+# What reusing a keep-alive connection the server has already closed fails with. Only retried on a new connection
+# when the failing one was reused, where that is what it usually means: the server closed it before reading the request
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+# Safe to send again when it cannot be told whether the server got them. A POST (an order, a cancel) is not
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
 
 
 def build_signature(params, secret_key):
@@ -12,33 +24,165 @@ def build_signature(params, secret_key):
     data = sign + 'secret_key=' + secret_key
     return hashlib.md5(data.encode('utf-8')).hexdigest().upper()
 
-def http_get(url, resource, params=''):
-    conn = http.client.HTTPSConnection(url, timeout=10)
-    conn.request("GET",resource + '?' + params)
-    response = conn.getresponse()
-    data = response.read().decode('utf-8')
+
+class ConnectionPool(object):
+    """Persistent keep-alive HTTPS connections to one host, shared by the threads of a RestClient.
+
+    At most size requests are in flight at once, each on a connection of its own; a thread asking for one more waits.
+    Connections go back to the pool after each response, so a request after the first pays one round trip rather
+    than a TCP and TLS handshake first. A connection that fails is closed and replaced.
+
+    An idle connection the server has closed is dropped before use. If one still fails once the request is written,
+    only idempotent requests (IDEMPOTENT_METHODS) are sent again on a new connection. Anything else raises, as the
+    server may have acted on it: the caller must check, e.g. for the order it was placing, rather than send it twice.
+    """
+
+    def __init__(self, host, size=POOL_SIZE, timeout_s=TIMEOUT_S, connection_class=http.client.HTTPSConnection):
+        self.host = host
+        self.size = size
+        self.timeout_s = timeout_s
+        self.connection_class = connection_class
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = deque()
+        self.opened_count = 0
+        self.reused_count = 0
+        self.discarded_count = 0
+        self.reconnect_count = 0
+
+    def request(self, method, resource, body=None, headers=None):
+        """
+        :return: the response body, as a str
+        """
+        with self.slots:
+            connection, reused = self.__take()
+            try:
+                data, keep_alive = self.__send(connection, method, resource, body, headers)
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                if not reused or method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+                # The server closed the connection while it sat idle, after it was checked
+                with self.lock:
+                    self.reconnect_count += 1
+                connection = self.__open()
+                data, keep_alive = self.__send(connection, method, resource, body, headers)
+
+            if keep_alive:
+                with self.lock:
+                    self.idle.append(connection)
+            else:
+                connection.close()
+            return data
+
+    def close(self):
+        with self.lock:
+            while len(self.idle) > 0:
+                self.idle.pop().close()
+
+    def collect(self):
+        """For metrics.MetricsRegistry.add_collector"""
+        with self.lock:
+            idle = len(self.idle)
+            counts = {'opened': self.opened_count, 'reused': self.reused_count, 'discarded': self.discarded_count,
+                      'reconnected': self.reconnect_count}
+        labels = {'host': self.host}
+        yield 'http_pool_idle_connections', 'gauge', 'Keep-alive connections waiting in the pool', labels, idle
+        for outcome, count in counts.items():
+            yield ('http_pool_connections_total', 'counter', 'Connections taken from the pool by how they were got',
+                   dict(labels, outcome=outcome), count)
+
+    def __take(self):
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                # Most recently used first: it is the least likely to have been closed by the server
+                connection = self.idle.pop()
+            if ConnectionPool.__is_open(connection):
+                with self.lock:
+                    self.reused_count += 1
+                return connection, True
+            connection.close()
+            with self.lock:
+                self.discarded_count += 1
+        return self.__open(), False
+
+    def __open(self):
+        with self.lock:
+            self.opened_count += 1
+        return self.connection_class(self.host, timeout=self.timeout_s)
+
+    @staticmethod
+    def __is_open(connection):
+        # Nothing is due on an idle keep-alive connection, so a readable one has been closed by the server (or sent
+        # something that cannot be used)
+        if connection.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return len(readable) == 0
+
+    @staticmethod
+    def __send(connection, method, resource, body, headers):
+        try:
+            connection.request(method, resource, body, headers or {})
+            response = connection.getresponse()
+            data = response.read().decode('utf-8')
+        except STALE_CONNECTION_ERRORS:
+            raise
+        except Exception:
+            # Whatever state it was left in, the connection cannot be reused
+            connection.close()
+            raise
+        return data, not response.will_close
+
+
+def http_get(pool, resource, params=''):
+    data = pool.request("GET", resource + '?' + params)
     return json.loads(data)
 
-def http_post(url,resource,params):
+def http_post(pool, resource, params):
     headers = {
     "Content-type" : "application/x-www-form-urlencoded",
     }
-    conn = http.client.HTTPSConnection(url, timeout=10)
     temp_params = urllib.parse.urlencode(params)
-    conn.request("POST", resource, temp_params, headers)
-    response = conn.getresponse()
-    data = response.read().decode('utf-8')
+    data = pool.request("POST", resource, temp_params, headers)
     params.clear()
-    conn.close()
     return json.loads(data)
 
 class RestClient(object):
 
     __url = 'www.okex.com'
-    def __init__(self, api_key, secret_key):
+    def __init__(self, api_key, secret_key, pool_size=POOL_SIZE, timeout_s=TIMEOUT_S, metrics=None):
+        """
+        :param pool_size: most requests in flight at once, each on its own keep-alive connection
+        :param metrics: a common.metrics.MetricsRegistry to time every call and count pool connections in
+        """
 
         self.__api_key = api_key
         self.__secret_key = secret_key
+        self.__pool = ConnectionPool(self.__url, pool_size, timeout_s)
+        self.__metrics = metrics
+        if metrics is not None:
+            metrics.add_collector(self.__pool.collect)
+
+    def close(self):
+        self.__pool.close()
+
+    def __get(self, resource, params=''):
+        if self.__metrics is None:
+            return http_get(self.__pool, resource, params)
+        with self.__metrics.rest_call(resource):
+            return http_get(self.__pool, resource, params)
+
+    def __post(self, resource, params):
+        if self.__metrics is None:
+            return http_post(self.__pool, resource, params)
+        with self.__metrics.rest_call(resource):
+            return http_post(self.__pool, resource, params)
 
     def market_depth(self, symbol=''):
         DEPTH_RESOURCE = '/api/v1/depth.do'
@@ -46,7 +190,7 @@ class RestClient(object):
         if symbol:
             params = 'symbol=%(symbol)s' % {'symbol': symbol}
 
-        return http_get(self.__url, DEPTH_RESOURCE, params)
+        return self.__get(DEPTH_RESOURCE, params)
 
     def trade_history(self, symbol=''):
         TRADES_RESOURCE = '/api/v1/trades.do'
@@ -54,7 +198,7 @@ class RestClient(object):
         if symbol:
             params = 'symbol=%(symbol)s' % {'symbol': symbol}
 
-        return http_get(self.__url, TRADES_RESOURCE, params)
+        return self.__get(TRADES_RESOURCE, params)
 
     def user_info(self):
         '''
@@ -65,7 +209,7 @@ class RestClient(object):
         params['api_key'] = self.__api_key
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, USERINFO_RESOURCE, params)
+        return self.__post(USERINFO_RESOURCE, params)
 
     def wallet_info(self):
         '''
@@ -76,7 +220,7 @@ class RestClient(object):
         params['api_key'] = self.__api_key
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, WALLETINFO_RESOURCE, params)
+        return self.__post(WALLETINFO_RESOURCE, params)
 
     def place_order(self, symbol, order_type, price='', amount=''):
         TRADE_RESOURCE = '/api/v1/trade.do'
@@ -98,7 +242,7 @@ class RestClient(object):
         params['sign'] = build_signature(params, self.__secret_key)
 
 
-        return http_post(self.__url, TRADE_RESOURCE, params)
+        return self.__post(TRADE_RESOURCE, params)
 
     def place_limit_order(self, symbol, side, price, amount):
         return self.place_order(symbol=symbol, order_type=side, price=price, amount=amount)
@@ -123,7 +267,7 @@ class RestClient(object):
         }
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, BATCH_TRADE_RESOURCE, params)
+        return self.__post(BATCH_TRADE_RESOURCE, params)
 
     def cancel_order(self, symbol, order_id):
         CANCEL_ORDER_RESOURCE = '/api/v1/cancel_order.do'
@@ -134,7 +278,7 @@ class RestClient(object):
                                                     # Max of 3 orders are allowed per request)
         }
         params['sign'] = build_signature(params,self.__secret_key)
-        return http_post(self.__url, CANCEL_ORDER_RESOURCE, params)
+        return self.__post(CANCEL_ORDER_RESOURCE, params)
 
     def get_order_info_byid(self, symbol, order_id, batch = False, fill_type=''):
         if batch == False:
@@ -153,7 +297,7 @@ class RestClient(object):
         params['sign'] = build_signature(params, self.__secret_key)
 
 
-        return http_post(self.__url, ORDER_INFO_RESOURCE, params)
+        return self.__post(ORDER_INFO_RESOURCE, params)
 
     def get_orders_info_bysymbol(self, symbol, status, current_page=1, page_length=200):
         # only the most recent two days are returned
@@ -169,7 +313,7 @@ class RestClient(object):
         params['sign'] = build_signature(params, self.__secret_key)
 
 
-        return http_post(self.__url, ORDER_HISTORY_RESOURCE, params)
+        return self.__post(ORDER_HISTORY_RESOURCE, params)
 
     def withdraw(self, symbol, trade_pwd, withdraw_address, withdraw_amount, address_type='address'):
         WITHDRAW_RESOURCE = '/api/v1/withdraw.do'
@@ -185,7 +329,7 @@ class RestClient(object):
         }
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, WITHDRAW_RESOURCE, params)
+        return self.__post(WITHDRAW_RESOURCE, params)
 
     def cancel_withdraw(self, symbol, withdraw_id):
         CANCEL_WITHDRAW_RESOURCE = '/api/v1/withdraw_info.do'
@@ -197,7 +341,7 @@ class RestClient(object):
         }
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, CANCEL_WITHDRAW_RESOURCE, params)
+        return self.__post(CANCEL_WITHDRAW_RESOURCE, params)
 
     def withdraw_info(self, symbol, withdraw_id):
         WITHDRAWINFO_RESOURCE = '/api/v1/withdraw_info.do'
@@ -208,7 +352,7 @@ class RestClient(object):
         }
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, WITHDRAWINFO_RESOURCE, params)
+        return self.__post(WITHDRAWINFO_RESOURCE, params)
 
     def deposit_withdraw_record(self, symbol, dw_type, current_page, page_length):
         DW_RESOURCE = '/api/v1/account_records.do'
@@ -221,7 +365,7 @@ class RestClient(object):
         }
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, DW_RESOURCE, params)
+        return self.__post(DW_RESOURCE, params)
 
     def internal_fund_transfer(self, symbol, amount, from_acc, to_acc):
         IFTRANSFER_RESOURCE = '/api/v1/funds_transfer.do'
@@ -234,7 +378,7 @@ class RestClient(object):
         }
         params['sign'] = build_signature(params, self.__secret_key)
 
-        return http_post(self.__url, IFTRANSFER_RESOURCE, params)
+        return self.__post(IFTRANSFER_RESOURCE, params)
 
     def tickers_market_info(self, symbol=''):
         TICKER_RESOURCE = '/api/v1/tickers.do'
@@ -242,7 +386,7 @@ class RestClient(object):
         if symbol:
             params = 'symbol=%(symbol)s' % {'symbol': symbol}
 
-        return http_get(self.__url, TICKER_RESOURCE, params)
+        return self.__get(TICKER_RESOURCE, params)
 
     def ticker_list(self):
         resp = self.tickers_market_info()
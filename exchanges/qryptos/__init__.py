@@ -8,31 +8,65 @@ from aj_sns.log_service import logger
 from quoine.client import Qryptos
 from quoine.exceptions import QuoineAPIException
 
+from exchanges.common.async_http import get_async_http
+from exchanges.common.events import BalanceEvent, BookEvent, ExecutionEvent, LifecycleEvent
+from exchanges.common.metadata_cache import MetadataCache
+from exchanges.common.metrics import ReceiveTime
+from exchanges.common.order_store import OrderStore
+from exchanges.common.scheduler import get_scheduler
 from exchanges.exchange import Exchange
 
 
 class QryptosService(Exchange):
+
+    PRODUCTS_CACHE_KEY = 'qryptos_products'
+    PRODUCTS_TTL_S = 24 * 3600
+
     def __init__(self, name, public_key, private_key, poll_time_s=5, tick_tock=True):
         Exchange.__init__(self, name)
-        self.pending_cancel = {}
+        self.orders = OrderStore()
         self.client = Qryptos(public_key, private_key)
         self.client.API_URL = 'https://api.liquid.com'
-        self.internal_to_external_id = {}
-        self.external_to_internal_id = {}
-        self.open_orders_by_exchange_id = {}
-        self.symbol_to_product = {}
+        self.http = get_async_http()
+        self.cache = MetadataCache()
+        self.products_lock = threading.Lock()
+        # Loaded on first use, or by warm_up
+        self.symbol_to_product = None
         self.markets_following = {}
-        product_list = self.client.get_products()
-        for product in product_list:
-            if 'product_type' in product and product['product_type'] == 'CurrencyPair':
-                self.symbol_to_product[product['currency_pair_code']] = product['id']
 
         self.poll_time_s = poll_time_s
         self.tick_tock = tick_tock
         self.name = name
 
+        # Polled by the scheduler shared with the other services, see common.scheduler. Ticks with no markets
+        # followed do nothing
+        self.tick_task = None
         if tick_tock is True:
-            threading.Timer(self.poll_time_s, self.on_tick).start()
+            self.tick_task = get_scheduler().schedule('{} tick'.format(name), self.on_tick, self.poll_time_s,
+                                                      jitter_s=self.poll_time_s / 10.0)
+            self.metrics.add_collector(self.tick_task.collect)
+
+    def warm_up(self):
+        self.load_products()
+
+    def load_products(self):
+        """
+        :return: {currency pair code: product id}, from the metadata cache when it is younger than PRODUCTS_TTL_S
+        """
+        with self.products_lock:
+            if self.symbol_to_product is None:
+                symbol_to_product = self.cache.load(self.PRODUCTS_CACHE_KEY, self.PRODUCTS_TTL_S)
+                if symbol_to_product is None:
+                    symbol_to_product = {}
+                    with self.metrics.rest_call('get_products'):
+                        product_list = self.client.get_products()
+                    for product in product_list:
+                        if 'product_type' in product and product['product_type'] == 'CurrencyPair':
+                            symbol_to_product[product['currency_pair_code']] = product['id']
+                    self.cache.save(self.PRODUCTS_CACHE_KEY, symbol_to_product)
+                self.symbol_to_product = symbol_to_product
+
+        return self.symbol_to_product
 
     def can_withdraw(self, withdraw):
         return False
@@ -44,20 +78,23 @@ class QryptosService(Exchange):
         logger().info('tick')
 
         if len(self.callbacks) > 0:
-            for product_id, details in self.markets_following.copy().items():
-                try:
-                    base = details['base']
-                    quote = details['quote']
-
-                    self._send_executions_to_cb(base, quote)
-                    self._send_order_book_to_cb(base, quote)
-                except Exception as e:
-                    traceback.print_exc(file=sys.stdout)
-                    logger().error('on_tick failed with error: ' + str(e))
+            markets = list(self.markets_following.values())
+            # The quoine client blocks, so each market is polled on a worker thread of the async transport, all at
+            # once, and the tick takes about as long as the slowest market rather than all of them in turn
+            results = self.http.run_all([self.http.in_thread(self._poll_market, details['base'], details['quote'])
+                                         for details in markets])
+            for details, result in zip(markets, results):
+                if isinstance(result, Exception):
+                    traceback.print_exception(type(result), result, result.__traceback__, file=sys.stdout)
+                    logger().error('on_tick failed for {}/{} with error: {}'
+                                   .format(details['base'], details['quote'], result))
+                    self.metrics.counter('errors_total', 'Failures caught and logged', where='on_tick').inc()
 
         logger().info('tock')
-        if len(self.markets_following) > 0:
-            threading.Timer(self.poll_time_s, self.on_tick).start()
+
+    def _poll_market(self, base, quote):
+        self._send_executions_to_cb(base, quote)
+        self._send_order_book_to_cb(base, quote)
 
     def _send_order_book_to_cb(self, base, quote):
         book = self.get_order_book(base, quote)
@@ -65,57 +102,45 @@ class QryptosService(Exchange):
         self.notify_callbacks('order_book', data=book)
 
     def _send_executions_to_cb(self, base, quote):
-        if len(self.open_orders_by_exchange_id) == 0:
-            return
-
-        for open_order in self.open_orders_by_exchange_id.copy().values():
-            exchange_order = self.client.get_order(open_order['exchange_order_id'])
-            newly_executed_amount = Decimal(str(exchange_order['filled_quantity'])) - \
-                                    Decimal(str(open_order['cum_quantity_filled']))
-
-            if newly_executed_amount > Decimal(0):
-                open_order['cum_quantity_filled'] = Decimal(exchange_order['filled_quantity'])
-
-                if 'fee_base' in open_order.keys():
-                    fee_base_delta = Decimal(exchange_order['order_fee']) - Decimal(open_order['fee_base'])
-                else:
-                    fee_base_delta = Decimal(exchange_order['order_fee'])
-
-                open_order['fee_base'] = Decimal(exchange_order['order_fee'])
-
-                if exchange_order['status'] == 'filled':
-                    status = 'FILLED'
-                    self.open_orders_by_exchange_id.pop(str(exchange_order['id']))
-                    self.external_to_internal_id.pop(str(open_order['exchange_order_id']))
-                    self.internal_to_external_id.pop(str(open_order['internal_order_id']))
-                elif exchange_order['status'] == 'cancelled':
-                    status = 'CANCELED'
-                    self.open_orders_by_exchange_id.pop(str(exchange_order['id']))
-                    self.external_to_internal_id.pop(str(open_order['exchange_order_id']))
-                    self.internal_to_external_id.pop(str(open_order['internal_order_id']))
-                else:
-                    status = 'PARTIALLY_FILLED'
-
-                message = {
-                    'action': 'EXECUTION',
-                    'exchange': self.name,
-                    'base': base,
-                    'quote': quote,
-                    'exchange_order_id': str(open_order['exchange_order_id']),
-                    'internal_order_id': str(open_order['internal_order_id']),
-                    'side': open_order['side'],
-                    'quantity': open_order['quantity'],
-                    'price': open_order['price'],
-                    'cum_quantity_filled': open_order['cum_quantity_filled'],
-                    'order_status': status,
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000)),
-                    'last_executed_quantity': newly_executed_amount,
-                    'last_executed_price': open_order['price'],
-                    'fee_base': fee_base_delta,
-                    'fee_quote': Decimal('0'),
-                    'trade_id': '-1'
-                }
+        for open_order in self.orders.get_market(base, quote):
+            with self.metrics.rest_call('get_order'):
+                exchange_order = self.client.get_order(open_order['exchange_order_id'])
+            receive_time = ReceiveTime()
+
+            if exchange_order['status'] == 'filled':
+                status = 'FILLED'
+            elif exchange_order['status'] == 'cancelled':
+                status = 'CANCELED'
+            else:
+                status = 'PARTIALLY_FILLED'
+
+            fee_base = Decimal(str(exchange_order['order_fee']))
+            fee_base_delta = fee_base - open_order.get('fee_base', Decimal(0))
+            open_order, newly_executed_amount = self.orders.fill(open_order['exchange_order_id'],
+                                                                 exchange_order['filled_quantity'],
+                                                                 done=status != 'PARTIALLY_FILLED', fee_base=fee_base)
+
+            if open_order is not None and newly_executed_amount > Decimal(0):
+                message = ExecutionEvent(
+                    action='EXECUTION',
+                    exchange=self.name,
+                    base=base,
+                    quote=quote,
+                    exchange_order_id=str(open_order['exchange_order_id']),
+                    internal_order_id=str(open_order['internal_order_id']),
+                    side=open_order['side'],
+                    quantity=open_order['quantity'],
+                    price=open_order['price'],
+                    cum_quantity_filled=open_order['cum_quantity_filled'],
+                    order_status=status,
+                    server_ms=None,
+                    receive_time=receive_time,
+                    last_executed_quantity=newly_executed_amount,
+                    last_executed_price=open_order['price'],
+                    fee_base=fee_base_delta,
+                    fee_quote=Decimal('0'),
+                    trade_id='-1'
+                )
 
                 self.notify_callbacks('trade_lifecycle', trade_lifecycle_type=message['action'], data=message)
 
@@ -123,10 +148,6 @@ class QryptosService(Exchange):
         product_id = self.get_product_id(base, quote)
         self.markets_following[str(product_id)] = {'base': base, 'quote': quote}
 
-        # If this is the first market we've followed, start the tick tock
-        if self.markets_following == 1 and self.tick_tock is True:
-            threading.Timer(self.poll_time_s, self.on_tick).start()
-
     def unfollow_market(self, base, quote):
         product_id = self.get_product_id(base, quote)
         self.markets_following.pop(str(product_id), None)
@@ -135,8 +156,9 @@ class QryptosService(Exchange):
         self.markets_following = {}
 
     def get_exchange_id(self, internal_id):
-        if internal_id in self.internal_to_external_id:
-            return self.internal_to_external_id[internal_id]
+        exchange_id = self.orders.get_exchange_id(internal_id)
+        if exchange_id is not None:
+            return exchange_id
 
         raise LookupError('Could not find open order with internal id: {}'.format(internal_id))
 
@@ -145,18 +167,18 @@ class QryptosService(Exchange):
             if exchange_order_id is None:
                 exchange_order_id = self.get_exchange_id(internal_order_id)
         except LookupError:
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CANCEL_FAILED',
-                'base': base,
-                'quote': quote,
-                'reason': 'order_not_found',
-                'exchange': self.name,
-                'exchange_order_id': str(exchange_order_id),
-                'internal_order_id': str(internal_order_id),
-                'order_status': 'UNKNOWN',
-                'server_ms': int(round(time.time() * 1000)),
-                'received_ms': int(round(time.time() * 1000))
-            })
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CANCEL_FAILED',
+                base=base,
+                quote=quote,
+                reason='order_not_found',
+                exchange=self.name,
+                exchange_order_id=str(exchange_order_id),
+                internal_order_id=str(internal_order_id),
+                order_status='UNKNOWN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            ))
             return
 
         try:
@@ -164,60 +186,54 @@ class QryptosService(Exchange):
 
             if ('message' in response and len(response['message']) > 0) or \
                     ('errors' in response and len(response['errors']) > 0):
-                self.notify_callbacks('trade_lifecycle', data={
-                    'action': 'CANCEL_FAILED',
-                    'reason': 'order_not_found',
-                    'base': base,
-                    'quote': quote,
-                    'exchange': self.name,
-                    'exchange_order_id': str(exchange_order_id),
-                    'internal_order_id': str(internal_order_id),
-                    'order_status': 'UNKNOWN',
-                    'server_ms': int(round(time.time() * 1000)),
-                    'received_ms': int(round(time.time() * 1000))
-                })
-                self.internal_to_external_id.pop(str(internal_order_id), None)
-                self.external_to_internal_id.pop(str(exchange_order_id), None)
-                self.open_orders_by_exchange_id.pop(str(exchange_order_id), None)
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CANCEL_FAILED',
+                    reason='order_not_found',
+                    base=base,
+                    quote=quote,
+                    exchange=self.name,
+                    exchange_order_id=str(exchange_order_id),
+                    internal_order_id=str(internal_order_id),
+                    order_status='UNKNOWN',
+                    server_ms=None,
+                    receive_time=ReceiveTime()
+                ))
+                self.orders.remove(str(exchange_order_id), str(internal_order_id))
                 return
         except QuoineAPIException as e:
             logger().error('Failed to cancel order with error: {}'.format(e))
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CANCEL_FAILED',
-                'reason': 'Unknown exception type',
-                'base': base,
-                'quote': quote,
-                'exchange': self.name,
-                'exchange_order_id': str(exchange_order_id),
-                'internal_order_id': str(internal_order_id),
-                'order_status': 'UNKNOWN',
-                'server_ms': int(round(time.time() * 1000)),
-                'received_ms': int(round(time.time() * 1000))
-            })
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CANCEL_FAILED',
+                reason='Unknown exception type',
+                base=base,
+                quote=quote,
+                exchange=self.name,
+                exchange_order_id=str(exchange_order_id),
+                internal_order_id=str(internal_order_id),
+                order_status='UNKNOWN',
+                server_ms=None,
+                receive_time=ReceiveTime()
+            ))
             # If fails due to "already closed" or "not found", then popping is fine
             # TODO - If it fails due to a rate limit, we probably don't want this here?
-            self.internal_to_external_id.pop(str(internal_order_id), None)
-            self.external_to_internal_id.pop(str(exchange_order_id), None)
-            self.open_orders_by_exchange_id.pop(str(exchange_order_id), None)
+            self.orders.remove(str(exchange_order_id), str(internal_order_id))
             return
 
-        self.internal_to_external_id.pop(str(internal_order_id), None)
-        self.external_to_internal_id.pop(str(exchange_order_id), None)
-        self.open_orders_by_exchange_id.pop(str(exchange_order_id), None)
+        self.orders.remove(str(exchange_order_id), str(internal_order_id))
 
         time.sleep(2)
 
-        self.notify_callbacks('trade_lifecycle', data={
-            'action': 'CANCELED',
-            'exchange': self.name,
-            'base': base,
-            'quote': quote,
-            'exchange_order_id': str(exchange_order_id),
-            'internal_order_id': str(internal_order_id),
-            'order_status': 'CANCELED',
-            'server_ms': int(round(time.time() * 1000)),
-            'received_ms': int(round(time.time() * 1000))
-        })
+        self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+            action='CANCELED',
+            exchange=self.name,
+            base=base,
+            quote=quote,
+            exchange_order_id=str(exchange_order_id),
+            internal_order_id=str(internal_order_id),
+            order_status='CANCELED',
+            server_ms=None,
+            receive_time=ReceiveTime()
+        ))
 
     def get_withdrawals(self, currency):
         raise NotImplementedError('Qryptos does not have a get_withdrawals function in their API')
@@ -230,16 +246,12 @@ class QryptosService(Exchange):
 
     def get_order_book(self, base, quote):
         product_id = self.get_product_id(base, quote)
-        book = self.client.get_order_book(product_id, full=True)
-        book['bids'] = book['buy_price_levels']
-        book['asks'] = book['sell_price_levels']
-        book.pop('buy_price_levels', None)
-        book.pop('sell_price_levels', None)
-
-        book['base'] = base
-        book['quote'] = quote
-        book['exchange'] = self.name
-
+        with self.metrics.rest_call('get_order_book'):
+            response = self.client.get_order_book(product_id, full=True)
+        book = BookEvent(bids=response.pop('buy_price_levels'), asks=response.pop('sell_price_levels'), base=base,
+                         quote=quote, exchange=self.name, receive_time=ReceiveTime())
+        # Anything else Qryptos sends along (the timestamp) is passed through as before
+        book.update(response)
         return book
 
     def get_balances(self):
@@ -248,11 +260,9 @@ class QryptosService(Exchange):
         internal_balances_format = []
 
         for balance in balances:
-            internal_balances_format.append({
-                'asset': balance['currency'],
-                'free': Decimal(str(balance['balance'])),
-                'locked': Decimal(0)
-            })
+            internal_balances_format.append(BalanceEvent(asset=balance['currency'],
+                                                         free=Decimal(str(balance['balance'])),
+                                                         locked=Decimal(0)))
 
         self.notify_callbacks('account', account_type='balance', data=internal_balances_format)
 
@@ -270,87 +280,61 @@ class QryptosService(Exchange):
 
             if ('message' in response and len(response['message']) > 0) or \
                     ('errors' in response and len(response['errors']) > 0):
-                self.notify_callbacks('trade_lifecycle', data={
-                    'action': 'CREATE_FAILED',
-                    'reason': 'Unknown exception type',
-                    'exchange': self.name,
-                    'base': base,
-                    'quote': quote,
-                    'internal_order_id': str(internal_order_id),
-                    'side': side,
-                    'quantity': quantity,
-                    'price': price,
-                    'cum_quantity_filled': 0,
-                    'received_ms': int(round(time.time() * 1000))
-                })
+                self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                    action='CREATE_FAILED',
+                    reason='Unknown exception type',
+                    exchange=self.name,
+                    base=base,
+                    quote=quote,
+                    internal_order_id=str(internal_order_id),
+                    side=side,
+                    quantity=quantity,
+                    price=price,
+                    cum_quantity_filled=0,
+                    receive_time=ReceiveTime()
+                ))
                 return
         except QuoineAPIException as e:
             logger().error('Failed to create order due to error: {}'.format(e))
-            self.notify_callbacks('trade_lifecycle', data={
-                'action': 'CREATE_FAILED',
-                'reason': 'Unknown exception type',
-                'exchange': self.name,
-                'base': base,
-                'quote': quote,
-                'internal_order_id': str(internal_order_id),
-                'side': side,
-                'quantity': quantity,
-                'price': price,
-                'cum_quantity_filled': 0,
-                'received_ms': int(round(time.time() * 1000))
-            })
+            self.notify_callbacks('trade_lifecycle', data=LifecycleEvent(
+                action='CREATE_FAILED',
+                reason='Unknown exception type',
+                exchange=self.name,
+                base=base,
+                quote=quote,
+                internal_order_id=str(internal_order_id),
+                side=side,
+                quantity=quantity,
+                price=price,
+                cum_quantity_filled=0,
+                receive_time=ReceiveTime()
+            ))
             return
 
-        self.internal_to_external_id[str(internal_order_id)] = str(response['id'])
-        self.external_to_internal_id[str(response['id'])] = str(internal_order_id)
-
-        internal_response = {
-            'action': 'CREATED',
-            'exchange': self.name,
-            'base': base,
-            'quote': quote,
-            'exchange_order_id': str(response['id']),
-            'internal_order_id': str(internal_order_id),
-            'side': side,
-            'quantity': Decimal(str(quantity)),
-            'price': Decimal(str(price)),
-            'cum_quantity_filled': Decimal('0'),
-            'order_status': 'OPEN',
-            'server_ms': response['created_at'] * 1000,
-            'received_ms': int(round(time.time() * 1000))
-        }
-        self.open_orders_by_exchange_id[str(response['id'])] = internal_response
+        internal_response = LifecycleEvent(
+            action='CREATED',
+            exchange=self.name,
+            base=base,
+            quote=quote,
+            exchange_order_id=str(response['id']),
+            internal_order_id=str(internal_order_id),
+            side=side,
+            quantity=Decimal(str(quantity)),
+            price=Decimal(str(price)),
+            cum_quantity_filled=Decimal('0'),
+            order_status='OPEN',
+            server_ms=response['created_at'] * 1000,
+            receive_time=ReceiveTime()
+        )
+        self.orders.add(internal_response)
         self.notify_callbacks('trade_lifecycle', data=internal_response)
 
     def get_open_orders_by_side_and_price(self):
-        open_orders_by_side_and_price = {'bids': {}, 'asks': {}}
-
-        for order in self.open_orders_by_exchange_id.values():
-            if order['side'] == 'buy':
-                if Decimal(order['price']) in open_orders_by_side_and_price['bids']:
-                    open_orders_by_side_and_price['bids'][Decimal(order['price'])] \
-                        = open_orders_by_side_and_price['bids'][order['price']] + \
-                          order['quantity'] - order['cum_quantity_filled']
-                else:
-                    open_orders_by_side_and_price['bids'][Decimal(order['price'])] = order['quantity'] - \
-                                                                                     order['cum_quantity_filled']
-            elif order['side'] == 'sell':
-                if Decimal(order['price']) in open_orders_by_side_and_price['asks']:
-                    open_orders_by_side_and_price['asks'][Decimal(order['price'])] \
-                        = open_orders_by_side_and_price['asks'][order['price']] + \
-                          order['quantity'] - order['cum_quantity_filled']
-                else:
-                    open_orders_by_side_and_price['asks'][Decimal(order['price'])] = order['quantity'] - \
-                                                                                     order['cum_quantity_filled']
-
-        return open_orders_by_side_and_price
+        return self.orders.get_quantities_by_price()
 
     def get_product_id(self, base, quote):
         symbol = str.upper(base) + str.upper(quote)
-        if symbol in self.symbol_to_product:
-            return self.symbol_to_product[symbol]
-        else:
-            return None
+        return self.load_products().get(symbol)
 
     def cancel_all(self, base, quote):
         product_id = self.get_product_id(base, quote)
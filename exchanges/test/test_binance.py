@@ -0,0 +1,595 @@
+import json
+import os
+import threading
+import time
+
+from exchanges.binance import BinanceService
+from exchanges.binance.clock_sync import ClockSync
+from exchanges.binance.depth_capture import DepthCapture, DepthReplay
+from exchanges.binance.depth_socket import DepthSocketManager
+from exchanges.binance.limits import ACCOUNT, MARKET_DATA, ORDERS, WeightGovernor
+from exchanges.binance.order_book import MAX_CONFLATION_MS, OrderBookService
+from exchanges.binance.snapshot_recovery import SnapshotRecoveryWorker
+from exchanges.binance.symbol_info import SymbolInfoService
+from exchanges.common.metadata_cache import MetadataCache
+from exchanges.common.metrics import ClockOffset
+
+
+class Feed(object):
+    """Stands in for both the depth socket and the snapshot recovery worker of an OrderBookService"""
+
+    def __init__(self):
+        self.callback = None
+        self.requested = []
+
+    def subscribe(self, symbol, callback):
+        self.callback = callback
+
+    def unsubscribe(self, symbol):
+        self.callback = None
+
+    def request(self, order_book_service, delay_s=0):
+        self.requested.append(order_book_service)
+
+
+def diff(first_update_id, last_update_id, bids=(), asks=()):
+    return {'e': 'depthUpdate', 'E': 1000 + last_update_id, 's': 'ETHBTC', 'U': first_update_id,
+            'u': last_update_id, 'b': [list(level) for level in bids], 'a': [list(level) for level in asks]}
+
+
+SNAPSHOT = {'lastUpdateId': 10,
+            'bids': [['0.050000', '1.000'], ['0.049000', '2.000'], ['0.048000', '3.000']],
+            'asks': [['0.051000', '1.000'], ['0.052000', '2.000']]}
+
+
+def follow(publish_mode='full', **kwargs):
+    """An OrderBookService of ETHBTC, started on a Feed and in sync with SNAPSHOT. Returns it, the feed and the
+    (order_book_type, data) of everything it published"""
+    published = []
+    feed = Feed()
+    service = OrderBookService(None, 'ETH', 'BTC', lambda topic, **data: published.append((data['order_book_type'],
+                                                                                            data['data'])),
+                               'binance', publish_mode=publish_mode, depth_socket=feed, recovery=feed,
+                               tick_size='0.00000100', step_size='0.00100000', **kwargs)
+    service.start()
+    feed.callback(diff(9, 10))
+    assert feed.requested == [service] and service.on_snapshot(SNAPSHOT)
+    return service, feed, published
+
+
+def test_publish_modes_carry_the_book_its_top_its_best_or_its_changes():
+    books = {}
+    for publish_mode in ('full', 'top_n', 'best', 'delta'):
+        service, feed, published = follow(publish_mode, depth=2)
+        feed.callback(diff(11, 11, bids=[('0.049000', '0')], asks=[('0.050500', '4')]))
+        books[publish_mode] = published
+
+    assert [order_book_type for order_book_type, _ in books['full']] == ['full', 'full']
+    assert books['full'][-1][1]['bids'] == [['0.050000', '1.000'], ['0.048000', '3.000']]
+    assert books['full'][-1][1]['asks'] == [['0.050500', '4.000'], ['0.051000', '1.000'], ['0.052000', '2.000']]
+
+    assert books['top_n'][-1][0] == 'top_n'
+    assert books['top_n'][-1][1]['asks'] == [['0.050500', '4.000'], ['0.051000', '1.000']]
+
+    assert books['best'][-1][0] == 'best'
+    assert books['best'][-1][1]['bids'] == [['0.050000', '1.000']]
+    assert books['best'][-1][1]['asks'] == [['0.050500', '4.000']]
+
+    # A full book when in sync, then only what each diff changed, a removed level with quantity 0
+    (snapshot_type, snapshot), (delta_type, delta) = books['delta']
+    assert snapshot_type == 'snapshot' and len(snapshot['bids']) == 3
+    assert delta_type == 'delta' and delta['first_update_id'] == delta['last_update_id'] == 11
+    assert delta['bids'] == [['0.049000', '0.000']] and delta['asks'] == [['0.050500', '4.000']]
+
+
+class SocketManager(object):
+    """Stands in for BinanceSocketManager, recording the connections opened and closed"""
+
+    def __init__(self):
+        self.opened = []
+        self.stopped = []
+        self.callbacks = {}
+
+    def start(self):
+        pass
+
+    def start_multiplex_socket(self, streams, callback):
+        conn_key = 'streams=' + '/'.join(streams)
+        self.opened.append(conn_key)
+        self.callbacks[conn_key] = callback
+        return conn_key
+
+    def stop_socket(self, conn_key):
+        self.stopped.append(conn_key)
+        self.callbacks.pop(conn_key, None)
+
+    def close(self):
+        self.callbacks = {}
+
+
+def wait_for(condition, timeout_s=5):
+    deadline = time.time() + timeout_s
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    assert condition()
+
+
+def test_depth_socket_adds_runtime_subscriptions_without_restarting_open_shards():
+    sockets = DepthSocketManager(None, max_streams_per_connection=2, reconnect_delay_s=0)
+    bm = sockets.bm = SocketManager()
+    received = []
+
+    def callback(symbol):
+        return lambda msg, receive_time: received.append((symbol, msg['u']))
+
+    # Subscriptions made together share a shard, up to max_streams_per_connection
+    with sockets.lock:
+        for symbol in ('ETHBTC', 'LTCBTC', 'BNBBTC'):
+            sockets.subscribe(symbol, callback(symbol))
+    wait_for(lambda: len(bm.opened) == 2)
+    assert bm.opened == ['streams=ethbtc@depth/ltcbtc@depth', 'streams=bnbbtc@depth']
+
+    # The shard with room left is open, so a later subscription opens a new one rather than restarting it
+    sockets.subscribe('XRPBTC', callback('XRPBTC'))
+    wait_for(lambda: len(bm.opened) == 3)
+    assert bm.opened[2] == 'streams=xrpbtc@depth' and bm.stopped == [] and sockets.get_connection_count() == 3
+
+    # Unsubscribing leaves a shard's other streams flowing, and only closes the shard once it is empty
+    sockets.unsubscribe('ETHBTC')
+    first = bm.callbacks['streams=ethbtc@depth/ltcbtc@depth']
+    first({'stream': 'ethbtc@depth', 'data': {'u': 1}})
+    first({'stream': 'ltcbtc@depth', 'data': {'u': 2}})
+    assert received == [('LTCBTC', 2)]
+    sockets.unsubscribe('BNBBTC')
+    wait_for(lambda: len(bm.stopped) == 1)
+    assert bm.stopped == ['streams=bnbbtc@depth'] and sockets.get_connection_count() == 2
+
+    # A stream its shard still carries is listened to again without a new connection
+    sockets.subscribe('ETHBTC', callback('ETHBTC'))
+    first({'stream': 'ethbtc@depth', 'data': {'u': 3}})
+    assert received[-1] == ('ETHBTC', 3) and len(bm.opened) == 3
+
+
+def test_snapshot_applies_the_buffered_diffs_that_follow_it():
+    published = []
+    feed = Feed()
+    service = OrderBookService(None, 'ETH', 'BTC', lambda topic, **data: published.append(data['data']), 'binance',
+                               depth_socket=feed, recovery=feed, tick_size='0.000001', step_size='0.001')
+    service.start()
+    # Diffs buffer until the snapshot arrives, however many of them there are, asking for one snapshot
+    feed.callback(diff(8, 9, bids=[('0.050000', '9')]))
+    feed.callback(diff(10, 11, bids=[('0.049000', '0')]))
+    feed.callback(diff(12, 12, asks=[('0.051000', '5')]))
+    assert feed.requested == [service] and published == []
+
+    # Those the snapshot already covers (u <= lastUpdateId) are dropped, the one straddling it (U <= lastUpdateId+1)
+    # and those after it applied
+    assert service.on_snapshot(SNAPSHOT)
+    book = service.get_order_book()
+    assert book['last_update_id'] == 12 and len(published) == 1
+    assert book['bids'] == [['0.050000', '1.000'], ['0.048000', '3.000']]
+    assert book['asks'][0] == ['0.051000', '5.000']
+
+    # In sync, diffs apply one by one; one already covered is ignored
+    feed.callback(diff(13, 14, bids=[('0.047000', '1')]))
+    feed.callback(diff(12, 12, asks=[('0.051000', '6')]))
+    assert service.get_order_book()['last_update_id'] == 14 and len(published) == 2
+
+
+def test_stale_snapshots_and_gaps_ask_for_another_snapshot():
+    feed = Feed()
+    service = OrderBookService(None, 'ETH', 'BTC', lambda topic, **data: None, 'binance', depth_socket=feed,
+                               recovery=feed, tick_size='0.000001', step_size='0.001')
+    service.start()
+    feed.callback(diff(15, 16))
+    # The snapshot ends before the first buffered diff starts
+    assert not service.on_snapshot(SNAPSHOT)
+
+    # A gap inside the buffer: only the diffs after it are of use to the next snapshot
+    feed.callback(diff(18, 20))
+    assert not service.on_snapshot(dict(SNAPSHOT, lastUpdateId=15))
+    assert [update['U'] for update in service.buffer] == [18]
+    assert service.on_snapshot(dict(SNAPSHOT, lastUpdateId=17))
+    assert service.get_order_book()['last_update_id'] == 20
+
+    # A gap once in sync throws the book out of sync and asks for a snapshot again
+    feed.requested = []
+    feed.callback(diff(22, 23))
+    assert feed.requested == [service] and not service.recovered
+    assert service.on_snapshot(dict(SNAPSHOT, lastUpdateId=21))
+    assert service.get_order_book()['last_update_id'] == 23
+
+
+class Book(object):
+    """Stands in for an OrderBookService, taking the snapshots listed in usable in turn"""
+
+    def __init__(self, cross, usable=(True,)):
+        self.cross = cross
+        self.usable = list(usable)
+        self.snapshots = []
+        self.done = threading.Event()
+
+    def on_snapshot(self, snapshot):
+        self.snapshots.append(snapshot)
+        usable = self.usable.pop(0)
+        if usable:
+            self.done.set()
+        return usable
+
+
+class DepthClient(object):
+    """Stands in for the binance Client, failing the first fail_count snapshots of a symbol"""
+
+    def __init__(self, fail_count=None):
+        self.fail_count = dict(fail_count or {})
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_order_book(self, symbol):
+        with self.lock:
+            self.calls.append((symbol, time.monotonic()))
+            if self.fail_count.get(symbol, 0) > 0:
+                self.fail_count[symbol] -= 1
+                raise IOError('down')
+        return {'lastUpdateId': len(self.calls), 'bids': [], 'asks': []}
+
+
+def test_recovery_paces_snapshots_and_backs_off_on_failures():
+    client = DepthClient(fail_count={'LTCBTC': 2})
+    worker = SnapshotRecoveryWorker(client, min_interval_s=0.05, initial_backoff_s=0.1, max_backoff_s=0.15)
+    eth, ltc, bnb = Book('ETHBTC'), Book('LTCBTC'), Book('BNBBTC', usable=(False, True))
+    # Held so the worker cannot take ETHBTC off the queue before it is asked for twice
+    with worker.condition:
+        for book in (eth, ltc, bnb, eth):
+            worker.request(book)
+    for book in (eth, ltc, bnb):
+        assert book.done.wait(5)
+
+    # First come first served, a repeated request for a symbol already waiting is dropped, and no two snapshots
+    # go out less than min_interval_s apart whichever symbol they are for
+    symbols = [symbol for symbol, _ in client.calls]
+    assert symbols[:3] == ['ETHBTC', 'LTCBTC', 'BNBBTC'] and symbols.count('ETHBTC') == 1
+    times = [called for _, called in client.calls]
+    assert all(later - earlier >= 0.045 for earlier, later in zip(times, times[1:]))
+
+    # Failed fetches and unusable snapshots are retried after initial_backoff_s, doubling up to max_backoff_s
+    ltc_times = [called for symbol, called in client.calls if symbol == 'LTCBTC']
+    assert len(ltc_times) == 3 and len(ltc.snapshots) == 1
+    assert ltc_times[1] - ltc_times[0] >= 0.095 and ltc_times[2] - ltc_times[1] >= 0.145
+    assert len(bnb.snapshots) == 2 and worker.failed_attempts == {}
+
+
+def test_levels_finer_than_the_step_size_are_kept_not_rounded_away():
+    service, feed, published = follow()
+    feed.callback(diff(11, 11, bids=[('0.050000', '0.0005')], asks=[('0.0510005', '2')]))
+
+    # The whole book moved to finer increments, rather than the bid being deleted as a zero quantity
+    book = service.get_order_book()
+    assert book['bids'][0] == ['0.0500000', '0.0005'] and book['bids'][1] == ['0.0490000', '2.0000']
+    assert book['asks'][:2] == [['0.0510000', '1.0000'], ['0.0510005', '2.0000']]
+    assert published[-1][1]['asks'] == book['asks']
+    feed.callback(diff(12, 12, bids=[('0.050000', '0')]))
+    assert service.get_order_book()['bids'][0] == ['0.0490000', '2.0000']
+
+
+EXCHANGE_INFO = {'rateLimits': [],
+                 'symbols': [{'symbol': 'ETHBTC', 'baseAsset': 'ETH', 'quoteAsset': 'BTC',
+                              'filters': [{'filterType': 'PRICE_FILTER', 'tickSize': '0.00000100'},
+                                          {'filterType': 'LOT_SIZE', 'stepSize': '0.00100000'}]}]}
+
+
+class ExchangeInfoClient(object):
+    """Stands in for the binance Client, failing get_exchange_info while down"""
+
+    def __init__(self, down=True):
+        self.down = down
+        self.calls = 0
+
+    def get_exchange_info(self):
+        self.calls += 1
+        if self.down:
+            raise IOError('down')
+        return EXCHANGE_INFO
+
+
+def test_symbol_info_does_not_call_rest_on_every_lookup_after_a_failure(tmpdir):
+    client = ExchangeInfoClient()
+    symbol_info = SymbolInfoService(client, cache=MetadataCache(str(tmpdir)), retry_s=60)
+    try:
+        assert symbol_info.get('ETHBTC') is None and symbol_info.get('ETHBTC') is None
+        assert client.calls == 1 and symbol_info.failed_count == 1
+
+        # The scheduled retry, which would run in retry_s, loads it
+        client.down = False
+        symbol_info.refresh()
+        assert symbol_info.get('ETHBTC').tick_size == '0.00000100' and symbol_info.failed_count == 0
+    finally:
+        symbol_info.stop()
+
+
+def test_symbol_info_falls_back_on_a_stale_cached_copy(tmpdir):
+    with open(os.path.join(str(tmpdir), SymbolInfoService.CACHE_KEY + '.json'), 'w') as cache_file:
+        json.dump({'saved_at': 0, 'value': EXCHANGE_INFO}, cache_file)
+    client = ExchangeInfoClient()
+    symbol_info = SymbolInfoService(client, cache=MetadataCache(str(tmpdir)), retry_s=60)
+    try:
+        assert symbol_info.get('ETHBTC').step_size == '0.00100000' and client.calls == 1
+        symbol_info.refresh()
+        assert client.calls == 2 and symbol_info.failed_count == 2 and symbol_info.get('ETHBTC') is not None
+    finally:
+        symbol_info.stop()
+
+
+def test_symbol_info_from_the_cache_expires_ttl_after_it_was_fetched(tmpdir):
+    with open(os.path.join(str(tmpdir), SymbolInfoService.CACHE_KEY + '.json'), 'w') as cache_file:
+        json.dump({'saved_at': time.time() - 3000, 'value': EXCHANGE_INFO}, cache_file)
+    client = ExchangeInfoClient()
+    symbol_info = SymbolInfoService(client, cache=MetadataCache(str(tmpdir)), ttl_s=3600)
+    try:
+        assert symbol_info.get('ETHBTC') is not None and client.calls == 0
+        assert 590 < symbol_info.refresh_timer.interval <= 600
+    finally:
+        symbol_info.stop()
+
+
+def test_order_prices_round_toward_the_safe_side_and_quantities_down(tmpdir):
+    symbol_info = SymbolInfoService(ExchangeInfoClient(down=False), cache=MetadataCache(str(tmpdir)))
+    try:
+        # A buy is never sent dearer, nor a sell cheaper, than asked
+        assert symbol_info.format_price('ETHBTC', '0.0500006', 'BUY') == '0.050000'
+        assert symbol_info.format_price('ETHBTC', '0.0500006', 'sell') == '0.050001'
+        assert symbol_info.format_price('ETHBTC', '0.0500004', 'SELL') == '0.050001'
+        assert symbol_info.format_price('ETHBTC', '0.050001', 'BUY') == '0.050001'
+        assert symbol_info.format_price('ETHBTC', '0.0500006', None) == '0.0500006'
+        assert symbol_info.format_price('LTCBTC', '0.0500006', 'BUY') == '0.0500006'
+
+        assert symbol_info.format_quantity('ETHBTC', '1.2349') == '1.234'
+        assert symbol_info.format_quantity('ETHBTC', 2) == '2'
+        assert symbol_info.format_quantity('ETHBTC', '0.0009') == '0.000'
+    finally:
+        symbol_info.stop()
+
+
+class OrderClient(object):
+    """Stands in for the binance Client, recording the orders sent"""
+
+    def __init__(self):
+        self.orders = []
+
+    def create_order(self, **order):
+        self.orders.append(order)
+
+
+def test_create_order_refuses_a_quantity_below_one_step(tmpdir):
+    service = BinanceService('binance')
+    service.client = OrderClient()
+    service.symbol_info = SymbolInfoService(ExchangeInfoClient(down=False), cache=MetadataCache(str(tmpdir)))
+    published = []
+    service.notify_callbacks = lambda topic, **data: published.append(data['data'])
+    try:
+        service.create_order('ETH', 'BTC', '0.0500006', '0.0009', 'BUY', 'LIMIT', 'order-1')
+        assert service.client.orders == []
+        assert published[0]['action'] == 'CREATE_FAILED' and published[0]['reason'] == 'quantity_below_step_size'
+        assert published[0]['internal_order_id'] == 'order-1' and published[0]['quantity'] == '0.0009'
+
+        service.create_order('ETH', 'BTC', '0.0500006', '1.2349', 'SELL', 'LIMIT', 'order-2')
+        assert [(order['price'], order['quantity'], order['newClientOrderId']) for order in service.client.orders] == \
+            [('0.050001', '1.234', 'order-2')]
+        assert published[1]['action'] == 'order_sent'
+    finally:
+        service.symbol_info.stop()
+
+
+def test_captured_depth_replays_into_the_same_book(tmpdir):
+    directory = str(tmpdir)
+    capture = DepthCapture(directory, 'ETHBTC', '0.00000100', '0.00100000', segment_records=2)
+    live, feed, _ = follow(capture=capture)
+    for update_id, ask in ((11, '0.051500'), (12, '0.053000'), (13, '0.054000')):
+        feed.callback(diff(update_id, update_id, asks=[(ask, '1')]))
+    live.stop()
+
+    # Records: the first diff and the snapshot, then the three diffs after it
+    with open(os.path.join(directory, 'ETHBTC', 'index.jsonl')) as index_file:
+        index = [json.loads(line) for line in index_file]
+    assert [entry['segment'] for entry in index] == ['segment-000000.jsonl.gz', 'segment-000001.jsonl.gz',
+                                                     'segment-000002.jsonl.gz']
+    assert [entry['records'] for entry in index] == [2, 2, 1]
+    assert index[1]['first_update_id'] == 11 and index[2]['last_update_id'] == 13
+
+    replay = DepthReplay(directory, 'ETHBTC')
+    assert (replay.tick_size, replay.step_size) == ('0.00000100', '0.00100000')
+    published = []
+    replayed = OrderBookService(None, 'ETH', 'BTC', lambda topic, **data: published.append(data['data']),
+                                'binance', depth_socket=replay, recovery=replay, tick_size=replay.tick_size,
+                                step_size=replay.step_size)
+    replayed.start()
+    assert replay.run() == 5
+    assert replayed.get_order_book() == dict(live.get_order_book(), received_ms=replayed.snapshot.received_ms)
+    assert len(published) == 4
+
+    # Segments entirely outside a time range are skipped without being opened
+    capture = DepthCapture(directory, 'LTCBTC', '0.00000100', '0.00100000', segment_records=2)
+    for update_id in range(1, 6):
+        capture.record_diff(diff(update_id, update_id), received_ms=1000 * update_id)
+    capture.close()
+    replay = DepthReplay(directory, 'LTCBTC')
+    assert [os.path.basename(path) for path in replay.segments(start_ms=2500, end_ms=3500)] == \
+        ['segment-000001.jsonl.gz']
+    assert [record[2]['u'] for record in replay.records(start_ms=2500)] == [3, 4, 5]
+
+
+class Scheduler(object):
+    """Stands in for common.scheduler.Scheduler. Tasks only run when the test says"""
+
+    def __init__(self):
+        self.tasks = []
+
+    def schedule(self, name, function, period_s, jitter_s=0.0, first_run_s=None):
+        task = ScheduledTask(function, period_s)
+        self.tasks.append(task)
+        return task
+
+
+class ScheduledTask(object):
+
+    def __init__(self, function, period_s):
+        self.function = function
+        self.period_s = period_s
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def test_conflation_publishes_every_count_diffs():
+    scheduler = Scheduler()
+    service, feed, published = follow(conflation_count=3, scheduler=scheduler)
+    for update_id in range(11, 18):
+        feed.callback(diff(update_id, update_id, asks=[('0.051000', str(update_id))]))
+
+    assert [data['merged_updates'] for _, data in published[1:]] == [3, 3]
+    assert published[-1][1]['last_update_id'] == 16 and service.get_conflation_stats()['pending'] == 1
+    assert service.get_conflation_stats()['merged'] == 4
+
+
+def test_conflation_windows_close_on_the_scheduler_even_when_only_a_count_is_given():
+    scheduler = Scheduler()
+    service, feed, published = follow(conflation_count=3, scheduler=scheduler)
+    task, = scheduler.tasks
+    assert task.period_s == MAX_CONFLATION_MS / 1000.0
+    # A trailing diff that never makes up the count is published when its window closes
+    feed.callback(diff(11, 11, asks=[('0.051000', '7')]))
+    assert len(published) == 1
+    task.function()
+    assert published[-1][1]['merged_updates'] == 1 and published[-1][1]['asks'][0] == ['0.051000', '7.000']
+    task.function()
+    assert len(published) == 2 and service.get_conflation_stats()['pending'] == 0
+    service.stop()
+    assert task.cancelled
+
+
+def test_conflated_deltas_carry_each_level_changed_in_the_window_once():
+    scheduler = Scheduler()
+    service, feed, published = follow('delta', conflation_ms=50, scheduler=scheduler)
+    task, = scheduler.tasks
+    assert task.period_s == 0.05
+    feed.callback(diff(11, 11, asks=[('0.051000', '7')]))
+    feed.callback(diff(12, 13, asks=[('0.051000', '8'), ('0.052000', '0')], bids=[('0.047000', '1')]))
+    assert len(published) == 1
+    task.function()
+
+    order_book_type, delta = published[-1]
+    assert order_book_type == 'delta' and delta['merged_updates'] == 2
+    assert (delta['first_update_id'], delta['last_update_id']) == (11, 13)
+    assert sorted(delta['asks']) == [['0.051000', '8.000'], ['0.052000', '0.000']]
+    assert delta['bids'] == [['0.047000', '1.000']]
+
+
+class Clock(object):
+    """Wall clock seconds that only move when the test says"""
+
+    def __init__(self, now_s):
+        self.now_s = now_s
+
+    def __call__(self):
+        return self.now_s
+
+
+class Response(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class RateLimited(Exception):
+
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.response = Response(headers)
+
+
+def wake(governor, clock, now_s):
+    """Moves the clock and wakes the calls waiting on the governor, as the end of their wait would"""
+    clock.now_s = now_s
+    with governor.condition:
+        governor.condition.notify_all()
+
+
+def governed(governor, weight, priority, done):
+    thread = threading.Thread(target=lambda: (governor.acquire(weight, priority), done.append(priority)))
+    thread.start()
+    return thread
+
+
+def test_governor_keeps_lower_priorities_under_their_ceiling():
+    clock = Clock(1000.0)
+    governor = WeightGovernor(None, limit=100, interval_s=60, clock=clock)
+    # Binance counts other processes on our IP too. The newest header wins, but never lowers our own count
+    governor.observe(Response({'X-MBX-USED-WEIGHT': '70', 'Content-Type': 'application/json'}))
+    governor.observe(Response({'X-MBX-USED-WEIGHT-1M': '74', 'X-MBX-USED-WEIGHT': '1'}))
+    assert governor.used == 74
+
+    done = []
+    market_data = governed(governor, 5, MARKET_DATA, done)
+    wait_for(lambda: len(governor.waiting) == 1)
+    # Past the market data ceiling (75), under the account (90) and order (100) ones
+    assert governor.acquire(10, ACCOUNT) == 0 and governor.acquire(16, ORDERS) == 0
+    governor.observe(Response({'X-MBX-USED-WEIGHT-1M': '80'}))
+    assert governor.used == 100 and done == []
+
+    # Every priority gets the next minute's budget
+    wake(governor, clock, 1020.0)
+    market_data.join(5)
+    assert done == [MARKET_DATA] and governor.used == 5
+    assert governor.get_stats()['throttled'] == {'orders': 0, 'account': 0, 'market_data': 1}
+
+
+def test_governor_pauses_for_retry_after_then_serves_orders_first():
+    clock = Clock(1000.0)
+    governor = WeightGovernor(None, limit=100, interval_s=60, clock=clock)
+    governor.observe(Response({'X-MBX-USED-WEIGHT-1M': '70'}))
+    governor.on_error(RateLimited(429, {'Retry-After': '5'}))
+    assert governor.get_stats()['rate_limited'] == 1
+
+    done = []
+    market_data = governed(governor, 5, MARKET_DATA, done)
+    wait_for(lambda: len(governor.waiting) == 1)
+    orders = governed(governor, 10, ORDERS, done)
+    wait_for(lambda: len(governor.waiting) == 2)
+    wake(governor, clock, 1004.0)
+    time.sleep(0.05)
+    assert done == [] and len(governor.waiting) == 2
+
+    # The order, though asked for last, goes first. Had the market data call gone first, both would fit
+    wake(governor, clock, 1005.0)
+    orders.join(5)
+    assert done == [ORDERS] and governor.used == 80
+    wake(governor, clock, 1020.0)
+    market_data.join(5)
+    assert done == [ORDERS, MARKET_DATA]
+
+    # Without a Retry-After, a ban (418) lasts until the end of the interval
+    governor.on_error(RateLimited(418, {}))
+    assert governor.paused_until_s == 1080.0
+    governor.on_error(RateLimited(400, {'Retry-After': '600'}))
+    assert governor.paused_until_s == 1080.0
+
+
+class ServerTimeClient(object):
+
+    def __init__(self):
+        self.response = None
+        self.calls = 0
+
+    def get_server_time(self):
+        self.calls += 1
+        return {'serverTime': int(time.time() * 1000)}
+
+
+def test_clock_sync_takes_request_weight_from_the_governor():
+    client = ServerTimeClient()
+    governor = WeightGovernor(client, limit=100, interval_s=60, clock=Clock(1000.0))
+    clock_sync = ClockSync(client, ClockOffset(), governor=governor)
+    clock_sync.start()
+    clock_sync.stop()
+    assert client.calls == ClockSync.INITIAL_SAMPLES and governor.used == ClockSync.INITIAL_SAMPLES
@@ -0,0 +1,495 @@
+import threading
+import time
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from exchanges.common.dispatcher import Dispatcher
+from exchanges.common.events import ExecutionEvent, LifecycleEvent
+from exchanges.common.fixed_point import FixedPointCodec, PrecisionError
+from exchanges.common.metrics import ClockOffset, Histogram, MetricsRegistry, to_prometheus
+from exchanges.common.order_store import OrderStore
+from exchanges.common.price_levels import PriceLevels
+from exchanges.common.rate_limiter import TokenBucket, get_bucket
+from exchanges.common.scheduler import Scheduler
+from exchanges.common.warm_up import warm_up
+
+
+def test_levels_are_read_best_first():
+    bids = PriceLevels(descending=True)
+    asks = PriceLevels()
+    for price, quantity in [('100.2', '200'), ('100.4', '100'), ('100.3', '50')]:
+        bids.set(Decimal(price), quantity)
+    for price, quantity in [('101.4', '50'), ('101.2', '30'), ('101.3', '100')]:
+        asks.set(Decimal(price), quantity)
+
+    assert bids.top() == [[Decimal('100.4'), '100'], [Decimal('100.3'), '50'], [Decimal('100.2'), '200']]
+    assert asks.top(2) == [[Decimal('101.2'), '30'], [Decimal('101.3'), '100']]
+    assert bids.best() == [Decimal('100.4'), '100']
+    assert bids.top(0) == []
+    assert len(asks.top(10)) == 3
+
+
+def test_set_replaces_and_remove_deletes():
+    asks = PriceLevels()
+    asks.set(Decimal('0.001'), '1')
+    asks.set(Decimal('0.00100000'), '2')
+    asks.set(Decimal('0.002'), '3')
+    assert len(asks) == 2
+    assert asks.get(Decimal('0.001')) == '2'
+
+    asks.remove(Decimal('0.001'))
+    asks.remove(Decimal('0.005'))
+    assert asks.top() == [[Decimal('0.002'), '3']]
+    assert PriceLevels().best() is None
+
+    bids = PriceLevels(descending=True)
+    for price in range(300):
+        bids.set(price, 1)
+    bids.rescale(10, 2)
+    assert bids.top(2) == [[2990, 2], [2980, 2]] and bids.get(1500) == 2 and bids.get(1501) is None
+
+
+def test_fixed_point_round_trip():
+    prices = FixedPointCodec('0.00100000')
+    assert prices.to_int('0.00100000') == prices.to_int('0.001') == 1
+    assert prices.to_int('12.3450') == 12345
+    assert prices.to_str(12345) == '12.345'
+    assert prices.to_str(1) == '0.001'
+    assert prices.to_decimal(12345) == Decimal('12.345')
+
+    ticks = FixedPointCodec('0.05')
+    assert ticks.to_int('1.15') == 23
+    assert ticks.to_str(23) == '1.15'
+
+    lots = FixedPointCodec('1.00000000')
+    assert lots.to_int('0.00000000') == 0
+    assert lots.to_str(42) == '42'
+
+
+def test_fixed_point_refuses_values_finer_than_the_increment():
+    steps = FixedPointCodec('0.00100000')
+    for value in ('0.0005', '12.3459', '0.00000001'):
+        with pytest.raises(PrecisionError):
+            steps.to_int(value)
+    with pytest.raises(PrecisionError):
+        FixedPointCodec('0.05').to_int('1.13')
+
+    finer, factor = steps.finer('0.00050000')
+    assert finer.increment == '0.0001' and factor == 10
+    assert finer.to_int('0.0005') == 5 and finer.to_int('12.345') == steps.to_int('12.345') * factor
+
+    finer, factor = FixedPointCodec('0.05').finer('1.13')
+    assert finer.increment == '0.01' and factor == 5 and finer.to_int('1.13') == 113
+    finer, factor = FixedPointCodec('10').finer('15')
+    assert finer.increment == '1' and factor == 10 and finer.to_str(15) == '15'
+
+
+def test_levels_match_a_sorted_dict_and_frozen_copies_do_not_change():
+    import random
+    random.seed(7)
+    bids = PriceLevels(descending=True)
+    expected = {}
+    frozen, frozen_expected = None, None
+    for i in range(5000):
+        price = random.randint(0, 2000)
+        if random.random() < 0.3:
+            bids.remove(price)
+            expected.pop(price, None)
+        else:
+            bids.set(price, i)
+            expected[price] = i
+        if i == 2500:
+            frozen, frozen_expected = bids.freeze(), dict(expected)
+
+    assert bids.top() == [[price, expected[price]] for price in sorted(expected, reverse=True)]
+    assert len(bids) == len(expected)
+    assert frozen.top() == [[price, frozen_expected[price]] for price in sorted(frozen_expected, reverse=True)]
+    assert all(frozen.get(price) == quantity for price, quantity in frozen_expected.items())
+
+
+def test_slow_subscriber_conflates_books_and_keeps_lifecycle_events():
+    release = threading.Event()
+    done = threading.Event()
+    slow, fast = [], []
+
+    def slow_callback(topic, **data):
+        release.wait(5)
+        slow.append((topic, data['data']))
+        if topic == 'trade_lifecycle' and data['data']['id'] == 2:
+            done.set()
+
+    dispatcher = Dispatcher()
+    dispatcher.add('slow', slow_callback, queue_size=10)
+    dispatcher.add('fast', lambda topic, **data: fast.append(topic), policies={'order_book': 'block'})
+
+    dispatcher.dispatch('trade_lifecycle', data={'id': 0})
+    for version in range(100):
+        dispatcher.dispatch('order_book', data={'base': 'BTC', 'quote': 'USDT', 'exchange': 'binance',
+                                                'version': version})
+    dispatcher.dispatch('trade_lifecycle', data={'id': 1})
+    dispatcher.dispatch('trade_lifecycle', data={'id': 2})
+    # The fast subscriber gets everything while the slow one is still stuck on its first message
+    deadline = time.time() + 5
+    while len(fast) < 103 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(fast) == 103 and len(slow) == 0
+    release.set()
+    assert done.wait(5)
+
+    books = [data['version'] for topic, data in slow if topic == 'order_book']
+    assert books[-1] == 99 and len(books) <= 2
+    assert [data['id'] for topic, data in slow if topic == 'trade_lifecycle'] == [0, 1, 2]
+    stats = dispatcher.get_stats()['slow']
+    assert stats['conflated'] >= 98 and stats['dropped'] == 0
+    dispatcher.remove_all()
+
+
+def test_callbacks_only_get_the_topics_and_markets_they_asked_for():
+    received = {'lifecycle': [], 'eth_btc': [], 'all': []}
+    done = threading.Event()
+
+    def recorder(name):
+        def callback(topic, **data):
+            received[name].append((topic, data['data'].get('base')))
+            if name == 'all' and len(received['all']) == 4:
+                done.set()
+        return callback
+
+    dispatcher = Dispatcher()
+    dispatcher.add('lifecycle', recorder('lifecycle'), topics=['trade_lifecycle'])
+    dispatcher.add('eth_btc', recorder('eth_btc'), markets=[('ETH', 'BTC')])
+    dispatcher.add('all', recorder('all'))
+
+    dispatcher.dispatch('order_book', data={'base': 'ETH', 'quote': 'BTC'})
+    dispatcher.dispatch('order_book', data={'base': 'LTC', 'quote': 'BTC'})
+    dispatcher.dispatch('trade_lifecycle', data={'base': 'LTC', 'quote': 'BTC'})
+    dispatcher.dispatch('account', data={})
+    assert done.wait(5)
+    time.sleep(0.05)
+
+    assert received['lifecycle'] == [('trade_lifecycle', 'LTC')]
+    assert received['eth_btc'] == [('order_book', 'ETH'), ('account', None)]
+    dispatcher.remove_all()
+
+
+def test_each_callback_gets_its_own_copy_of_an_event_to_change():
+    both_changed = threading.Barrier(2, timeout=5)
+    seen = {}
+
+    def changer(name):
+        def callback(topic, **data):
+            event = data['data']
+            event['request_id'] = name
+            event.pop('price')
+            # Both have changed their event before either reads it back
+            both_changed.wait()
+            seen[name] = (event['request_id'], 'price' in event, data['balances'][0]['free'])
+            data['balances'][0]['free'] = name
+        return callback
+
+    dispatcher = Dispatcher()
+    dispatcher.add('first', changer('first'))
+    dispatcher.add('eth_btc', changer('eth_btc'), markets=[('ETH', 'BTC')])
+    event = LifecycleEvent(action='CREATED', base='ETH', quote='BTC', price='0.05', request_id='r1')
+    balances = [{'asset': 'ETH', 'free': '1'}]
+    dispatcher.dispatch('trade_lifecycle', data=event, balances=balances)
+    wait_until(lambda: len(seen) == 2)
+    dispatcher.remove_all()
+
+    assert seen == {'first': ('first', False, '1'), 'eth_btc': ('eth_btc', False, '1')}
+
+
+def test_events_read_and_write_like_the_dicts_they_replace():
+    message = LifecycleEvent(action='CREATED', base='ETH', quote='BTC', quantity='1', cum_quantity_filled=0)
+
+    assert message['action'] == 'CREATED' and message.get('price') is None and 'price' not in message
+    message['cum_quantity_filled'] = '0.5'
+    message['request_id'] = 'r1'
+    message['not_a_field'] = 1
+    assert 'not_a_field' in message.keys() and message.pop('not_a_field') == 1
+    assert message.to_dict() == {'action': 'CREATED', 'base': 'ETH', 'quote': 'BTC', 'request_id': 'r1',
+                                 'quantity': '1', 'cum_quantity_filled': '0.5'}
+    assert message.copy() == message and message.copy() is not message
+
+    execution = ExecutionEvent(action='EXECUTION', fee_base=0)
+    assert execution['fee_base'] == 0 and 'fee_quote' not in execution
+    try:
+        execution['trade_id']
+        assert False
+    except KeyError:
+        pass
+
+
+def test_histogram_percentiles_and_clock_offset():
+    histogram = Histogram(bounds=(1, 2, 5, 10))
+    for value in [0.5] * 90 + [3] * 9 + [50]:
+        histogram.observe(value)
+
+    stats = histogram.get_stats()
+    assert stats['count'] == 100 and stats['min'] == 0.5 and stats['max'] == 50
+    assert stats['p50'] == 1 and stats['p90'] == 1 and stats['p99'] == 5 and stats['p999'] == 50
+
+    clock = ClockOffset(samples=2)
+    clock.add_sample(server_ms=1100, sent_ms=1000, received_ms=1010)
+    clock.add_sample(server_ms=2150, sent_ms=2000, received_ms=2200)
+    assert clock.round_trip_ms == 10 and clock.offset_ms == 95
+    assert clock.to_local_ms(5095) == 5000
+
+
+def test_metrics_registry_collects_and_renders_prometheus_text():
+    registry = MetricsRegistry('binance')
+    registry.counter('book_updates_total', 'Depth diffs received', symbol='ETHBTC').inc()
+    registry.counter('book_updates_total', symbol='ETHBTC').inc(2)
+    registry.gauge('socket_connections', socket='depth').set(3)
+    registry.histogram('rest_request_ms', endpoint='depth').observe(4)
+    registry.add_collector(lambda: [('callback_queue_depth', 'gauge', '', {'callback': 'cb'}, 7)])
+
+    metrics = registry.get_metrics()
+    assert metrics['book_updates_total']['samples'] == [{'labels': {'symbol': 'ETHBTC', 'exchange': 'binance'},
+                                                         'value': 3}]
+    assert metrics['rest_request_ms']['samples'][0]['value']['count'] == 1
+    try:
+        registry.gauge('book_updates_total')
+        assert False
+    except ValueError:
+        pass
+
+    text = to_prometheus([registry, MetricsRegistry('bittrex')]).splitlines()
+    assert '# HELP exchanges_book_updates_total Depth diffs received' in text
+    assert 'exchanges_book_updates_total{exchange="binance",symbol="ETHBTC"} 3' in text
+    assert 'exchanges_socket_connections{exchange="binance",socket="depth"} 3' in text
+    assert 'exchanges_callback_queue_depth{callback="cb",exchange="binance"} 7' in text
+    assert 'exchanges_rest_request_ms_bucket{endpoint="depth",exchange="binance",le="5"} 1' in text
+    assert 'exchanges_rest_request_ms_count{endpoint="depth",exchange="binance"} 1' in text
+
+
+def test_order_store_indexes_follow_fills_and_cancels():
+    orders = OrderStore()
+    created = LifecycleEvent(action='CREATED', exchange_order_id='e1', internal_order_id='i1', base='ETH', quote='BTC',
+                             side='buy', price='0.05', quantity='2', cum_quantity_filled=0)
+    orders.add(created)
+    orders.add(LifecycleEvent(action='CREATED', exchange_order_id='e2', internal_order_id='i2', base='ETH',
+                              quote='BTC', side='buy', price='0.050', quantity='1', cum_quantity_filled=0))
+    orders.add(LifecycleEvent(action='CREATED', exchange_order_id='e3', internal_order_id='i3', base='LTC',
+                              quote='BTC', side='sell', price='0.01', quantity='5', cum_quantity_filled=0))
+
+    assert orders.get_exchange_id('i1') == 'e1' and orders.get('i3')['exchange_order_id'] == 'e3'
+    assert len(orders.get_market('ETH', 'BTC')) == 2 and len(orders.get_at_price('buy', Decimal('0.05'))) == 2
+    assert orders.get_quantities_by_price() == {'bids': {Decimal('0.05'): Decimal(3)}, 'asks': {Decimal('0.01'): 5}}
+
+    before = orders.get_quantities_by_price()
+    order, newly_filled = orders.fill('e1', '0.5')
+    assert newly_filled == Decimal('0.5') and created['cum_quantity_filled'] == 0
+    assert orders.get_quantities_by_price()['bids'] == {Decimal('0.05'): Decimal('2.5')}
+    assert before['bids'] == {Decimal('0.05'): Decimal(3)}
+    try:
+        before['bids'][Decimal('0.05')] = 0
+        assert False
+    except TypeError:
+        pass
+    order, newly_filled = orders.fill('e1', '2', done=True)
+    assert newly_filled == Decimal('1.5') and 'e1' not in orders and orders.get('i1') is None
+    assert orders.fill('e1', '2') == (None, None)
+
+    orders.set_pending_cancel('i2')
+    assert orders.is_pending_cancel('i2')
+    assert orders.remove(internal_order_id='i2')['exchange_order_id'] == 'e2' and not orders.is_pending_cancel('i2')
+    assert orders.get_at_price('buy', '0.05') == [] and orders.get_market('ETH', 'BTC') == []
+    assert [order['exchange_order_id'] for order in orders.remove_market('LTC', 'BTC')] == ['e3'] and len(orders) == 0
+    assert orders.get_quantities_by_price() == {'bids': {}, 'asks': {}}
+
+
+def test_order_store_counts_only_buys_and_sells_by_price():
+    orders = OrderStore()
+    for exchange_order_id, side in [('e1', 'BUY'), ('e2', 'Sell'), ('e3', None), ('e4', 'short'), ('e5', 'buy')]:
+        orders.add(LifecycleEvent(action='CREATED', exchange_order_id=exchange_order_id, base='ETH', quote='BTC',
+                                  side=side, price='0.05', quantity='1', cum_quantity_filled=0))
+
+    assert len(orders) == 5
+    assert orders.get_quantities_by_price() == {'bids': {Decimal('0.05'): Decimal(2)}, 'asks': {Decimal('0.05'): 1}}
+    orders.fill('e3', '0.5')
+    orders.remove('e4')
+    assert orders.get_quantities_by_price() == {'bids': {Decimal('0.05'): Decimal(2)}, 'asks': {Decimal('0.05'): 1}}
+    orders.remove('e1')
+    orders.remove('e2')
+    assert orders.get_quantities_by_price() == {'bids': {Decimal('0.05'): Decimal(1)}, 'asks': {}}
+
+
+def test_services_warm_up_at_once_and_failures_are_left_out():
+    # Only passed when all three warm up at the same time. One after the other, the first would time out
+    all_started = threading.Barrier(3, timeout=5)
+
+    class Service(object):
+        def __init__(self, name, fails=False):
+            self.name = name
+            self.fails = fails
+
+        def warm_up(self):
+            all_started.wait()
+            time.sleep(0.01)
+            if self.fails:
+                raise IOError('down')
+
+    durations = warm_up([Service('a'), Service('b'), Service('c', fails=True)])
+    assert durations['a'] >= 0.01 and durations['b'] >= 0.01 and durations['c'] is None
+    assert warm_up([]) == {}
+
+
+def wait_until(condition, timeout_s=10):
+    deadline = time.monotonic() + timeout_s
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert condition()
+
+
+def test_scheduler_skips_runs_of_a_task_still_running():
+    scheduler = Scheduler(workers=2)
+    fast_runs = []
+    release = threading.Event()
+
+    def fail():
+        raise ValueError('down')
+
+    scheduled_at = time.monotonic()
+    fast = scheduler.schedule('fast', lambda: fast_runs.append(time.monotonic()), 0.02, first_run_s=0)
+    slow = scheduler.schedule('slow', lambda: release.wait(10), 0.02, first_run_s=0)
+    failing = scheduler.schedule('failing', fail, 0.02, jitter_s=0.01)
+    try:
+        # The slow task's first run is still blocked, so every later slot of it is skipped, not queued
+        wait_until(lambda: slow.skipped_count >= 3 and failing.failed_count >= 1 and len(fast_runs) >= 5)
+        assert slow.run_count == 0 and slow.running
+        release.set()
+        wait_until(lambda: slow.run_count >= 1)
+        assert slow.overrun_count >= 1
+
+        fast.cancel()
+        cancelled_at = len(fast_runs)
+        time.sleep(0.1)
+        stats = scheduler.get_stats()
+    finally:
+        scheduler.stop()
+
+    # No more than one run per period, as missed slots are skipped rather than caught up in a burst. A run may have
+    # been in flight when the task was cancelled
+    assert len(fast_runs) - 1 <= (fast_runs[-1] - scheduled_at) / 0.02 + 0.01
+    assert len(fast_runs) <= cancelled_at + 1 and 'fast' not in stats
+    assert stats['failing']['failed'] == stats['failing']['runs'] > 0
+    assert ('task_ticks_total', 'counter', 'Scheduled runs of a polling task by what became of them',
+            {'task': 'slow', 'outcome': 'skipped'}, slow.skipped_count) in list(slow.collect())
+    assert failing.cancelled
+
+
+def test_scheduler_keeps_its_pace_when_the_wall_clock_steps(monkeypatch):
+    scheduler = Scheduler(workers=1)
+    runs = []
+    wall_clock = time.time
+    try:
+        task = scheduler.schedule('tick', lambda: runs.append(time.monotonic()), 0.05, first_run_s=0)
+        wait_until(lambda: len(runs) >= 1)
+        # As an NTP step or a manual change of the time would
+        monkeypatch.setattr(time, 'time', lambda: wall_clock() - 3600)
+        stepped_at = time.monotonic()
+        wait_until(lambda: len(runs) >= 4, timeout_s=2)
+        monkeypatch.setattr(time, 'time', lambda: wall_clock() + 3600)
+        time.sleep(0.12)
+    finally:
+        scheduler.stop()
+
+    # Neither stalled by the step back nor caught up in a burst by the step forward
+    assert runs[3] - stepped_at < 1
+    assert len(runs) - 1 <= (runs[-1] - runs[0]) / 0.05 + 0.01
+    assert task.skipped_count == 0
+
+
+class FakeClock(object):
+    """Time that only moves when slept through"""
+
+    def __init__(self):
+        self.now_s = 0.0
+
+    def time(self):
+        return self.now_s
+
+    def sleep(self, seconds):
+        self.now_s += seconds
+
+
+def test_token_bucket_lets_bursts_through_and_only_waits_once_they_are_spent():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_per_s=20, burst=5, name='test', clock=clock.time, sleep=clock.sleep)
+    assert [bucket.acquire() for _ in range(5)] == [0.0] * 5 and clock.now_s == 0
+
+    # Then one token per 1/20s
+    assert [bucket.acquire() for _ in range(4)] == [pytest.approx(0.05)] * 4
+    assert clock.now_s == pytest.approx(0.2)
+    stats = bucket.get_stats()
+    assert stats['acquired'] == 9 and stats['throttled'] == 4 and stats['throttled_s'] == pytest.approx(0.2)
+
+    # Idle time refills up to the burst, no more
+    clock.sleep(10)
+    assert bucket.get_stats()['tokens'] == 5
+    assert bucket.acquire(5) == 0.0 and bucket.acquire(2) == pytest.approx(0.1)
+
+    assert get_bucket('test:key', 1, 1) is get_bucket('test:key', 5, 5) and get_bucket('test:key', 1, 1).burst == 1
+
+
+def test_token_bucket_spreads_waiting_threads_out_at_the_rate():
+    bucket = TokenBucket(rate_per_s=50, burst=1)
+    bucket.acquire()
+    started = time.monotonic()
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Served one after the other rather than all woken at once, so never faster than the rate
+    assert time.monotonic() - started >= 0.09
+    assert bucket.get_stats()['acquired'] == 6
+
+
+def test_async_http_runs_requests_at_once_and_retries_unavailable_gets():
+    pytest.importorskip('aiohttp')
+    from exchanges.common.async_http import AsyncHttpClient
+
+    unavailable = ['/flaky']
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(0.2)
+            status = 503 if self.path in unavailable else 200
+            if self.path in unavailable:
+                unavailable.remove(self.path)
+            body = '\ufeff{{"path": "{}"}}'.format(self.path).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    http = AsyncHttpClient(backoff_s=0.01)
+    try:
+        started = time.time()
+        responses = http.run_all([http.request('GET', '{}/{}'.format(url, i)) for i in range(5)])
+        assert time.time() - started < 0.6
+        assert [response.json()['path'] for response in responses] == ['/{}'.format(i) for i in range(5)]
+
+        assert http.run(http.request('GET', url + '/flaky')).status_code == 200
+        results = http.run_all([http.request('GET', 'http://127.0.0.1:1/refused', retry=False),
+                                http.in_thread(lambda: 'blocking')])
+        assert isinstance(results[0], Exception) and results[1] == 'blocking'
+    finally:
+        http.close()
+        server.shutdown()
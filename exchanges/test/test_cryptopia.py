@@ -0,0 +1,101 @@
+import asyncio
+from decimal import Decimal
+
+from exchanges.cryptopia import CryptopiaService
+from exchanges.cryptopia.api import Api, chunk_markets
+
+
+def url_length(markets):
+    return Api.public_url_length('GetMarketOrderGroups', {'markets': '-'.join(markets)})
+
+
+def test_markets_are_chunked_by_url_length_in_order():
+    markets = ['AAA_BTC', 'BBB_BTC', 'CCC_BTC', 'DDD_BTC', 'EEE_BTC']
+    chunks = chunk_markets(markets, max_url_length=url_length(markets[:2]))
+    assert chunks == [['AAA_BTC', 'BBB_BTC'], ['CCC_BTC', 'DDD_BTC'], ['EEE_BTC']]
+    assert chunk_markets(markets, max_url_length=url_length(markets)) == [markets]
+    assert chunk_markets([]) == []
+
+
+def test_a_market_too_long_for_any_url_gets_a_chunk_to_itself():
+    long_market = 'X' * 100 + '_BTC'
+    chunks = chunk_markets(['AAA_BTC', long_market, 'BBB_BTC'], max_url_length=url_length(['AAA_BTC', 'BBB_BTC']))
+    assert chunks == [['AAA_BTC'], [long_market], ['BBB_BTC']]
+
+
+def test_markets_are_chunked_by_count():
+    markets = ['C{:03d}_BTC'.format(i) for i in range(120)]
+    chunks = chunk_markets(markets)
+    assert [len(chunk) for chunk in chunks] == [50, 50, 20]
+    assert [market for chunk in chunks for market in chunk] == markets
+    assert all(url_length(chunk) <= 2000 for chunk in chunks)
+    assert [len(chunk) for chunk in chunk_markets(markets[:5], max_markets=2)] == [2, 2, 1]
+
+
+class Http(object):
+    """Stands in for common.async_http.AsyncHttpClient, running the coroutines on a loop of its own"""
+
+    def run_all(self, coroutines, timeout_s=None):
+        async def gather():
+            return await asyncio.gather(*coroutines, return_exceptions=True)
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(gather())
+        finally:
+            loop.close()
+
+
+class Client(object):
+    """Stands in for cryptopia.api.Api, answering GetMarketOrderGroups with a book per market unless told to fail"""
+
+    def __init__(self, failing=None):
+        # The failure, an exception or an error message, of a request by the first market it asks for
+        self.failing = failing or {}
+        self.requested = []
+
+    async def get_ordergroups_async(self, markets):
+        self.requested.append(markets)
+        names = markets.split('-')
+        failure = self.failing.get(names[0])
+        if isinstance(failure, Exception):
+            raise failure
+        if failure is not None:
+            return None, failure
+        return [{'Market': name, 'Buy': [{'Price': 0.5, 'Volume': 2}], 'Sell': [{'Price': 0.6, 'Volume': 1}]}
+                for name in reversed(names)], None
+
+
+def poll(markets, client):
+    service = CryptopiaService('cryptopia', 'key', 'secret', tick_tock=False)
+    service.http = Http()
+    service.client = client
+    published = []
+    service.notify_callbacks = lambda topic, data: published.append((topic, data))
+    for base, quote in markets:
+        service.follow_market(base, quote)
+    service._poll_markets(list(service.markets_following.values()))
+    return service, published
+
+
+def test_books_split_across_chunks_are_fanned_out_per_market():
+    markets = [('C{:03d}'.format(i), 'BTC') for i in range(120)]
+    client = Client()
+    service, published = poll(markets, client)
+
+    assert [len(request.split('-')) for request in client.requested] == [50, 50, 20]
+    # Matched to their markets by name, whatever order the groups come back in
+    assert [(book['base'], book['quote']) for _, book in published] == markets
+    assert all(topic == 'order_book' and book['exchange'] == 'cryptopia' for topic, book in published)
+    assert published[0][1]['bids'] == [[Decimal('0.5'), Decimal('2')]]
+    assert service.metrics.counter('errors_total', where='on_tick').value == 0
+
+
+def test_a_failing_chunk_loses_only_its_own_books():
+    markets = [('C{:03d}'.format(i), 'BTC') for i in range(120)]
+    client = Client(failing={'C050_BTC': IOError('connection reset'), 'C100_BTC': 'Status Code : 503'})
+    service, published = poll(markets, client)
+
+    assert len(client.requested) == 3
+    assert [(book['base'], book['quote']) for _, book in published] == markets[:50]
+    assert service.metrics.counter('errors_total', where='on_tick').value == 2
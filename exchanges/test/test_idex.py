@@ -0,0 +1,37 @@
+from exchanges.idex import IdexService
+
+
+class Response(object):
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+class Session(object):
+    """Stands in for the requests session IdexService talks to IDEX through"""
+
+    def __init__(self):
+        self.posted = []
+
+    def post(self, uri, json=None, headers=None, timeout=None):
+        self.posted.append((uri, json))
+        return Response({'nonce': 2650})
+
+
+def test_service_with_an_address_starts_from_the_exchange_nonce(monkeypatch):
+    session = Session()
+    monkeypatch.setattr(IdexService, '_init_session', lambda self: session)
+    key = '0x' + 'ab' * 32
+    service = IdexService('idex', address='0x925CFC20DE3FCBDBA2D6E7C75DBB1D0A3F93B8A3', private_key=key,
+                          tick_tock=False)
+
+    assert session.posted == [('https://api.idex.market/returnNextNonce',
+                               {'address': '0x925cfc20de3fcbdba2d6e7c75dbb1d0a3f93b8a3'})]
+    assert service._start_nonce == 2650
+    assert service._private_key == key
+    assert service.metrics.counter('rest_requests_total', endpoint='returnNextNonce').value == 1
@@ -0,0 +1,90 @@
+import http.client
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from exchanges.okex_service.rest_client import ConnectionPool
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(handle):
+    """A local keep-alive HTTP server calling handle(request handler) per request. Returns it and the requests seen"""
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            requests.append((self.command, self.path, body))
+            handle(self)
+
+        do_GET = respond
+        do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, requests
+
+
+def reply(handler, close_after=False):
+    handler.send_response(200)
+    handler.send_header('Content-Length', '2')
+    handler.end_headers()
+    handler.wfile.write(b'{}')
+    # Closes the connection without telling the client, as a server timing out an idle keep-alive connection does
+    handler.close_connection = close_after
+
+
+def drop(handler):
+    handler.close_connection = True
+
+
+def test_pool_never_sends_a_post_twice_when_its_connection_fails():
+    def handle(handler):
+        if handler.path == '/trade.do' or (handler.path == '/depth.do' and len(requests) == 2):
+            drop(handler)
+        else:
+            reply(handler)
+
+    server, requests = serve(handle)
+    pool = ConnectionPool('127.0.0.1:{}'.format(server.server_address[1]), size=1,
+                          connection_class=http.client.HTTPConnection)
+    try:
+        assert pool.request('GET', '/ticker.do') == '{}'
+        # A GET whose reused connection drops is sent again on a new one
+        assert pool.request('GET', '/depth.do') == '{}'
+        assert [path for _, path, _ in requests] == ['/ticker.do', '/depth.do', '/depth.do']
+        assert pool.reconnect_count == 1
+
+        # An order whose reused connection drops after it was written may have been placed, so it is not resent
+        with pytest.raises(http.client.RemoteDisconnected):
+            pool.request('POST', '/trade.do', 'symbol=eth_btc', {'Content-type': 'application/x-www-form-urlencoded'})
+        assert [request for request in requests if request[0] == 'POST'] == [('POST', '/trade.do', b'symbol=eth_btc')]
+        assert pool.reconnect_count == 1
+    finally:
+        pool.close()
+        server.shutdown()
+
+
+def test_pool_drops_idle_connections_the_server_closed_before_sending_a_post():
+    server, requests = serve(lambda handler: reply(handler, close_after=handler.path == '/ticker.do'))
+    pool = ConnectionPool('127.0.0.1:{}'.format(server.server_address[1]), size=1,
+                          connection_class=http.client.HTTPConnection)
+    try:
+        assert pool.request('GET', '/ticker.do') == '{}'
+        time.sleep(0.2)
+        assert pool.request('POST', '/trade.do', 'symbol=eth_btc') == '{}'
+        assert len(requests) == 2 and pool.discarded_count == 1 and pool.opened_count == 2
+    finally:
+        pool.close()
+        server.shutdown()
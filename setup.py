@@ -12,6 +12,7 @@ setup(
         'Flask==0.12.2',
         'pandas==0.20.1',
         'requests==2.18.4',
+        'aiohttp==3.7.4.post0',
         'aj_sns==0.0.56',
         'networkx==2.1',
         'ethereum==2.3.1',